@@ -60,8 +60,8 @@ hsm_name = "C:/Users/s150127/Downloads/___MBx/datasets/_1nMimager_newGNRs_100mW_
 
 NAME = "test_v2"
 
-fit_options = ["Gaussian - Fit bg", "Gaussian - Estimate bg",
-               "Phasor + Intensity", "Phasor + Sum", "Phasor"]
+fit_options = ["Gaussian - Fit bg", "Gaussian - Estimate bg", "Gaussian - Fixed sigma",
+               "Phasor + Intensity", "Phasor + Sum", "Phasor", "Radial symmetry"]
 
 ALL_FIGURES = False
 METHOD = "Gaussian - Estimate bg"
@@ -71,6 +71,20 @@ NM_OR_PIXELS = "nm"
 FRAME_BEGIN = "Leave empty for start"  # number or "Leave empty for start"
 FRAME_END = 300  # number or "Leave empty for end"
 CORR_INT = 500  # "Never" or integer
+WARM_START = False  # True or False, Gaussian only. Saves few iterations, see WARM_START_ITERATIONS in tt.py
+WARM_START_TOLERANCE = 0.5  # pixels
+REUSE_TOLERANCE = None  # None or fraction of peak-to-peak value, Gaussian only
+PRESCREEN_THRESHOLD = None  # None or minimum peak-to-noise ratio to fit a frame, Gaussian only
+SINGLE_PRECISION = False  # True or False, float32 results
+PHASOR_FFT = False  # True or False, full FFT with pyFFTW instead of only the used coefficients, Phasor only
+FRAME_MAJOR = False  # True or False, stream frames and fit all ROIs of a frame together, Phasor only
+LIVE = False  # True or False, fit while the ND2 is still being acquired, Phasor only
+LIVE_SOURCE = None  # None for the ND2 itself or a directory that .npy frames are written to
+LIVE_POLL_INTERVAL = 0.1  # seconds between checks for new frames
+LIVE_IDLE_TIMEOUT = 10  # seconds without new frames after which acquisition is done
+FIXED_SIGMA_FIT_BG = True  # True or False, fit background or subtract estimate, Gaussian - Fixed sigma only
+PIXEL_INTEGRATED = False  # True or False, Gaussian integrated over pixels, Gaussian methods only
+PRECISION_CONVERGENCE = None  # None or [position step (px), intensity step (%)] to stop at, Gaussian only
 
 # %% Proceed question
 
@@ -174,8 +188,8 @@ class ProgressUpdater:
         :return: Calls update when need be
         """
         self.progress += 1
-        # If Phasor, update every ten
-        if "Phasor" in self.method and \
+        # If Phasor or radial symmetry, update every ten
+        if ("Phasor" in self.method or self.method == "Radial symmetry") and \
                 self.progress % round(self.total * self.dataset_parts / 10, 0) == 0 and \
                 self.total * self.dataset_parts > 9:
             self.update(False, False, False)
@@ -342,7 +356,13 @@ if __name__ == '__main__':
     # finalize TT dataset
     settings_runtime = {'method': METHOD, 'rejection': REJECTION, '#cores': 1, "pixels_or_nm": NM_OR_PIXELS,
                         'roi_size': ROI_SIZE, 'name': '1nMimager_newGNRs_100mW_TT', "correlation_interval": CORR_INT,
-                        'frame_begin': FRAME_BEGIN, 'frame_end': FRAME_END}
+                        'frame_begin': FRAME_BEGIN, 'frame_end': FRAME_END, 'warm_start': WARM_START,
+                        'warm_start_tolerance': WARM_START_TOLERANCE, 'reuse_tolerance': REUSE_TOLERANCE,
+                        'prescreen_threshold': PRESCREEN_THRESHOLD, 'single_precision': SINGLE_PRECISION,
+                        'phasor_fft': PHASOR_FFT, 'frame_major': FRAME_MAJOR, 'live': LIVE,
+                        'live_source': LIVE_SOURCE, 'live_poll_interval': LIVE_POLL_INTERVAL,
+                        'live_idle_timeout': LIVE_IDLE_TIMEOUT, 'fixed_sigma_fit_bg': FIXED_SIGMA_FIT_BG,
+                        'pixel_integrated': PIXEL_INTEGRATED, 'precision_convergence': PRECISION_CONVERGENCE}
     if experiment.add_to_queue(settings_runtime) is False:
         sys.exit("Did not pass check")
 
@@ -357,11 +377,17 @@ if __name__ == '__main__':
 
     # finalize HSM dataset
     #settings_runtime_hsm = {'correction_file': CORRECTION, 'wavelengths': '[510:10:740]',
-    #                        'name': '1nMimager_newGNRs_100mW_HSM'}
+    #                        'name': '1nMimager_newGNRs_100mW_HSM', '#cores': 1, 'preview': False}
 
     #if experiment.add_to_queue(settings_runtime_hsm) is False:
     #    sys.exit("Did not pass check")
 
+    # %% Add HSM series, same settings as HSM. First stack is reference
+    #experiment.init_new_hsm_series([hsm_name, hsm_name])
+    #experiment.find_rois_dataset(settings_correlation_hsm)
+    #if experiment.add_to_queue(settings_runtime_hsm) is False:
+    #    sys.exit("Did not pass check")
+
     # finalize experiment by adding to experiment list and run
     experiments.append(experiment)
     run(experiments, progress_updater)
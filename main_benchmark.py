@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2020
+
+----------------------------
+
+@author: Dion Engels
+PLASMON Data Analysis
+
+main_benchmark
+
+Runs the TT fitters on synthetic data and writes the outcome to a JSON file. No ND2 needed.
+
+----------------------------
+
+v0.1: single precision accuracy report
+v0.2: throughput and precision suite of all methods
+
+ """
+# GENERAL IMPORTS
+import json
+from datetime import datetime  # current time
+
+# Numpy, for versions in output
+import numpy as np
+
+# Own code
+from src.benchmark import precision_report, run_suite
+
+__self_made__ = True
+
+# %% Inputs
+
+OUTPUT = "benchmark_{}.json".format(datetime.now().strftime("%Y%m%d_%H%M%S"))
+ROI_SIZE = 7  # 7 or 9
+N_FRAMES = 200
+PHOTONS = 2000
+BACKGROUND = 100
+SUITE = True  # True or False, run all scenarios for all methods
+PRECISION = True  # True or False, compare single to double precision
+
+# %% Main
+if __name__ == '__main__':
+    benchmark = {'date': datetime.now().isoformat(), 'numpy': np.__version__}
+    if SUITE:
+        benchmark['suite'] = run_suite(n_frames=N_FRAMES)
+    if PRECISION:
+        benchmark['precision'] = precision_report(roi_size=ROI_SIZE, n_frames=N_FRAMES, photons=PHOTONS,
+                                                  background=BACKGROUND)
+
+    with open(OUTPUT, 'w') as f:
+        json.dump(benchmark, f, indent=4)
+    print("Benchmark written to {}".format(OUTPUT))
@@ -18,12 +18,14 @@ v1.3: HSM to eV: 24/09/2020
 v1.4: HSM output back to nm, while fitting in eV: 29/09/2020
 v2.0 pre-1: First version of GUI v2.0: 15/10/2020
 v2.0: GUI v2.0 ready for release: 30/10/2020
+v2.1: HSM series, live TT
+v2.2: stop button for live TT
 """
 
 __self_made__ = True
 
 # GENERAL IMPORTS
-from os import getcwd, environ, listdir, rmdir, mkdir, path  # to get standard usage
+from os import getcwd, environ, rmdir, mkdir, path  # to get standard usage
 from tempfile import mkdtemp
 import sys
 import time  # for timekeeping
@@ -44,13 +46,14 @@ from matplotlib.figure import Figure
 # GUI
 import tkinter as tk  # for GUI
 from tkinter import ttk  # GUI styling
-from tkinter.filedialog import askopenfilename  # for popup that asks to select .nd2's or folders
+from tkinter.filedialog import askopenfilename, askopenfilenames  # for popup that asks to select .nd2's or folders
 
 # Own code
 from main import ProgressUpdater, logging_setup
 from src.class_experiment import Experiment
 import src.figure_making as figuring
 from src.nd2_reading import ND2ReaderSelf
+from src.spectral_corrections import correction_options
 from setup import __version__
 
 # Multiprocessing
@@ -115,8 +118,8 @@ GUI_HEIGHT_START = int((SCREEN_HEIGHT - GUI_HEIGHT) / 2)
 
 # %% Options for dropdown menus
 
-fit_options = ["Gaussian - Fit bg", "Gaussian - Estimate bg",
-               "Phasor + Intensity", "Phasor + Sum", "Phasor"]
+fit_options = ["Gaussian - Fit bg", "Gaussian - Estimate bg", "Gaussian - Fixed sigma",
+               "Phasor + Intensity", "Phasor + Sum", "Phasor", "Radial symmetry"]
 roi_size_options = ["7x7", "9x9"]
 dimension_options = ["nm", "pixels"]
 
@@ -722,10 +725,16 @@ TOOLTIP_TT_ROI_SIZE = "The ROI size you want to use. 7x7 works usually, and is f
                       "Larger ROI size is slower, but might work better if you expected large PSFs."
 TOOLTIP_TT_FIRST_FRAME = "First frame to fit for the TT.\nYou can use this to crop the video."
 TOOLTIP_TT_LAST_FRAME = "Last frame to fit for the TT.\nYou can use this to crop the video."
+TOOLTIP_TT_LIVE = "Fit while the TT is still being acquired. Follows the growing nd2\n" \
+                  "up to the last frame set, until no new frames arrive for a while,\n" \
+                  "or until 'Stop live' on the main page. Only with one of the Phasor methods."
 TOOLTIP_HSM_MAIN = "All the settings related to HSM analysis."
 TOOLTIP_HSM_CORRECTION_FILE = "The correction file to use for HSM."
 TOOLTIP_HSM_WAVELENGTHS = "The wavelengths that were used to created the HSM.\n" \
                           "Use MATLAB-like notation as shown in the placeholder"
+TOOLTIP_HSM_CORES = "The number of cores used for fitting the ROIs. More is faster for many ROIs."
+TOOLTIP_HSM_PREVIEW = "Quick look. Intensities are background corrected sums instead of Gaussian fits.\n" \
+                      "Finishes in seconds, to decide whether a full run is worth it."
 
 
 class ToolTip:
@@ -965,6 +974,9 @@ class MainPage(BasePage):
         self.listbox_queued.configure(justify="center")
         self.listbox_queued.bindtags((self.listbox_queued, self, "all"))
 
+        self.button_stop_live = NormalButton(self, text="Stop live", state='disabled',
+                                             row=9, column=32, columnspan=8, sticky='EW', padx=PAD_SMALL)
+
         self.button_run = NormalButton(self, text="Run", command=lambda: self.run(),
                                        row=9, column=40, columnspan=8, sticky='EW', padx=PAD_SMALL)
 
@@ -1048,6 +1060,15 @@ class MainPage(BasePage):
         """
         self.listbox_loaded.selection_clear(0, "end")
 
+    def stop_live(self):
+        """
+        Stops the live TT that is running. Its results so far are kept
+        """
+        for experiment in self.controller.experiments:
+            for dataset in experiment.datasets:
+                if dataset.type == "TT":
+                    dataset.stop_live()
+
     def run_thread(self):
         """
         The function that is run within the thread when run is called
@@ -1081,6 +1102,8 @@ class MainPage(BasePage):
         self.button_new_dataset.updater(state='disabled')
         self.button_loaded_delete.updater(state='disabled')
         self.button_loaded_deselect.updater(state='disabled')
+        # only button that works during a run
+        self.button_stop_live.updater(command=lambda: self.stop_live(), state='enabled')
 
     def close_down(self):
         """
@@ -1091,6 +1114,7 @@ class MainPage(BasePage):
         self.button_new_dataset.updater(state='enabled')
         self.button_loaded_delete.updater(state='enabled', command=lambda: self.delete_experiment())
         self.button_loaded_deselect.updater(state='enabled', command=lambda: self.deselect_experiment())
+        self.button_stop_live.updater(state='disabled')
 
         self.controller.experiments = []
         self.update_page()
@@ -1119,7 +1143,7 @@ class MainPage(BasePage):
 
 class LoadPage(BasePage):
     """
-    Loading page. On this page, there are only two big buttons to select which type of dataset you want to load
+    Loading page. On this page, there are only three big buttons to select which type of dataset you want to load
     """
     def __init__(self, container, controller):
         super().__init__(container, controller)
@@ -1134,27 +1158,41 @@ class LoadPage(BasePage):
                             command=lambda: self.load_nd2("HSM"))
         button2.grid(row=10, column=25, columnspan=1, rowspan=1, padx=PAD_SMALL)
 
+        button3 = BigButton(self, text="HSM series", height=int(GUI_HEIGHT / 6),
+                            width=int(GUI_WIDTH / 8),
+                            command=lambda: self.load_nd2("HSM series"))
+        button3.grid(row=10, column=26, columnspan=1, rowspan=1, padx=PAD_SMALL)
+
         self.label_wait = NormalLabel(self, text="HSM frames are being merged. Progress 0%", row=11, column=24,
-                                      columnspan=2, font=FONT_LABEL, padx=PAD_SMALL, sticky='EW')
+                                      columnspan=3, font=FONT_LABEL, padx=PAD_SMALL, sticky='EW')
         self.label_wait.grid_remove()
 
     def load_nd2(self, dataset_type):
         """
-        Function to load an nd2
+        Function to load an nd2, or several for a HSM series
         :param dataset_type: Type is given by which button you click
         """
-        filename = askopenfilename(filetypes=FILETYPES,
-                                   title="Select nd2",
-                                   initialdir=self.controller.dir_open)
+        if dataset_type == "HSM series":
+            # all stacks of the series, the first one is the reference
+            filename = list(askopenfilenames(filetypes=FILETYPES, title="Select nd2s of series, first is reference",
+                                             initialdir=self.controller.dir_open))
+            if len(filename) == 1:
+                tk.messagebox.showerror("Input error", "A HSM series needs at least two nd2s")
+                return
+        else:
+            filename = askopenfilename(filetypes=FILETYPES,
+                                       title="Select nd2",
+                                       initialdir=self.controller.dir_open)
 
         if len(filename) == 0:
             return
+        first_filename = filename[0] if dataset_type == "HSM series" else filename
 
         # save directory
-        self.controller.dir_open = '/'.join(filename[:-4].split("/")[:-1])
+        self.controller.dir_open = '/'.join(first_filename[:-4].split("/")[:-1])
 
-        if dataset_type == "HSM":
-            if self.bad_hsm_size(filename):
+        if "HSM" in dataset_type:
+            if self.bad_hsm_size(first_filename):
                 return
             # if datatype is HSM, show wait label
             self.label_wait.grid()
@@ -1173,12 +1211,16 @@ class LoadPage(BasePage):
             if dataset_type == "TT":
                 experiment_to_link.init_new_tt(filename)
                 self.controller.show_page(TTPage, experiment=experiment_to_link)
+            elif dataset_type == "HSM series":
+                # HSM series has the same settings as a HSM
+                if experiment_to_link.init_new_hsm_series(filename, label=self.label_wait) is not False:
+                    self.controller.show_page(HSMPage, experiment=experiment_to_link)
             else:
                 experiment_to_link.init_new_hsm(filename, label=self.label_wait)
                 self.controller.show_page(HSMPage, experiment=experiment_to_link)
 
         # remove wait label
-        if dataset_type == "HSM":
+        if "HSM" in dataset_type:
             self.label_wait.grid_remove()
             self.label_wait.updater(text="HSM frames are being merged. Progress 0%")
 
@@ -1945,6 +1987,13 @@ class TTPage(AnalysisPageTemplate):
         self.entry_end_frame = EntryPlaceholder(self, "Leave empty for end")
         self.entry_end_frame.grid(row=19, column=24, rowspan=1, columnspan=8, padx=PAD_SMALL)
 
+        label_live = tk.Label(self, text="Live", font=FONT_LABEL, bg='white')
+        label_live.grid(row=18, column=32, rowspan=1, columnspan=8, sticky='EW', padx=PAD_BIG)
+        create_tooltip(label_live, TOOLTIP_TT_LIVE)
+        self.variable_live = tk.BooleanVar(self, value=False)
+        check_live = ttk.Checkbutton(self, variable=self.variable_live, onvalue=True, offvalue=False)
+        check_live.grid(row=19, column=32, rowspan=1, columnspan=8, padx=PAD_SMALL)
+
     def add_to_queue(self):
         """
         Add to queue specific for TT analysis
@@ -1960,6 +2009,7 @@ class TTPage(AnalysisPageTemplate):
         frame_end = self.entry_end_frame.get()
         roi_size = int(self.variable_roi_size.get()[0])
         corr_int = self.entry_correlation_interval.get()
+        live = self.variable_live.get()
 
         # check validity inputs
         if self.check_invalid_input(frame_begin, True) or self.check_invalid_input(frame_end, False):
@@ -1969,7 +2019,8 @@ class TTPage(AnalysisPageTemplate):
         # make settings dict and set to input
         settings_runtime = {'method': method, 'rejection': rejection_type, '#cores': n_processes,
                             'roi_size': roi_size, "pixels_or_nm": dimension, 'name': name,
-                            'frame_begin': frame_begin, 'frame_end': frame_end, 'correlation_interval': corr_int}
+                            'frame_begin': frame_begin, 'frame_end': frame_end, 'correlation_interval': corr_int,
+                            'live': live}
 
         if self.experiment.add_to_queue(settings_runtime) is False:
             return
@@ -1995,6 +2046,7 @@ class TTPage(AnalysisPageTemplate):
         self.entry_begin_frame.updater()
         self.entry_end_frame.updater()
         self.entry_correlation_interval.updater()
+        self.variable_live.set(False)
 
         self.button_add_to_queue.updater(state='disabled')
 
@@ -2021,13 +2073,27 @@ class HSMPage(AnalysisPageTemplate):
         label_hsm_correct = tk.Label(self, text="Correction file:", font=FONT_LABEL, bg='white', anchor='e')
         label_hsm_correct.grid(row=15, column=0, columnspan=8, rowspan=2, sticky='EW', padx=PAD_SMALL)
         create_tooltip(label_hsm_correct, TOOLTIP_HSM_CORRECTION_FILE)
-        path_hsm_correct = getcwd() + "/spectral_corrections"
-        hsm_correct_options = listdir(path_hsm_correct)
-        hsm_correct_options = [option[:-4] for option in hsm_correct_options]  # remove .mat in name
+        hsm_correct_options = correction_options()
         self.variable_hsm_correct = tk.StringVar(self)
         drop_hsm_correct = ttk.OptionMenu(self, self.variable_hsm_correct, [], *hsm_correct_options)
         drop_hsm_correct.grid(row=15, column=8, columnspan=24, rowspan=2, sticky="ew")
 
+        label_cores = tk.Label(self, text="#cores", font=FONT_LABEL, bg='white')
+        label_cores.grid(row=15, column=32, columnspan=8, sticky='EW', padx=PAD_BIG)
+        create_tooltip(label_cores, TOOLTIP_HSM_CORES)
+        total_cores = mp.cpu_count()
+        cores_options = [1, int(total_cores / 2), int(total_cores * 3 / 4), int(total_cores)]
+        self.variable_cores = tk.IntVar(self)
+        drop_cores = ttk.OptionMenu(self, self.variable_cores, cores_options[0], *cores_options)
+        drop_cores.grid(row=16, column=32, columnspan=8, sticky='EW', padx=PAD_BIG)
+
+        label_preview = tk.Label(self, text="Preview", font=FONT_LABEL, bg='white')
+        label_preview.grid(row=15, column=40, columnspan=8, sticky='EW', padx=PAD_SMALL)
+        create_tooltip(label_preview, TOOLTIP_HSM_PREVIEW)
+        self.variable_preview = tk.BooleanVar(self, value=False)
+        check_preview = ttk.Checkbutton(self, variable=self.variable_preview, onvalue=True, offvalue=False)
+        check_preview.grid(row=16, column=40, columnspan=8, padx=PAD_SMALL)
+
         label_hsm_wavelength = tk.Label(self, text="Wavelengths:", font=FONT_LABEL, bg='white', anchor='e')
         label_hsm_wavelength.grid(row=18, column=0, columnspan=8, rowspan=2, sticky='EW', padx=PAD_SMALL)
         create_tooltip(label_hsm_wavelength, TOOLTIP_HSM_WAVELENGTHS)
@@ -2047,6 +2113,8 @@ class HSMPage(AnalysisPageTemplate):
 
         self.variable_hsm_correct.set("")
         self.entry_wavelength.updater()
+        self.variable_cores.set(1)
+        self.variable_preview.set(False)
 
         self.button_add_to_queue.updater(state='disabled')
 
@@ -2057,6 +2125,8 @@ class HSMPage(AnalysisPageTemplate):
         # get input values
         hsm_correction = self.variable_hsm_correct.get()
         wavelengths = self.entry_wavelength.get()
+        n_processes = self.variable_cores.get()
+        preview = self.variable_preview.get()
         name = self.entry_name.get()
 
         # check input values
@@ -2068,7 +2138,8 @@ class HSMPage(AnalysisPageTemplate):
             return
 
         # make settings dictionary and add to queue
-        settings_runtime_hsm = {'correction_file': hsm_correction, 'wavelengths': wavelengths, 'name': name}
+        settings_runtime_hsm = {'correction_file': hsm_correction, 'wavelengths': wavelengths, 'name': name,
+                                '#cores': n_processes, 'preview': preview}
         if self.experiment.add_to_queue(settings_runtime_hsm) is False:
             return
 
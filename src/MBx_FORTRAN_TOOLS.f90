@@ -3,6 +3,8 @@ C FILE: MBX_FORTRAN_TEST.F90
 	  implicit none
 C
 C     Calc background
+C     Takes the first and last column, their inner pixels twice. The first and last row are
+C     not used. Kept as is, changing it changes the background of all existing results
 C
       REAL*8 arr(9*2+(9-2)*2)											! arr = temporary array
 	  REAL*8 ret														! ret = return
@@ -24,6 +26,8 @@ Cf2py depend(d) ret
 	  implicit none
 C
 C     Calc background
+C     Takes the first and last column, their inner pixels twice. The first and last row are
+C     not used. Kept as is, changing it changes the background of all existing results
 C
       REAL*8 arr(7*2+(7-2)*2)											! arr = temporary array
 	  REAL*8 ret														! ret = return
@@ -233,4 +237,87 @@ Cf2py depend(d) x_re, y_re, y_im, x_im
 	  
       END
 	  	  
+	  SUBROUTINE CALC_BG_STACK(ret, d, s, n)
+	  implicit none
+C
+C     Calc background of each frame of a stack
+C     Same pixels as CALC_BG7/9, so also the first and last column twice and no first and last row
+C
+      INTEGER s, n, i
+	  REAL*8 d(s,s,n)													! d = data = pixel values, frame is last
+	  REAL*8 ret(n)														! ret = return, one per frame
+Cf2py intent(in) d
+Cf2py integer intent(hide),depend(d) :: s=shape(d,0)
+Cf2py integer intent(hide),depend(d) :: n=shape(d,2)
+Cf2py intent(out) ret
+Cf2py depend(n) ret
+	  
+	  do i = 1, n
+	  ret(i) = sum(d(1,:,i)) + sum(d(s,:,i))								! same pixels as CALC_BG7/9
+	  ret(i) = ret(i) + sum(d(1,2:s-1,i)) + sum(d(s,2:s-1,i))			! d is transposed stack
+	  ret(i) = ret(i)/(4*s-4)												! calculate mean
+	  enddo
+	  
+      END
+	  
+	  SUBROUTINE MAX_STACK(ret, d, s, n)
+	  implicit none
+C
+C     Maximum of each frame of a stack
+C
+      INTEGER s, n, i
+	  REAL*8 d(s,s,n)													! d = data = pixel values, frame is last
+	  REAL*8 ret(n)														! ret = return, one per frame
+Cf2py intent(in) d
+Cf2py integer intent(hide),depend(d) :: s=shape(d,0)
+Cf2py integer intent(hide),depend(d) :: n=shape(d,2)
+Cf2py intent(out) ret
+Cf2py depend(n) ret
+	  
+	  do i = 1, n
+	  ret(i) = maxval(d(:,:,i))
+	  enddo
+	  
+      END
+	  
+	  SUBROUTINE MIN_STACK(ret, d, s, n)
+	  implicit none
+C
+C     Minimum of each frame of a stack
+C
+      INTEGER s, n, i
+	  REAL*8 d(s,s,n)													! d = data = pixel values, frame is last
+	  REAL*8 ret(n)														! ret = return, one per frame
+Cf2py intent(in) d
+Cf2py integer intent(hide),depend(d) :: s=shape(d,0)
+Cf2py integer intent(hide),depend(d) :: n=shape(d,2)
+Cf2py intent(out) ret
+Cf2py depend(n) ret
+	  
+	  do i = 1, n
+	  ret(i) = minval(d(:,:,i))
+	  enddo
+	  
+      END
+	  
+	  SUBROUTINE SUM_STACK(ret, d, s, n)
+	  implicit none
+C
+C     Sum of each frame of a stack
+C
+      INTEGER s, n, i
+	  REAL*8 d(s,s,n)													! d = data = pixel values, frame is last
+	  REAL*8 ret(n)														! ret = return, one per frame
+Cf2py intent(in) d
+Cf2py integer intent(hide),depend(d) :: s=shape(d,0)
+Cf2py integer intent(hide),depend(d) :: n=shape(d,2)
+Cf2py intent(out) ret
+Cf2py depend(n) ret
+	  
+	  do i = 1, n
+	  ret(i) = sum(d(:,:,i))
+	  enddo
+	  
+      END
+	  	  
 C END FILE MBX_FORTRAN_TEST.F90
\ No newline at end of file
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon 19-10-2020
+
+@author: Dion Engels
+PLASMON Data Analysis
+
+benchmark
+
+Synthetic datasets with a known ground truth, used to check the accuracy and speed of the TT fitters without an ND2
+
+----------------------------
+
+v0.1: single precision accuracy report
+v0.2: throughput and precision suite for all methods
+v0.3: Gaussian - Fixed sigma
+v0.4: Radial symmetry
+
+"""
+import queue
+from time import perf_counter
+
+import numpy as np
+from scipy.special import erf
+
+from src.class_dataset_and_class_roi import Roi
+from src.tt import Gaussian, GaussianBackground, GaussianFixedSigma, Phasor, PhasorDumb, PhasorSum, RadialSymmetry, \
+    calibrate_sigmas, BATCHED_MAX_ITS, SIGMA_N_FRAMES
+
+__self_made__ = True
+
+# %% Settings
+
+BENCHMARK_MAX_ITS = 400  # fixed iteration limit, no calibration on synthetic data
+METHODS = ["Gaussian - Fit bg", "Gaussian - Estimate bg", "Gaussian - Fixed sigma", "Phasor + Intensity",
+           "Phasor + Sum", "Phasor", "Radial symmetry"]
+# suite varies one setting at a time from the base scenario
+BASE_SCENARIO = {'roi_size': 7, 'photons': 2000, 'background': 100, 'spacing': 15, 'duty_cycle': 1.0}
+SCENARIO_VARIATIONS = {'roi_size': [9], 'photons': [500, 10000], 'background': [20, 500], 'spacing': [9, 30],
+                       'duty_cycle': [0.2, 0.5]}
+NFEV_PERCENTILES = [5, 25, 50, 75, 95, 100]
+
+# %% Synthetic data
+
+
+class SyntheticPart:
+    """
+    Stand-in for a TTPart, holds the information the fitters need about the fitted part
+    """
+    def __init__(self, n_frames):
+        """
+        Initialisation of synthetic part. Always starts at frame zero without offset.
+        ----------------------------
+        :param n_frames: number of frames in the part
+        """
+        self.slice = slice(0, n_frames)
+        self.frame_start = 0
+        self.offset_from_base = np.asarray([0, 0])
+
+
+def pixel_profile(n_pixels, mu, sigma):
+    """
+    Fraction of a 1D Gaussian falling in each pixel. Pixel i covers i to i + 1.
+    ----------------------------
+    :param n_pixels: number of pixels
+    :param mu: center of Gaussian in pixel-edge coordinates
+    :param sigma: width of Gaussian in pixels
+    :return: fraction per pixel
+    """
+    edges = erf((np.arange(n_pixels + 1) - mu) / (np.sqrt(2) * sigma))
+    return np.diff(edges) / 2
+
+
+def make_dataset(n_frames=200, roi_size=7, photons=2000, background=100, spacing=15, n_side=6, duty_cycle=1.0,
+                 sigma=1.2, seed=0):
+    """
+    Makes a synthetic TT dataset with emitters on a grid, pixel-integrated Gaussian PSFs and Poisson noise
+    ----------------------------
+    :param n_frames: number of frames
+    :param roi_size: ROI size, sets the margin around the grid
+    :param photons: total number of photons per emitter per frame
+    :param background: background photons per pixel
+    :param spacing: distance between emitters in pixels, sets emitter density
+    :param n_side: emitters per side of the grid
+    :param duty_cycle: fraction of frames an emitter is on
+    :param sigma: width of the PSF in pixels
+    :param seed: seed of random generator
+    :return: frames: uint16 stack of frames
+    :return: rois: ROIs around each emitter
+    :return: truth: true positions in pixel-edge coordinates, same as the fitters
+    :return: on: boolean array of which emitter is on in which frame
+    """
+    rng = np.random.default_rng(seed)
+    margin = roi_size
+    frame_size = 2 * margin + (n_side - 1) * spacing + 1
+
+    # emitters somewhere in the center pixel of their ROI
+    grid = margin + spacing * np.arange(n_side)
+    truth = np.stack(np.meshgrid(grid, grid, indexing='ij'), axis=-1).reshape(-1, 2).astype(float)
+    truth += rng.uniform(0.2, 0.8, truth.shape)
+    on = rng.random((n_frames, truth.shape[0])) < duty_cycle
+
+    expected = np.full((n_frames, frame_size, frame_size), float(background))
+    for emitter, (y, x) in enumerate(truth):
+        psf = np.outer(pixel_profile(frame_size, y, sigma), pixel_profile(frame_size, x, sigma))
+        expected += photons * on[:, emitter, None, None] * psf
+    frames = np.minimum(rng.poisson(expected), np.iinfo(np.uint16).max).astype(np.uint16)
+
+    rois = []
+    for index, (y, x) in enumerate(np.floor(truth).astype(int)):
+        roi = Roi(x, y)
+        roi.set_index(index)
+        rois.append(roi)
+
+    return frames, rois, truth, on
+
+# %% Fitting
+
+
+def create_fitter(method, roi_size, frames=None, rois=None, **settings):
+    """
+    Creates a fitter the same way TimeTrace.prepare_run does, without calibration of the maximum iterations
+    ----------------------------
+    :param method: fitting method
+    :param roi_size: ROI size
+    :param frames: frames, first frames are used to calibrate sigma for Gaussian - Fixed sigma
+    :param rois: ROIs, to calibrate sigma for Gaussian - Fixed sigma
+    :param settings: any other fitter settings, such as single_precision
+    :return: fitter
+    """
+    settings = {'roi_size': roi_size, 'method': method, 'rejection': settings.pop('rejection', True), **settings}
+    roi_offset = np.asarray([0, 0])
+    if method == "Phasor + Intensity":
+        return Phasor(settings, roi_offset)
+    elif method == "Phasor":
+        return PhasorDumb(settings, roi_offset)
+    elif method == "Radial symmetry":
+        return RadialSymmetry(settings, roi_offset)
+    elif method == "Gaussian - Fit bg":
+        return GaussianBackground(settings, BENCHMARK_MAX_ITS, 6, roi_offset)
+    elif method == "Gaussian - Estimate bg":
+        return Gaussian(settings, BENCHMARK_MAX_ITS, 5, roi_offset)
+    elif method == "Gaussian - Fixed sigma":
+        sigmas, _ = calibrate_sigmas(frames[:SIGMA_N_FRAMES], rois, roi_offset, SyntheticPart(SIGMA_N_FRAMES),
+                                     settings)
+        return GaussianFixedSigma(settings, BATCHED_MAX_ITS, sigmas, roi_offset)
+    else:
+        return PhasorSum(settings, roi_offset)
+
+
+def fit_dataset(fitter, frames, rois):
+    """
+    Fits a synthetic dataset through BaseFitter.run
+    ----------------------------
+    :param fitter: fitter to use
+    :param frames: frames to fit
+    :param rois: ROIs to fit
+    :return: res_dict: results per ROI index, same as a single part of a MP run
+    """
+    frame_stacks = [roi.get_frame_stack(frames, fitter.roi_size_1D, [0, 0]) for roi in rois]
+    res_dict = {}
+    fitter.run(frame_stacks, rois, SyntheticPart(frames.shape[0]), q=queue.SimpleQueue(), res_dict=res_dict)
+    return res_dict
+
+
+def localisation_errors(res_dict, rois, truth, on):
+    """
+    Distance between fitted and true position for all fitted frames in which the emitter was on
+    ----------------------------
+    :param res_dict: results of fit_dataset
+    :param rois: fitted ROIs
+    :param truth: true positions
+    :param on: which emitter is on in which frame
+    :return: errors in pixels
+    """
+    errors = []
+    for roi in rois:
+        result = res_dict["{}".format(roi.index)]['result']
+        distance = np.hypot(result[:, 1] - truth[roi.index, 0], result[:, 2] - truth[roi.index, 1])
+        errors.append(distance[on[:, roi.index] & ~np.isnan(distance)])
+    return np.concatenate(errors)
+
+
+def rmse(errors):
+    """
+    Root mean square of errors, NaN when there are no errors
+    ----------------------------
+    :param errors: errors
+    :return: root mean square error
+    """
+    return float(np.sqrt(np.mean(np.square(errors, dtype=np.float64)))) if len(errors) > 0 else float('nan')
+
+# %% Precision report
+
+
+def precision_report(methods=None, roi_size=7, **dataset_settings):
+    """
+    Compares single precision to double precision for each method on the same synthetic dataset
+    ----------------------------
+    :param methods: methods to compare, default all
+    :param roi_size: ROI size
+    :param dataset_settings: settings of make_dataset
+    :return: report: per method the RMSE of both precisions, difference between them, and result size
+    """
+    frames, rois, truth, on = make_dataset(roi_size=roi_size, **dataset_settings)
+    report = {}
+    for method in methods or METHODS:
+        results = {}
+        for single_precision in (False, True):
+            fitter = create_fitter(method, roi_size, frames, rois, single_precision=single_precision)
+            results[single_precision] = fit_dataset(fitter, frames, rois)
+
+        difference = []
+        nan_mismatch = 0
+        result_bytes = {False: 0, True: 0}
+        for roi in rois:
+            double = results[False]["{}".format(roi.index)]['result']
+            single = results[True]["{}".format(roi.index)]['result']
+            result_bytes[False] += double.nbytes
+            result_bytes[True] += single.nbytes
+            nan_mismatch += int(np.count_nonzero(np.isnan(double[:, 1]) != np.isnan(single[:, 1])))
+            both = ~np.isnan(double[:, 1]) & ~np.isnan(single[:, 1])
+            difference.append(np.hypot(double[both, 1] - single[both, 1], double[both, 2] - single[both, 2]))
+        difference = np.concatenate(difference)
+
+        report[method] = {'rmse_float64': rmse(localisation_errors(results[False], rois, truth, on)),
+                          'rmse_float32': rmse(localisation_errors(results[True], rois, truth, on)),
+                          'rms_difference': rmse(difference),
+                          'max_difference': float(difference.max()) if len(difference) > 0 else float('nan'),
+                          'nan_mismatch': nan_mismatch,
+                          'result_bytes_float64': result_bytes[False],
+                          'result_bytes_float32': result_bytes[True]}
+    return report
+
+# %% Throughput suite
+
+
+def scenarios():
+    """
+    All scenarios of the suite, the base scenario followed by one variation at a time
+    ----------------------------
+    :return: list of scenario dicts, settings for make_dataset
+    """
+    all_scenarios = [dict(BASE_SCENARIO)]
+    for key, values in SCENARIO_VARIATIONS.items():
+        for value in values:
+            all_scenarios.append({**BASE_SCENARIO, key: value})
+    return all_scenarios
+
+
+def benchmark_method(method, frames, rois, truth, on, roi_size, **settings):
+    """
+    Times one method on one dataset and describes its results
+    ----------------------------
+    :param method: fitting method
+    :param frames: frames to fit
+    :param rois: ROIs to fit
+    :param truth: true positions
+    :param on: which emitter is on in which frame
+    :param roi_size: ROI size
+    :param settings: any other fitter settings
+    :return: dict with fits/s, ns/pixel, nfev distribution (Gaussian only), rejection rates, RMSE, and counters
+    """
+    fitter = create_fitter(method, roi_size, frames, rois, **settings)
+    start = perf_counter()
+    res_dict = fit_dataset(fitter, frames, rois)
+    elapsed = perf_counter() - start
+
+    results = np.concatenate([res_dict["{}".format(roi.index)]['result'] for roi in rois])
+    on_flat = np.concatenate([on[:, roi.index] for roi in rois])
+    rejected = np.isnan(results[:, 1])
+    n_fits = results.shape[0]
+
+    outcome = {'fits_per_second': n_fits / elapsed,
+               'ns_per_pixel': elapsed * 1e9 / (n_fits * roi_size ** 2),
+               'rejection_rate_on': float(np.mean(rejected[on_flat])) if on_flat.any() else float('nan'),
+               'rejection_rate_off': float(np.mean(rejected[~on_flat])) if (~on_flat).any() else float('nan'),
+               'rmse': rmse(localisation_errors(res_dict, rois, truth, on)),
+               'counters': res_dict.get('counters', {})}
+    if "Gaussian" in method:
+        nfev = results[~rejected, 7]
+        outcome['nfev'] = {'mean': float(nfev.mean()) if len(nfev) > 0 else float('nan'),
+                           'percentiles': dict(zip(NFEV_PERCENTILES,
+                                                   np.percentile(nfev, NFEV_PERCENTILES).tolist()
+                                                   if len(nfev) > 0 else [float('nan')] * len(NFEV_PERCENTILES)))}
+    return outcome
+
+
+def run_suite(methods=None, n_frames=200, seed=0, **settings):
+    """
+    Runs all methods on all scenarios
+    ----------------------------
+    :param methods: methods to run, default all
+    :param n_frames: frames per dataset
+    :param seed: seed of random generator, same data for all methods
+    :param settings: any other fitter settings
+    :return: list with per scenario its settings and per method the outcome of benchmark_method
+    """
+    suite = []
+    for scenario in scenarios():
+        frames, rois, truth, on = make_dataset(n_frames=n_frames, seed=seed, **scenario)
+        outcome = {method: benchmark_method(method, frames, rois, truth, on, scenario['roi_size'], **settings)
+                   for method in methods or METHODS}
+        suite.append({'scenario': {**scenario, 'n_frames': n_frames, 'n_rois': len(rois)}, 'methods': outcome})
+    return suite
@@ -14,6 +14,8 @@ The dataset and ROI class of v2 of program. Dataset is one nd2 file, ROIs are re
 -----------------
 
 v2.0: part of v2.0: 15/10/2020
+v2.1: normxcorr2 in a window, from precomputed spectra
+v2.2: ratio of correlation outside the window to inside, to detect drift larger than the window
 
 """
 # GENERAL IMPORTS
@@ -224,15 +226,17 @@ class Dataset:
         if np.array_equal(frame_new, frame_old):
             offset = np.asarray([0, 0])
         else:
-            corr = normxcorr2(frame_old, frame_new)
             if range is None:
+                corr = normxcorr2(frame_old, frame_new)
                 maxima = np.transpose(np.asarray(np.where(corr == np.amax(corr))))[0]
+                offset = maxima - np.asarray(frame_old.shape) + np.asarray([1, 1])
             else:
-                # cut out center with range. Only check center for maximum value
-                small_corr = corr[frame_old.shape[0] - range:frame_old.shape[0] + range,
-                                  frame_old.shape[1] - range:frame_old.shape[1] + range]
-                maxima = np.transpose(np.asarray(np.where(corr == np.amax(small_corr))))[0]
-            offset = maxima - np.asarray(frame_old.shape) + np.asarray([1, 1])
+                # only shifts up to range are checked, so frames are padded by range instead of doubled
+                shape = correlation_shape(frame_old.shape, range)
+                ones_spectrum = fft.rfft2(np.ones(frame_old.shape), shape)
+                corr = normxcorr2_spectra(correlation_spectra(frame_new, shape), correlation_spectra(frame_old, shape),
+                                          ones_spectrum, shape)
+                offset = correlation_peak(corr, frame_old.shape, range)
 
         return offset
 
@@ -335,3 +339,72 @@ def normxcorr2(b, a):
     b = int(sum(b.flatten().astype(np.int64) ** 2))
     c = c / np.sqrt(a * b)
     return c
+
+
+def correlation_shape(frame_shape, range=None):
+    """
+    Padded shape of normxcorr2 from spectra. Without range 2 * frame shape - 1, all shifts. With range, a fast transform
+    size padded by range, so that shifts up to range do not wrap around and equal those of the full correlation
+    ---------------------------
+    :param frame_shape: shape of frames
+    :param range: maximum possible drift. If None, any shift
+    :return: padded shape of correlation
+    """
+    if range is None:
+        return tuple(2 * size - 1 for size in frame_shape)
+    return tuple(fft.next_fast_len(size + range, real=True) for size in frame_shape)
+
+
+def correlation_spectra(frame, shape):
+    """
+    Spectra of a frame needed to correlate it with normxcorr2_spectra. Computed once per frame and used for both its
+    neighbours: as previous frame for the next one and as new frame for the one before.
+    ---------------------------
+    :param frame: frame to transform
+    :param shape: padded shape of correlation, see correlation_shape
+    :return: spectrum of frame, of frame squared, of flipped frame, and energy of frame
+    """
+    frame_float = frame.astype(np.float64)
+    return (fft.rfft2(frame_float, shape), fft.rfft2(frame_float ** 2, shape),
+            fft.rfft2(frame_float[::-1, ::-1], shape), int(np.sum(frame.astype(np.int64) ** 2)))
+
+
+def normxcorr2_spectra(spectra_old, spectra_new, ones_spectrum, shape):
+    """
+    Same correlation as normxcorr2(frame_new, frame_old), from precomputed spectra. Real FFTs, so the result is real.
+    ---------------------------
+    :param spectra_old: correlation_spectra of previous frame
+    :param spectra_new: correlation_spectra of new frame
+    :param ones_spectrum: spectrum of ones in the shape of a frame
+    :param shape: padded shape of correlation
+    :return: correlation
+    """
+    c = fft.irfft2(spectra_old[0] * spectra_new[2], shape)
+    denominator = np.sqrt(np.maximum(fft.irfft2(spectra_old[1] * ones_spectrum, shape), 0) * spectra_new[3])
+    return np.divide(c, denominator, out=np.zeros_like(c), where=denominator > 0)
+
+
+def correlation_peak(corr, frame_shape, range=None, outside_ratio=False):
+    """
+    Offset at the maximum of normxcorr2_spectra, as maxima - frame shape + 1 of the full correlation. Shift d is at
+    index d + frame shape - 1, modulo the padded shape
+    ---------------------------
+    :param corr: correlation from normxcorr2_spectra
+    :param frame_shape: shape of frames
+    :param range: maximum possible drift. Only offsets up to range are searched
+    :param outside_ratio: if True, also returns ratio. Needs range
+    :return: offset: the offset at the maximum
+    :return: ratio: highest correlation of all indices divided by highest within range. Well above one if the drift is
+    larger than range, noise alone stays close to one
+    """
+    if range is None:
+        maxima = np.transpose(np.asarray(np.where(corr == np.amax(corr))))[0]
+        return maxima - np.asarray(frame_shape) + np.asarray([1, 1])
+
+    window = [(np.arange(-range, range + 1) + size - 1) % padded for size, padded in zip(frame_shape, corr.shape)]
+    small_corr = corr[np.ix_(*window)]
+    maxima = np.transpose(np.asarray(np.where(small_corr == np.amax(small_corr))))[0]
+    offset = maxima - range
+    if outside_ratio:
+        return offset, np.amax(corr) / max(np.amax(small_corr), np.finfo(float).tiny)
+    return offset
@@ -14,6 +14,7 @@ The experiment class of v2 of the program. Holds several datasets.
 -----------------
 
 v2.0: part of v2.0: 15/10/2020
+v2.1: HSM series
 
 """
 # GENERAL IMPORTS
@@ -26,7 +27,7 @@ import time  # for time keeping
 from src.nd2_reading import ND2ReaderSelf
 from src.roi_finding import RoiFinder
 import src.tt as fitting
-from src.hsm import HSMDataset
+from src.hsm import HSMDataset, HSMSeriesDataset
 import src.tools as tools
 import src.figure_making as figuring
 import src.output as outputting
@@ -44,8 +45,8 @@ class Experiment:
         """
         Initialises experiment. Sets some settings and calls first dataset initialization and ROI finder
         ----------------------
-        :param created_by: whether or not first dataset is TT or HSM
-        :param filename: filename of first nd2
+        :param created_by: whether or not first dataset is TT, HSM, or HSM series
+        :param filename: filename of first nd2, list of filenames for HSM series
         :param proceed_question: proceed question function. Changes if GUI is used or not
         :param error_func: Error function. Also changes if GUI is used or not
         :param progress_updater: Progress updater. GUI changes this
@@ -53,7 +54,7 @@ class Experiment:
         :param label: a label that you can add. If added, update percentages will be placed there
         """
         self.created_by = created_by
-        self.directory = filename
+        self.directory = filename if created_by != 'HSM series' else filename[0]
         self.dir_made = False
         self.name = None
         self.datasets = []
@@ -65,6 +66,8 @@ class Experiment:
 
         if created_by == 'HSM':
             self.init_new_hsm(filename, label=label)
+        elif created_by == 'HSM series':
+            self.init_new_hsm_series(filename, label=label)
         elif created_by == 'TT':
             self.init_new_tt(filename)
         self.frame_for_rois = self.datasets[-1].frame_for_rois
@@ -83,6 +86,21 @@ class Experiment:
         hsm_object = HSMDataset(self, nd2, filename, label=label)
         self.datasets.append(hsm_object)
 
+    def init_new_hsm_series(self, filenames, label=None):
+        """
+        Add a new HSM series to experiment. Loads all nd2s, initialises HSM series class, appends to self.datasets
+        -----------------------------------
+        :param filenames: filenames of HSM stacks, first one is reference
+        :param label: a label that you can add. If added, update percentages will be placed there
+        :return: status: False if stacks cannot form a series. Otherwise edits class.
+        """
+        nd2s = [ND2ReaderSelf(filename) for filename in filenames]
+        if any(tuple(nd2.frame_shape) != tuple(nd2s[0].frame_shape) for nd2 in nd2s):
+            self.error_func("Input error", "All HSM stacks of a series need the same frame size")
+            return False
+        hsm_series_object = HSMSeriesDataset(self, nd2s, filenames[0], label=label)
+        self.datasets.append(hsm_series_object)
+
     def init_new_tt(self, filename):
         """
         Add a new TT to experiment. Loads nd2, initialises TT class, appends to self.datasets
@@ -198,6 +216,10 @@ class Experiment:
             if dataset.type == "TT":
                 self.progress_updater.new_dataset(dataset.type, len(dataset.active_rois),
                                                   method=dataset.settings['method'], tt_parts=len(dataset.tt_parts))
+            elif dataset.type == "HSM series":
+                # progress is per stack of each ROI
+                self.progress_updater.new_dataset(dataset.type, len(dataset.active_rois), method="HSM",
+                                                  tt_parts=len(dataset.stacks))
             else:
                 self.progress_updater.new_dataset(dataset.type, len(dataset.active_rois), method="HSM")
             dataset.run()
@@ -16,6 +16,7 @@ v0.1.1: bug fix and save drift: 03/08/2020
 v1.0: more output just after initial release: 07/08/2020
 v1.1: switch to Python coordinate system: 10/08/2020
 v2.0: part of v2.0: 03/10/2020
+v2.1: drift in same precision as results
 
 """
 
@@ -29,14 +30,16 @@ class DriftCorrector:
     """
     Drift correction class of PLASMON. Takes results and corrects them for drift
     """
-    def __init__(self, method):
+    def __init__(self, method, dtype=np.float64):
         """
         Initialisation, does not do much
         ----------------------
         :param method: method used to get results
+        :param dtype: floating point type of results, drift is found in the same type
         """
         self.threshold_sigma = 5
         self.method = method
+        self.dtype = dtype
 
     def main(self, rois, name_dataset, n_frames):
         """
@@ -50,8 +53,8 @@ class DriftCorrector:
         np.warnings.filterwarnings('ignore')  # ignore warnings of "nan" values to a real value
 
         # declare
-        all_drift_x = np.zeros((n_frames, len(rois)))
-        all_drift_y = np.zeros((n_frames, len(rois)))
+        all_drift_x = np.zeros((n_frames, len(rois)), dtype=self.dtype)
+        all_drift_y = np.zeros((n_frames, len(rois)), dtype=self.dtype)
 
         for roi_index, roi in enumerate(rois):
             # get drift for each ROI
@@ -16,6 +16,7 @@ v1.1: individual ROI figures
 v1.2: minor improvement based on Sjoerd's feedback: 27/08/2020
 v1.3: feedback of Peter meeting: 06/09/2020
 v2.0: Figure making for v2.0 of GUI: 15/10/2020
+v2.1: HSM series, resonance of each stack
 
 """
 
@@ -148,6 +149,40 @@ def plot_hsm(ax, result, wavelengths):
         pass
 
 
+def plot_hsm_series(ax, result):
+    """
+    Plotter of a HSM series result, resonance of each stack
+    ----------------------
+    :param ax: ax object to edit
+    :param result: result to plot
+    :return: None. Edits ax object
+    """
+    stacks = list(range(1, len(result['lambda']) + 1))
+    ax.plot(stacks, result['lambda'], 'o-')
+    ax.set_xticks(stacks)
+    ax.set_xlabel('stack')
+    ax.set_ylabel('SPR (nm)')
+
+
+def plot_hsm_dataset(ax, result, dataset, roi):
+    """
+    Plots the result of a HSM or HSM series of a ROI and sets labels and title
+    ----------------------
+    :param ax: ax object to edit
+    :param result: result to plot
+    :param dataset: HSM or HSM series dataset of result
+    :param roi: ROI of result
+    :return: None. Edits ax object
+    """
+    if dataset.type == "HSM series":
+        plot_hsm_series(ax, result)
+    else:
+        plot_hsm(ax, result, dataset.wavelengths)
+        ax.set_xlabel('wavelength (nm)')
+        ax.set_ylabel('intensity (arb. units)')
+    ax.set_title('{} {}\nROI {}'.format(dataset.type, dataset.name, roi.index + 1))
+
+
 def make_tt_scatter(ax, result, event_or_not_boolean, dataset):
     """
     Scatter plot of TT results
@@ -265,7 +300,7 @@ def save_overview(experiment):
         if dataset.type == "TT":
             dataset.figure_range = find_range(dataset.name_result, dataset.active_rois)
             tt.append(n_dataset)
-        elif dataset.type == "HSM":
+        elif dataset.type == "HSM" or dataset.type == "HSM series":
             hsm.append(n_dataset)
 
     per_roi_length = len(tt) + max(len(hsm), 1)
@@ -342,11 +377,8 @@ def save_overview(experiment):
                 try:
                     # then each HSM
                     ax_hsm = fig.add_subplot(gs[row + index_dataset, column + 1])
-                    plot_hsm(ax_hsm, roi.results[experiment.datasets[n_dataset].name_result],
-                             experiment.datasets[n_dataset].wavelengths)
-                    ax_hsm.set_xlabel('wavelength (nm)')
-                    ax_hsm.set_ylabel('intensity (arb. units)')
-                    ax_hsm.set_title('HSM {}\nROI {}'.format(experiment.datasets[n_dataset].name, roi.index + 1))
+                    plot_hsm_dataset(ax_hsm, roi.results[experiment.datasets[n_dataset].name_result],
+                                     experiment.datasets[n_dataset], roi)
                 except:
                     pass  # if this ROI does not have results for that dataset, skip
 
@@ -409,7 +441,7 @@ def individual_figures(experiment):
     for n_dataset, dataset in enumerate(experiment.datasets):
         if dataset.type == "TT":
             tt.append(n_dataset)
-        elif dataset.type == "HSM":
+        elif dataset.type == "HSM" or dataset.type == "HSM series":
             hsm.append(n_dataset)
 
     per_roi_length = len(tt) + max(len(hsm), 1)
@@ -429,11 +461,8 @@ def individual_figures(experiment):
             try:
                 # then each HSM
                 ax_hsm = fig.add_subplot(per_roi_length, 2, 2 + index_dataset * 2)
-                plot_hsm(ax_hsm, roi.results[experiment.datasets[n_dataset].name_result],
-                         experiment.datasets[n_dataset].wavelengths)
-                ax_hsm.set_xlabel('wavelength (nm)')
-                ax_hsm.set_ylabel('intensity (arb. units)')
-                ax_hsm.set_title('HSM {}\nROI {}'.format(experiment.datasets[n_dataset].name, str(roi.index + 1)))
+                plot_hsm_dataset(ax_hsm, roi.results[experiment.datasets[n_dataset].name_result],
+                                 experiment.datasets[n_dataset], roi)
             except:
                 pass  # if this ROI does not have results for that dataset, skip
 
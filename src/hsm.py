@@ -19,100 +19,86 @@ v0.1: working: 13/09/2020
 v0.1.1: in GUI
 v1.0: Working as desired and as in SPectrA: 29/09/2020
 v2.0: Completed for v2 of program: 15/10/2020
+v2.1: background of all frames of a ROI in one FORTRAN call
+v2.2: parallel background removal and correlation in drift correction
+v2.3: drift correction shifts frames in place, no helper frames
+v2.4: frames streamed from nd2, only drift and merged frame kept
+v2.5: Gaussian fits of all ROIs and frames at once, lower bound of sigma HSM_SIGMA_MIN instead of 0
+v2.6: Lorentzian fits of all ROIs at once
+v2.7: spectral corrections from cached library, interpolated
+v2.8: multiple cores for fitting ROIs
+v2.9: drift by normxcorr2 in a window of HSM_DRIFT_RANGE
+v2.10: series of HSM stacks with shared drift, fitted in one batch
+v2.11: preview mode, background corrected sums instead of Gaussian fits
+v2.12: warning when HSM drift is larger than HSM_DRIFT_RANGE
 
 """
 # General
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 import numpy as np
 
-# I/O
-from scipy.io import loadmat
-import mat73
-
 # Scipy for signal processing
 from scipy.ndimage import median_filter
-from scipy.optimize import least_squares
+import scipy.fft as fft
 
 # Own code
 import src.tt as fitting
 import src.figure_making as figuring
-from src.class_dataset_and_class_roi import Dataset, normxcorr2
+from src.class_dataset_and_class_roi import Dataset, correlation_shape, correlation_spectra, normxcorr2_spectra, \
+    correlation_peak
+from src.spectral_corrections import load_correction, correction_shape
 
 import matplotlib.pyplot as plt
+import logging  # for logging warnings
+logger = logging.getLogger('main')
 __self_made__ = True
 
+HSM_DRIFT_WORKERS = os.cpu_count() or 1  # threads for background removal and correlation of HSM frames
+HSM_DRIFT_RANGE = 20  # maximum drift in pixels between two consecutive HSM frames
+HSM_DRIFT_OUTSIDE_RATIO = 2  # correlation outside HSM_DRIFT_RANGE this much higher than inside means larger drift
+# lower bound of sigma, was 0 before v2.5. Zero sigma is a division by zero in the jacobian. Fits that end on the bound
+# are rejected, so sigma up to HSM_SIGMA_MIN is now rejected as well
+HSM_SIGMA_MIN = 1e-2
+HSM_CAUCHY_SCALE = 0.1  # f_scale of Cauchy loss of retry of failed fits
+HSM_IRLS_ITS = 5  # reweighting iterations of Cauchy loss retry
+HSM_LORENTZIAN_MAX_ITS = 400  # same as default of least_squares, 100 per parameter
+HSM_CHUNKS_PER_CORE = 4  # chunks of ROIs per worker process when using multiple cores
+HSM_BATCH = 16384  # fits per batch, bounds memory of the jacobian. Larger than fitting.LM_BATCH, fewer slow tails
+
+# %% Shifting
+
+
+def shifted_slices(shift_dist, size_frame):
+    """
+    Slices to shift a frame by -shift_dist within a frame of the same size. Part shifted out is lost.
+    ----------------------------------------
+    :param shift_dist: shift in pixels, [y, x]
+    :param size_frame: shape of frame
+    :return: target: slices of shifted frame that are covered
+    :return: source: slices of original frame that end up there
+    """
+    target = tuple(slice(min(max(-shift, 0), size), max(min(size - shift, size), 0))
+                   for shift, size in zip(shift_dist, size_frame))
+    source = tuple(slice(min(max(shift, 0), size), max(min(size + shift, size), 0))
+                   for shift, size in zip(shift_dist, size_frame))
+    return target, source
+
 # %% HSM Fitter
 
 
 class HSMFit(fitting.GaussianBackground):
-
+    """
+    Gaussian fitter of HSM. Fits all frames of all ROIs together with a batched Levenberg-Marquardt, with bounds and
+    a Cauchy loss retry for failed fits.
+    """
     def __init__(self, roi_size_1d):
         super().__init__({'roi_size': int(roi_size_1d * 2 + 1), 'rejection': True, 'method': "Gaussian - Fit bg"},
                          1000, 6, [0, 0])
         self.init_sig = 0.8
-
-    def fit_gaussian(self, data):
-        """
-        Gathers parameter estimate and calls fit.
-
-        Parameters
-        ----------
-        data : ROI pixel values
-
-        Returns
-        -------
-        p.x: solution of parameters
-        p.nfev: number of iterations
-        p.success: success or failure
-
-        """
-        def extract_data(p=None):
-            if p is None:
-                return np.ones(5), None, False
-            else:
-                return p.x, p.nfev, p.success
-        # set bounds
-        pos_max, pos_min, int_max, int_min, sig_max, sig_min = self.define_fitter_bounds()
-
-        # set parameters
-        background = self.fun_calc_bg(data)
-        height = data[int(4.5), int(4.5)] - background
-        if height < 0:
-            height = 0
-        params = np.array([height, 4.5, 4.5, self.init_sig, self.init_sig, background])
-
-        # try first fit
-        try:
-            p = least_squares(lambda p: self.fun_gaussian(p, data), params, method='dogbox', max_nfev=self.max_its,
-                              ftol=10e-12, gtol=10e-12, xtol=10e-12,
-                              bounds=([int_min, pos_min, pos_min, sig_min, sig_min, 0],
-                                      [int_max, pos_max, pos_max, sig_max, sig_max, np.inf]))
-            res, its, success = extract_data(p)
-        except Exception as e:
-            # if exception, print and set comparison
-            print(e)
-            print(np.array([height, 4.5, 4.5, self.init_sig, self.init_sig, background]))
-            # extract data
-            res, its, success = extract_data(p=None)
-
-        # if fit is bad, do new fit with Cauchy loss (better at low SNR)
-        if success == 0 or \
-                res[2] < pos_min or res[2] > pos_max or res[1] < pos_min or res[1] > pos_max or \
-                res[0] <= int_min or res[0] > int_max or \
-                res[3] <= sig_min or res[3] >= sig_max or res[4] <= sig_min or res[4] >= sig_max:
-            params = np.array([height, 4.5, 4.5, self.init_sig, self.init_sig, background])
-            try:
-                p = least_squares(lambda p: self.fun_gaussian(p, data), params, method='dogbox', max_nfev=self.max_its,
-                                  ftol=10e-12, gtol=10e-12, xtol=10e-12, loss='cauchy', f_scale=0.1,
-                                  bounds=([int_min, pos_min, pos_min, sig_min, sig_min, 0],
-                                          [int_max, pos_max, pos_max, sig_max, sig_max, np.inf]))
-                # extract data
-                res, its, success = extract_data(p)
-            except Exception as e:
-                # if exception, print
-                print(e)
-                print(np.array([height, 4.5, 4.5, self.init_sig, self.init_sig, background]))
-        return [res, its, success]
+        self.pixels = np.arange(self.roi_size, dtype=np.float64)
 
     def define_fitter_bounds(self):
         """
@@ -132,53 +118,220 @@ class HSMFit(fitting.GaussianBackground):
         pos_min = 0.0
         int_min = 0.0
         int_max = np.inf
-        sig_min = 0.0
+        sig_min = HSM_SIGMA_MIN
         sig_max = 2.0
 
         return pos_max, pos_min, int_max, int_min, sig_max, sig_min
 
-    def fitter(self, frame_stack, shape, energy_width, *_):
+    def model_jacobian(self, weights=None):
         """
-        Does Gaussian fitting for all frames for a single ROI
-        --------------------------------------------------------
-        :param frame_stack: HSM corrected frame stack for one ROI
-        :return: HSM results for a single ROI
+        Model and analytic jacobian of a Gaussian with background, for fitting.levenberg_marquardt_batch
+
+        Parameters
+        ----------
+        weights : optional square root of weight of each pixel of each fit, (fits, pixels)
+
+        Returns
+        -------
+        Function of parameters and rows of fits, returns model (fits, pixels) and jacobian (fits, pixels, params).
+        Parameters in order height, position y, position x, sigma y, sigma x, background.
+
+        """
+        def model_jacobian(params, rows):
+            # separable, so profiles along y and x
+            dist_y = (self.pixels[None, :] - params[:, 1, None]) / params[:, 3, None]
+            dist_x = (self.pixels[None, :] - params[:, 2, None]) / params[:, 4, None]
+            profile_y = np.exp(-dist_y ** 2 / 2)
+            profile_x = np.exp(-dist_x ** 2 / 2)
+            gaussian = profile_y[:, :, None] * profile_x[:, None, :]
+            height_gaussian = params[:, 0, None, None] * gaussian
+
+            jac = np.empty((params.shape[0], self.roi_size, self.roi_size, 6))
+            jac[:, :, :, 0] = gaussian
+            jac[:, :, :, 1] = height_gaussian * (dist_y / params[:, 3, None])[:, :, None]
+            jac[:, :, :, 2] = height_gaussian * (dist_x / params[:, 4, None])[:, None, :]
+            jac[:, :, :, 3] = jac[:, :, :, 1] * dist_y[:, :, None]
+            jac[:, :, :, 4] = jac[:, :, :, 2] * dist_x[:, None, :]
+            jac[:, :, :, 5] = 1
+            model = (height_gaussian + params[:, 5, None, None]).reshape(params.shape[0], -1)
+            jac = jac.reshape(params.shape[0], -1, 6)
+            if weights is not None:
+                return model * weights[rows], jac * weights[rows][:, :, None]
+            return model, jac
+        return model_jacobian
+
+    def fit_batch(self, patches, backgrounds):
         """
-        # predefine
-        raw_intensity = np.zeros(frame_stack.shape[0])
-        intensity = np.zeros(frame_stack.shape[0])
-        raw_fits = np.zeros((frame_stack.shape[0], self.num_fit_params))
+        Fits all patches at once, in batches of HSM_BATCH. Patches that fail are fitted again with a Cauchy loss
+        (better at low SNR), by iteratively reweighted least squares.
 
+        Parameters
+        ----------
+        patches : all patches to fit, (fits, roi size, roi size)
+        backgrounds : background of each patch
+
+        Returns
+        -------
+        result: solution of parameters, NaN if failed
+        nfev: number of function evaluations per fit
+
+        """
         pos_max, pos_min, int_max, int_min, sig_max, sig_min = self.define_fitter_bounds()
+        bounds = (np.array([int_min, pos_min, pos_min, sig_min, sig_min, 0]),
+                  np.array([int_max, pos_max, pos_max, sig_max, sig_max, np.inf]))
+
+        def valid(result, success):
+            return success & np.all((result[:, 1:3] >= pos_min) & (result[:, 1:3] <= pos_max), axis=1) & \
+                (result[:, 0] > int_min) & (result[:, 0] <= int_max) & \
+                np.all((result[:, 3:5] > sig_min) & (result[:, 3:5] < sig_max), axis=1)
+
+        def fit(params, data, weights=None):
+            # in batches, bounds memory of the jacobian
+            result = np.empty(params.shape)
+            nfev = np.empty(params.shape[0], dtype=int)
+            success = np.empty(params.shape[0], dtype=bool)
+            for start in range(0, params.shape[0], HSM_BATCH):
+                batch = slice(start, start + HSM_BATCH)
+                result[batch], nfev[batch], success[batch] = \
+                    fitting.levenberg_marquardt_batch(self.model_jacobian(None if weights is None else weights[batch]),
+                                                      params[batch], data[batch], self.max_its, bounds=bounds)
+            return result, nfev, success
 
-        # fit per frame
-        for frame_index, my_roi in enumerate(frame_stack):  
-            # fit
-            result, _, success = self.fit_gaussian(my_roi)
-            # save fittings if success
-            if success == 0 or \
-                    result[2] < pos_min or result[2] > pos_max or result[1] < pos_min or result[1] > pos_max or \
-                    result[0] <= int_min or result[0] > int_max or \
-                    result[3] <= sig_min or result[3] >= sig_max or result[4] <= sig_min or result[4] >= sig_max:
-                raw_intensity[frame_index] = np.nan
-                intensity[frame_index] = np.nan
-                raw_fits[frame_index, :] = np.nan
-            else:
-                raw_intensity[frame_index] = 2 * np.pi * result[0] * result[3] * result[4]
-                # for intensity, divide by shape correction and energy_width normalization
-                intensity[frame_index] = raw_intensity[frame_index] / shape[frame_index] / energy_width[frame_index]
-                raw_fits[frame_index, :] = result
-
-        # reject very high sigma fits (50% above average)
-        intensity[(raw_fits[:, 3] > np.nanmean(raw_fits[:, 3]) * 1.5) |
-                  (raw_fits[:, 4] > np.nanmean(raw_fits[:, 4]) * 1.5)] = np.nan
-        raw_intensity[(raw_fits[:, 3] > np.nanmean(raw_fits[:, 3]) * 1.5) |
-                      (raw_fits[:, 4] > np.nanmean(raw_fits[:, 4]) * 1.5)] = np.nan
-        raw_fits[(raw_fits[:, 3] > np.nanmean(raw_fits[:, 3]) * 1.5) |
-                 (raw_fits[:, 4] > np.nanmean(raw_fits[:, 4]) * 1.5), :] = np.nan
+        # set parameters
+        data = patches.reshape(patches.shape[0], -1).astype(np.float64)
+        height = np.maximum(patches[:, int(4.5), int(4.5)] - backgrounds, 0)
+        params = np.zeros((patches.shape[0], 6))
+        params[:, 0] = height
+        params[:, 1:3] = 4.5
+        params[:, 3:5] = self.init_sig
+        params[:, 5] = backgrounds
+
+        # first fit
+        result, nfev, success = fit(params, data)
+        fit_valid = valid(result, success)
+
+        # if fit is bad, do new fit with Cauchy loss from the same start. Only for bad fits
+        retry = np.flatnonzero(~fit_valid)
+        if retry.size > 0:
+            result[retry] = params[retry]
+            retry_success = np.zeros(patches.shape[0], dtype=bool)
+            for _ in range(HSM_IRLS_ITS):
+                # weights of cauchy loss from residuals of previous iteration
+                model, _ = self.model_jacobian()(result[retry], None)
+                weights = 1 / np.sqrt(1 + ((data[retry] - model) / HSM_CAUCHY_SCALE) ** 2)
+                retry_result, retry_nfev, retry_success[retry] = fit(result[retry], data[retry] * weights, weights)
+                nfev[retry] += retry_nfev
+                # fits stop reweighting once weights no longer change their solution
+                moved = np.linalg.norm(retry_result - result[retry], axis=1) > \
+                    fitting.LM_XTOL * (np.linalg.norm(retry_result, axis=1) + fitting.LM_XTOL)
+                result[retry] = retry_result
+                retry = retry[moved]
+                if retry.size == 0:
+                    break
+            retry = np.flatnonzero(~fit_valid)
+            fit_valid[retry] = valid(result[retry], retry_success[retry])
+
+        result[~fit_valid, :] = np.nan
+        return result, nfev
+
+    def fitter(self, frame_stacks, shape, energy_width, *_):
+        """
+        Does Gaussian fitting for all frames of all ROIs at once
+        --------------------------------------------------------
+        :param frame_stacks: HSM corrected frame stacks of all ROIs, ROI by frame by ROI size by ROI size
+        :param shape: spectral correction of each frame
+        :param energy_width: bandwidth in eV of each frame
+        :return: HSM results of all ROIs: raw intensity and intensity (ROI by frame), and raw fits (ROI by frame by
+        parameter)
+        """
+        n_rois, n_frames = frame_stacks.shape[:2]
+        patches = frame_stacks.reshape(n_rois * n_frames, self.roi_size, self.roi_size)
+        if patches.shape[0] == 0:
+            return np.zeros((n_rois, n_frames)), np.zeros((n_rois, n_frames)), np.zeros((n_rois, n_frames, 6))
+
+        raw_fits, _ = self.fit_batch(patches, self.stack_bg(patches))
+        raw_fits = raw_fits.reshape(n_rois, n_frames, self.num_fit_params)
+        raw_intensity = 2 * np.pi * raw_fits[:, :, 0] * raw_fits[:, :, 3] * raw_fits[:, :, 4]
+        # for intensity, divide by shape correction and energy_width normalization
+        intensity = raw_intensity / shape[None, :] / energy_width[None, :]
+
+        # reject very high sigma fits (50% above average of ROI)
+        with np.errstate(invalid='ignore'):
+            high_sigma = (raw_fits[:, :, 3] > np.nanmean(raw_fits[:, :, 3], axis=1, keepdims=True) * 1.5) | \
+                         (raw_fits[:, :, 4] > np.nanmean(raw_fits[:, :, 4], axis=1, keepdims=True) * 1.5)
+        intensity[high_sigma] = np.nan
+        raw_intensity[high_sigma] = np.nan
+        raw_fits[high_sigma, :] = np.nan
 
         return raw_intensity, intensity, raw_fits
 
+# %% HSM fitting of ROIs
+
+
+def fit_rois(frame_stacks, shape, energy_width, wavelengths, verbose=False):
+    """
+    Gaussian fits of all frames and Lorentzian fit of the spectrum, for a number of ROIs
+    ----------------------------------------
+    :param frame_stacks: HSM corrected frame stacks, ROI by frame by ROI size by ROI size
+    :param shape: spectral correction of each frame
+    :param energy_width: bandwidth in eV of each frame
+    :param wavelengths: wavelength of each frame
+    :param verbose: if True, you get a lot of images
+    :return: compact result rows, per ROI: raw intensity and intensity per frame, raw fit per frame, Lorentzian
+    parameters, and r-squared
+    """
+    fitter = HSMFit(int((frame_stacks.shape[-1] - 1) / 2))
+    raw_intensities, intensities, raw_fits = fitter.fitter(frame_stacks, shape, energy_width)
+    results, r_squareds = HSMDataset.fit_lorentzian(intensities, wavelengths, verbose=verbose)
+    return np.concatenate((raw_intensities, intensities, raw_fits.reshape(raw_fits.shape[0], -1), results,
+                           r_squareds[:, None]), axis=1)
+
+
+def preview_rois(frame_stacks, shape, energy_width, wavelengths, verbose=False):
+    """
+    Quick-look alternative to fit_rois. Intensity of each frame is the background corrected sum of the ROI instead of
+    a Gaussian fit, the spectrum is fitted the same. Same compact result rows as fit_rois, raw fits are NaN
+    ----------------------------------------
+    :param frame_stacks: HSM corrected frame stacks, ROI by frame by ROI size by ROI size
+    :param shape: spectral correction of each frame
+    :param energy_width: bandwidth in eV of each frame
+    :param wavelengths: wavelength of each frame
+    :param verbose: if True, you get a lot of images
+    :return: compact result rows, see fit_rois
+    """
+    n_rois, n_frames = frame_stacks.shape[:2]
+    patches = frame_stacks.reshape(n_rois * n_frames, *frame_stacks.shape[2:])
+    backgrounds = HSMFit(int((frame_stacks.shape[-1] - 1) / 2)).stack_bg(patches)
+    raw_intensities = (patches.sum(axis=(1, 2), dtype=np.float64) -
+                       backgrounds * patches.shape[1] * patches.shape[2]).reshape(n_rois, n_frames)
+    # no signal above background is no intensity, as a failed fit
+    raw_intensities[raw_intensities <= 0] = np.nan
+    intensities = raw_intensities / shape[None, :] / energy_width[None, :]
+    results, r_squareds = HSMDataset.fit_lorentzian(intensities, wavelengths, verbose=verbose)
+    return np.concatenate((raw_intensities, intensities, np.full((n_rois, 6 * n_frames), np.nan), results,
+                           r_squareds[:, None]), axis=1)
+
+
+def fit_rois_shared(shared_name, stacks_shape, stacks_dtype, roi_slice, shape, energy_width, wavelengths):
+    """
+    fit_rois for a chunk of ROIs in a worker process. Frame stacks of all ROIs are in shared memory
+    ----------------------------------------
+    :param shared_name: name of shared memory with frame stacks of all ROIs
+    :param stacks_shape: shape of frame stacks of all ROIs
+    :param stacks_dtype: data type of frame stacks
+    :param roi_slice: slice of ROIs to fit
+    :param shape: spectral correction of each frame
+    :param energy_width: bandwidth in eV of each frame
+    :param wavelengths: wavelength of each frame
+    :return: roi_slice, and compact result rows of those ROIs
+    """
+    shared = shared_memory.SharedMemory(name=shared_name)
+    try:
+        frame_stacks = np.ndarray(stacks_shape, dtype=stacks_dtype, buffer=shared.buf)[roi_slice].copy()
+    finally:
+        shared.close()
+    return roi_slice, fit_rois(frame_stacks, shape, energy_width, wavelengths)
+
 # %% HSM Dataset v2
 
 
@@ -188,7 +341,7 @@ class HSMDataset(Dataset):
     """
     def __init__(self, experiment, nd2, name, label=None):
         """
-        Initialise HSM Dataset. Set base values and load nd2. Also create corrected frame.
+        Initialise HSM Dataset. Set base values and open nd2. Also finds drift and creates merged frame.
         ------------------------
         :param experiment: parent experiment
         :param nd2: nd2 of HSM
@@ -197,15 +350,18 @@ class HSMDataset(Dataset):
         """
         super().__init__(experiment, nd2, name)
         self.type = "HSM"
-        self.frames = np.asarray(nd2)
+        self.frames = nd2
+        self.read_lock = threading.Lock()
         self.metadata = nd2.get_metadata(verbose=False)
         self.wavelengths = None
         self.correction_file = None
         self.spec_wavelength = None
         self.spec_shape = None
+        self.n_cores = 1
+        self.preview = False
 
-        # create corrected merged frame and corrected frames
-        self.corrected, self.frame_for_rois = self.hsm_drift(verbose=False, label=label)
+        # find drift of frames and create corrected merged frame. Frames themselves are read again during run
+        self.frame_offsets, self.frame_for_rois = self.hsm_drift(verbose=False, label=label)
 
     def prepare_run(self, settings):
         """
@@ -281,20 +437,16 @@ class HSMDataset(Dataset):
             return False
         self.set_name(new_name)
         self.settings = settings
+        self.n_cores = settings.get('#cores', 1)
+        self.preview = settings.get('preview', False)
 
-        # set correction file
+        # set correction file, loaded once per session
         self.correction_file = settings['correction_file']
-        path = os.getcwd()
-        path += ("/spectral_corrections/" + settings['correction_file'] + ".mat")
-        # load in correction file
-        try:  # for new MATLAB versions
-            correction = loadmat(path)
-            self.spec_wavelength = correction['SpectralCorrection'][0][0][0][0]
-            self.spec_shape = correction['SpectralCorrection'][0][0][1][0]
-        except NotImplementedError:  # for old MATLAB versions
-            correction = mat73.loadmat(path)
-            self.spec_wavelength = correction['SpectralCorrection']['Lambda']
-            self.spec_shape = correction['SpectralCorrection']['SpecShape']
+        try:
+            self.spec_wavelength, self.spec_shape = load_correction(self.correction_file)
+        except OSError:
+            self.experiment.error_func("Input error", "Correction file not found")
+            return False
 
         # Add wavelengths. Return false if fails
         try:
@@ -308,101 +460,154 @@ class HSMDataset(Dataset):
             return False
 
         # check wavelengths same size as array
-        if len(self.wavelengths) != self.corrected.shape[0]:
+        if len(self.wavelengths) != len(self.frames):
             self.experiment.error_func("Input error", "Wavelengths not same length as the amount of frames loaded")
             return False
 
+    # %% Correct for drift between frames
+    def read_frame(self, frame_index):
+        """
+        Reads a single frame from the nd2. The nd2 reader is not thread safe, so reads are done one at a time.
+        ----------------------------------------
+        :param frame_index: index of frame to read
+        :return: frame
+        """
+        with self.read_lock:
+            return np.asarray(self.frames[frame_index])
+
+    def shifted_frame(self, frame_index, frame_buffer):
+        """
+        Frame shifted to correct for drift, without background correction. Part shifted in is filled with the mean.
+        ----------------------------------------
+        :param frame_index: index of frame
+        :param frame_buffer: frame of data type to put shifted frame in
+        :return: frame_buffer
+        """
+        frame = self.read_frame(frame_index)
+        target, source = shifted_slices(self.frame_offsets[frame_index, :], frame.shape)
+        frame_buffer[:, :] = np.mean(frame)
+        frame_buffer[target] = frame[source]
+        return frame_buffer
+
+    def get_frame_stacks(self, roi_size_1d):
+        """
+        Gets the drift corrected frame stack of all active ROIs. Reads one frame at a time from the nd2
+        ----------------------------------------
+        :param roi_size_1d: ROI size
+        :return: frame stacks, ROI by frame by ROI size by ROI size
+        """
+        roi_size = roi_size_1d * 2 + 1
+        frame_stacks = np.zeros((len(self.active_rois), len(self.frames), roi_size, roi_size), dtype=self.data_type)
+        frame_buffer = np.empty(self.frame_for_rois.shape, dtype=self.data_type)
+        for frame_index in range(len(self.frames)):
+            self.shifted_frame(frame_index, frame_buffer)
+            for roi_index, roi in enumerate(self.active_rois):
+                frame_stacks[roi_index, frame_index, :, :] = roi.get_roi(frame_buffer, roi_size_1d, self.roi_offset)
+        return frame_stacks
+
     # %% Correct for drift between frames
     def hsm_drift(self, verbose=False, label=None):
         """
-        Corrects the drift between the HSM frames and adds them up for a merged frame to compare to the laser frame.
+        Finds the drift between the HSM frames and adds them up for a merged frame to compare to the laser frame.
+        Frames are read from the nd2 when needed, the stack is never loaded as a whole.
         ----------------------------------------
         :param verbose: If true, you get figures
         :param label: a label that you can add. If added, update percentages will be placed there
-        :return: data_output: all the frames aligned (without background correction)
+        :return: frame_offsets: shift of each frame to align it with the center frame
         :return: data_merged: all the frames aligned and added up (with background correction)
         """
         # pre-declare
-        offset = np.zeros((self.frames.shape[0], 2))
-        offset_from_zero = np.zeros((self.frames.shape[0], 2))
+        n_frames = len(self.frames)
+        offset = np.zeros((n_frames, 2))
+        offset_from_zero = np.zeros((n_frames, 2))
+        outside_ratio = np.zeros(n_frames)
 
-        frame = self.frames[0, :, :]
-        data_output = np.zeros(self.frames.shape, dtype=self.data_type)
-        data_merged_helper = np.zeros(self.frames.shape, dtype=self.data_type_signed)
+        frame = self.read_frame(0)
         data_merged = np.zeros(frame.shape, dtype=self.data_type_signed)
-        img_corrected_previous = 0
 
-        # for each frame, correct for background and save corrected frame
-        for frame_index, frame in enumerate(self.frames):
+        # crop 5 pixels for background correction
+        crop_shape = frame[5:-5, 5:-5].shape
+        padded_shape = correlation_shape(crop_shape, HSM_DRIFT_RANGE)
+        ones_spectrum = fft.rfft2(np.ones(crop_shape), padded_shape)
+
+        def remove_background(frame_index):
+            # done on the fly where needed, no background corrected copy of the stack is kept
+            frame = self.read_frame(frame_index)
             background = median_filter(frame, size=9, mode='constant')
-            frame = frame.astype(self.data_type_signed) - background
-            # crop 5 pixels for background correction
-            img_corrected = np.round((frame[5:-5, 5:-5]), 0).astype(self.data_type_signed)
-            # save to data_merged_helper to prevent doing background correction again
-            data_merged_helper[frame_index, :, :] = frame.astype(self.data_type_signed)
-            # after first frame, correlate with previous frame
-            if frame_index > 0:
-                frame_convolution = normxcorr2(img_corrected, img_corrected_previous)
-                maxima = np.transpose(np.asarray(np.where(frame_convolution == np.amax(frame_convolution))))[0]
-                offset[frame_index, :] = maxima - np.asarray(img_corrected.shape) + np.asarray([1, 1])
-
-            img_corrected_previous = img_corrected
-            if label is not None:
-                label.updater(text=f'HSM frames are being merged. '
-                                   f'Progress {(frame_index + 1) / len(self.frames) * 100:.1f}%')
-
-        # after all correlations, add up individual offsets to get offset from frame zero
-        for index in range(self.frames.shape[0]):
-            if index == 0:
-                offset_from_zero[index, :] = offset[index, :].copy()
-            else:
-                offset_from_zero[index, :] = offset_from_zero[index - 1, :] + offset[index, :]
-
-        # now convert to offset from center
-        offset_from_center = offset_from_zero[int(round(self.frames.shape[0] / 2, 0)), :] - offset_from_zero
-        # get max offset and determine size of helper frame
-        max_offset = int(np.max(abs(offset_from_center)))
-        size_frame = np.asarray(frame.shape, dtype=int)
-        helper_size = tuple(size_frame + max_offset * 2)
-
-        for frame_index, frame in enumerate(self.frames):
-            # for each frame, make a helper frame (which is larger)
-            bg = np.mean(frame)
-            helper_image = np.ones(helper_size) * bg
-
-            # and shift frame to correct position within the helper frame
-            shift_dist = offset_from_center[frame_index, :].astype(int)
-            helper_image[max_offset - shift_dist[-2]:size_frame[-2] + max_offset - shift_dist[-2],
-                         max_offset - shift_dist[-1]:size_frame[-1] + max_offset - shift_dist[-1]] = frame
-
-            # save to data_output
-            data_output[frame_index, :, :] = helper_image[max_offset:size_frame[-2] + max_offset,
-                                                          max_offset:size_frame[-1] + max_offset]
-            # add to data merged by getting data_merged_helper
-            helper_image = np.zeros(helper_size, dtype=self.data_type_signed)
-            helper_image[max_offset - shift_dist[-2]:size_frame[-2] + max_offset - shift_dist[-2],
-                         max_offset - shift_dist[-1]:size_frame[-1] + max_offset - shift_dist[-1]] = \
-                data_merged_helper[frame_index, :, :]
-            data_merged += helper_image[max_offset:size_frame[-2] + max_offset, max_offset:size_frame[-1] + max_offset]
-
-            # if verbose, show result per frame
-            if verbose:
+            return frame.astype(self.data_type_signed) - background
+
+        def spectra(frame_index):
+            img_corrected = np.round(remove_background(frame_index)[5:-5, 5:-5], 0).astype(self.data_type_signed)
+            return correlation_spectra(img_corrected, padded_shape)
+
+        def correlate_chunk(chunk):
+            # each frame is transformed once per chunk and used for both its neighbours
+            spectra_previous = spectra(chunk[0] - 1)
+            for frame_index in chunk:
+                spectra_current = spectra(frame_index)
+                frame_convolution = normxcorr2_spectra(spectra_previous, spectra_current, ones_spectrum, padded_shape)
+                offset[frame_index, :], outside_ratio[frame_index] = \
+                    correlation_peak(frame_convolution, crop_shape, HSM_DRIFT_RANGE, outside_ratio=True)
+                spectra_previous = spectra_current
+
+        def shift_frame(frame_index):
+            # return shifted part of background corrected frame, and where it goes
+            target, source = shifted_slices(frame_offsets[frame_index, :], size_frame)
+            return target, remove_background(frame_index)[source]
+
+        n_workers = max(min(HSM_DRIFT_WORKERS, n_frames), 1)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # one contiguous chunk of frame pairs per worker, keeps memory at two frames of spectra per worker
+            # median filter and FFTs release the GIL, so threads run in parallel. Label only updated from this thread
+            chunks = [chunk for chunk in np.array_split(np.arange(1, n_frames), n_workers) if len(chunk) > 0]
+            tasks = [executor.submit(correlate_chunk, chunk) for chunk in chunks]
+            for task_index, task in enumerate(as_completed(tasks)):
+                task.result()
+                if label is not None:
+                    label.updater(text=f'HSM frames are being merged. '
+                                       f'Progress {(task_index + 1) / len(tasks) * 50:.1f}%')
+
+            # after all correlations, add up individual offsets to get offset from frame zero
+            offset_from_zero[:, :] = np.cumsum(offset, axis=0)
+
+            # only drift within HSM_DRIFT_RANGE is found, a clearly higher correlation outside means larger drift
+            frames_outside = np.flatnonzero(outside_ratio > HSM_DRIFT_OUTSIDE_RATIO)
+            if len(frames_outside) > 0:
+                logger.warning("HSM drift larger than {} pixels between {} pair(s) of frames, first between frame {} "
+                               "and {}. This drift is not corrected".format(HSM_DRIFT_RANGE, len(frames_outside),
+                                                                            frames_outside[0] - 1, frames_outside[0]))
+
+            # now convert to offset from center
+            offset_from_center = offset_from_zero[int(round(n_frames / 2, 0)), :] - offset_from_zero
+            frame_offsets = offset_from_center.astype(int)
+            size_frame = np.asarray(frame.shape, dtype=int)
+
+            # shift frames in blocks of one frame per worker, so only that many corrected frames exist at once
+            for block_start in range(0, n_frames, n_workers):
+                block = range(block_start, min(block_start + n_workers, n_frames))
+                for target, frame_shifted in executor.map(shift_frame, block):
+                    data_merged[target] += frame_shifted
+                if label is not None:
+                    label.updater(text=f'HSM frames are being merged. '
+                                       f'Progress {50 + block.stop / n_frames * 50:.1f}%')
+
+        # if verbose, show result per frame and overall result
+        if verbose:
+            self.frame_offsets = frame_offsets
+            frame_buffer = np.empty(frame.shape, dtype=self.data_type)
+            for frame_index in range(n_frames):
+                self.shifted_frame(frame_index, frame_buffer)
                 fig, ax = plt.subplots(1)
-                ax.imshow(data_output[frame_index, :, :],
-                          extent=[0, data_output[frame_index, :, :].shape[1],
-                                  data_output[frame_index, :, :].shape[0],
-                                  0], aspect='auto')
+                ax.imshow(frame_buffer, extent=[0, frame_buffer.shape[1], frame_buffer.shape[0], 0], aspect='auto')
                 plt.title("Frame {} shifted final".format(frame_index))
                 plt.show()
 
-        # if verbose, show overall result
-        if verbose:
             fig, ax = plt.subplots(1)
             ax.imshow(data_merged, extent=[0, data_merged.shape[1], data_merged.shape[0], 0], aspect='auto')
             plt.title("Result")
             plt.show()
 
-        return data_output, data_merged
+        return frame_offsets, data_merged
 
     def find_energy_width(self):
         """
@@ -426,15 +631,8 @@ class HSMDataset(Dataset):
         :return: self.hsm_result: the actual result. An array with ROI index, Lorentzian results and r-squared
         :return: intensity_result: All the intensities per ROI used to fit the lorentzian
         """
-        def find_nearest(match_array, value_array, match_index):
-            """
-            Finds and returns the nearest match in another array
-            """
-            idx = (np.abs(match_array - match_index)).argmin()
-            return value_array[idx]
-
         # find correct shape for wavelength
-        shape = np.asarray([find_nearest(self.spec_wavelength, self.spec_shape, nu) for nu in self.wavelengths])
+        shape = correction_shape(self.correction_file, self.wavelengths)
         energy_width = self.find_energy_width()
         # if verbose, show ROIs after correction
         if verbose:
@@ -445,24 +643,35 @@ class HSMDataset(Dataset):
 
         # prep for fitting
         roi_size_1d = 4
-        fitter = HSMFit(roi_size_1d)
+        n_frames = len(self.wavelengths)
+
+        # get ROIs from nd2, one frame at a time
+        frame_stacks = self.get_frame_stacks(roi_size_1d)
+
+        # %% Fit every ROI for every frame, and its spectrum. Preview is fast enough for a single core
+        n_cores = min(self.n_cores, len(self.active_rois))
+        if n_cores > 1 and not verbose and not self.preview:
+            rows = self.run_mp(frame_stacks, shape, energy_width, n_cores)
+            progress_per_roi = False
+        else:
+            rows = (preview_rois if self.preview else fit_rois)(frame_stacks, shape, energy_width, self.wavelengths,
+                                                                verbose=verbose)
+            progress_per_roi = True
 
-        # %% Fit every ROI for every frame
         for roi_index, roi in enumerate(self.active_rois):
-            frame_stack = roi.get_frame_stack(self.corrected, roi_size_1d, self.roi_offset)
-            # Fit with Gaussian fitter
-            raw_intensity, intensity, raw_fits = fitter.fitter(frame_stack, shape, energy_width)
+            frame_stack = frame_stacks[roi_index]
+            raw_intensity = rows[roi_index, :n_frames]
+            intensity = rows[roi_index, n_frames:2 * n_frames]
+            raw_fits = rows[roi_index, 2 * n_frames:8 * n_frames].reshape(n_frames, 6)
+            result, r_squared = rows[roi_index, 8 * n_frames:8 * n_frames + 4], rows[roi_index, -1]
 
-            # Fit the total intensity of a single ROI over all frames with Lorentzian
+            # Show the total intensity of a single ROI over all frames that the Lorentzian is fitted to
             if verbose:
                 fig, ax = plt.subplots(1)
                 ax.plot(self.wavelengths, intensity)
                 ax.set_title('Result ROI #{}'.format(roi.index))
                 plt.show()
 
-            # fit lorentzian to individual fits
-            result, r_squared = self.fit_lorentzian(intensity, self.wavelengths, verbose=verbose)
-
             result_dict = {"type": self.type, 'wavelengths': self.wavelengths, "lambda": 1240 / result[2],  # SP lambda
                            "linewidth": 1000 * result[3], 'R2': r_squared, "fit_parameters": result,  # linewidth
                            "raw_intensity": raw_intensity, "raw_fits": raw_fits,  # raw gaussian fits
@@ -470,49 +679,80 @@ class HSMDataset(Dataset):
             roi.results[self.name_result] = result_dict
 
             # progress update
-            self.experiment.progress_updater.update_progress()
+            if progress_per_roi:
+                self.experiment.progress_updater.update_progress()
+
+    def run_mp(self, frame_stacks, shape, energy_width, n_cores):
+        """
+        Fits chunks of ROIs in worker processes. Frame stacks are shared with the workers through shared memory, workers
+        return compact result rows
+        ---------------------------------------
+        :param frame_stacks: HSM corrected frame stacks of all ROIs
+        :param shape: spectral correction of each frame
+        :param energy_width: bandwidth in eV of each frame
+        :param n_cores: number of worker processes
+        :return: compact result rows of all ROIs, see fit_rois
+        """
+        n_rois = frame_stacks.shape[0]
+        rows = np.empty((n_rois, 8 * frame_stacks.shape[1] + 5))
+        # a few chunks per core, for progress updates and load balancing
+        bounds = np.linspace(0, n_rois, min(n_cores * HSM_CHUNKS_PER_CORE, n_rois) + 1).astype(int)
+
+        shared = shared_memory.SharedMemory(create=True, size=max(frame_stacks.nbytes, 1))
+        try:
+            np.ndarray(frame_stacks.shape, dtype=frame_stacks.dtype, buffer=shared.buf)[:] = frame_stacks
+            with ProcessPoolExecutor(max_workers=n_cores) as executor:
+                tasks = [executor.submit(fit_rois_shared, shared.name, frame_stacks.shape, frame_stacks.dtype,
+                                         slice(start, stop), shape, energy_width, self.wavelengths)
+                         for start, stop in zip(bounds[:-1], bounds[1:])]
+                for task in as_completed(tasks):
+                    roi_slice, chunk_rows = task.result()
+                    rows[roi_slice] = chunk_rows
+                    for _ in range(roi_slice.stop - roi_slice.start):
+                        self.experiment.progress_updater.update_progress()
+        finally:
+            shared.close()
+            shared.unlink()
+        return rows
 
     @staticmethod
     def fit_lorentzian(scattering, wavelength, verbose=False):
         """
-        Function to fit a lorentzian to the found intensities
+        Function to fit a lorentzian to the found intensities of all ROIs at once. Three starts per ROI (SPectrA
+        initial guess, standard values of Matej, standard values of Sjoerd), all fitted together.
         -----------------------------------------------
-        :param scattering: the scattering intensities found
+        :param scattering: the scattering intensities found, ROI by wavelength. NaN where no intensity was found
         :param wavelength: the wavelengths of the found intensities
         :param verbose: if True, you get a lot of images
-        :return: result: resulting Lorentzian parameters
-        :return r_squared: the r-squared of this fit
+        :return: result: resulting Lorentzian parameters, ROI by parameter
+        :return r_squared: the r-squared of each fit
         """
 
         def lorentzian(params, x):
             """
             Lorentzian formula. Taken from SPectrA
             ----------------
-            :param params: Parameters of lorentzian. Need to be four.
-            :param x: x-axis. Wavelengths
-            :return: array of values for current parameters and wavelengths
-            """
-            return params[0] + params[1] / ((x - params[2]) ** 2 + (0.5 * params[3]) ** 2)
-
-        def error_func(p, x, y):
-            """
-            Error function
+            :param params: Parameters of lorentzian, fit by four.
+            :param x: x-axis. Wavelengths in eV
+            :return: array of values for current parameters and wavelengths, fit by wavelength
             """
-            return lorentzian(p, x) - y
+            return params[:, 0, None] + params[:, 1, None] / ((x[None, :] - params[:, 2, None]) ** 2 +
+                                                              (0.5 * params[:, 3, None]) ** 2)
 
-        def find_r_squared(f, p, x, y):
+        def find_r_squared(p, x, y, mask):
             """
-            Finds R^2 of a function and fitted result
+            Finds R^2 of fitted result, only of points in mask
             --------------------------
-            :param f: function
-            :param p: parameters
+            :param p: parameters, fit by four
             :param x: x-axis
-            :param y: true y-axis
-            :return: R^2
+            :param y: true y-axis, fit by wavelength
+            :param mask: points to use, fit by wavelength
+            :return: R^2 of each fit
             """
-            res = y - f(p, x)
-            ss_res = np.sum(res ** 2)
-            ss_tot = np.sum((y - np.mean(y)) ** 2)
+            res = np.where(mask, y - lorentzian(p, x), 0)
+            ss_res = np.sum(res ** 2, axis=1)
+            mean = np.sum(y, axis=1, where=mask) / np.sum(mask, axis=1)
+            ss_tot = np.sum((y - mean[:, None]) ** 2, axis=1, where=mask)
             return 1 - ss_res / ss_tot
 
         def compare_plot(x, y, p):
@@ -524,62 +764,244 @@ class HSMDataset(Dataset):
             :param p: parameters for fit
             :return: None. Shows fit
             """
-            fy = lorentzian(p, x)
+            fy = lorentzian(p[None, :], x)[0]
             fig, ax = plt.subplots(1)
             ax.plot(x, y)
             ax.plot(x, fy)
             plt.show()
 
-        # remove nans
-        to_del = ~np.isnan(scattering)
-        scattering = scattering[to_del]
-        wavelength = wavelength[to_del]
+        scattering = np.atleast_2d(np.asarray(scattering, dtype=np.float64))
+        n_rois = scattering.shape[0]
+        result = np.full((n_rois, 4), np.nan)
+        r_squared = np.zeros(n_rois)
 
-        # return if not enough points
-        if len(scattering) < 5:
-            return [np.nan, np.nan, np.nan, np.nan], 0
+        # remove nans, return if not enough points
+        mask = ~np.isnan(scattering)
+        fit = np.flatnonzero(np.sum(mask, axis=1) >= 5)
+        if fit.size == 0:
+            return result, r_squared
+        mask = mask[fit]
+        y = np.where(mask, scattering[fit], 0)
 
         # convert to eV
-        wavelength_ev = 1240 / wavelength
-
-        # find max and min
-        max_sca = np.nanmax(scattering[scattering < np.nanmax(scattering)])
-        idx_max = np.nanargmax(scattering[scattering < np.nanmax(scattering)])
-        min_sca = np.nanmin(scattering)
-
-        # init guess and first fit
-        init_1w = abs(2 / (np.pi * max_sca) * np.trapz(scattering, wavelength_ev))
-        init_guess = [min_sca, min_sca * init_1w / (2 * np.pi), wavelength_ev[idx_max], init_1w]
-
-        result_full = least_squares(error_func, init_guess, args=(wavelength_ev, scattering))
-        result = result_full.x
-        result[3] = abs(result[3])
-        r_squared = find_r_squared(lorentzian, result, wavelength_ev, scattering)
-
-        # if bad fit, try standard values of Matej
-        if r_squared < 0.9:
-            result_full_std = least_squares(error_func, [min_sca, 100, 1240 / wavelength[idx_max], 0.15],
-                                            args=(wavelength_ev, scattering))
-            result_std = result_full_std.x
-            result_std[3] = abs(result_std[3])
-            r_squared_std = find_r_squared(lorentzian, result_std, wavelength_ev, scattering)
-            if r_squared_std > r_squared:
-                result = result_std
-                r_squared = r_squared_std
-
-        # if bad fit still, try standard values of Sjoerd
-        if r_squared < 0.9:
-            result_full_base = least_squares(error_func, [min_sca, 10000, 1240 / wavelength[idx_max], 0.15],
-                                             args=(wavelength_ev, scattering))
-            result_base = result_full_base.x
-            result_base[3] = abs(result_base[3])
-            r_squared_base = find_r_squared(lorentzian, result_base, wavelength_ev, scattering)
-            if r_squared_base > r_squared:
-                result = result_base
-                r_squared = r_squared_base
+        wavelength_ev = 1240 / np.asarray(wavelength, dtype=np.float64)
+
+        # find max and min. Max is the highest value below the actual maximum
+        highest = np.max(scattering[fit], axis=1, where=mask, initial=-np.inf)
+        below_highest = mask & (scattering[fit] < highest[:, None])
+        below_highest[~np.any(below_highest, axis=1)] = mask[~np.any(below_highest, axis=1)]
+        candidates = np.where(below_highest, scattering[fit], -np.inf)
+        idx_max = np.argmax(candidates, axis=1)
+        max_sca = candidates[np.arange(fit.size), idx_max]
+        min_sca = np.min(scattering[fit], axis=1, where=mask, initial=np.inf)
+
+        # trapezoid integral over the points that are not NaN, each point with the previous point that is not NaN
+        points = np.where(mask, np.arange(mask.shape[1])[None, :], -1)
+        previous = np.maximum.accumulate(points, axis=1)[:, :-1]
+        pairs = mask[:, 1:] & (previous >= 0)
+        previous = np.maximum(previous, 0)
+        integral = np.sum(np.where(pairs, (wavelength_ev[1:][None, :] - wavelength_ev[previous]) *
+                                   (y[:, 1:] + np.take_along_axis(y, previous, axis=1)) / 2, 0), axis=1)
+
+        # init guesses: SPectrA, Matej, and Sjoerd
+        init_1w = np.abs(2 / (np.pi * max_sca) * integral)
+        starts = np.zeros((3, fit.size, 4))
+        starts[:, :, 0] = min_sca
+        starts[:, :, 2] = wavelength_ev[idx_max]
+        starts[0, :, 1] = min_sca * init_1w / (2 * np.pi)
+        starts[0, :, 3] = init_1w
+        starts[1, :, 1] = 100
+        starts[2, :, 1] = 10000
+        starts[1:, :, 3] = 0.15
+
+        def model_jacobian(params, rows):
+            # masked points count as zero residual
+            distance = wavelength_ev[None, :] - params[:, 2, None]
+            denominator = distance ** 2 + (0.5 * params[:, 3, None]) ** 2
+            jac = np.empty(denominator.shape + (4,))
+            jac[:, :, 0] = 1
+            jac[:, :, 1] = 1 / denominator
+            jac[:, :, 2] = 2 * params[:, 1, None] * distance / denominator ** 2
+            jac[:, :, 3] = -0.5 * params[:, 1, None] * params[:, 3, None] / denominator ** 2
+            model = params[:, 0, None] + params[:, 1, None] * jac[:, :, 1]
+            fit_mask = mask_starts[rows]
+            return np.where(fit_mask, model, 0), np.where(fit_mask[:, :, None], jac, 0)
+
+        # all starts of all ROIs at once. Starts that are not finite are not fitted
+        starts = starts.reshape(3 * fit.size, 4)
+        mask_starts = np.tile(mask, (3, 1))
+        results = np.full(starts.shape, np.nan)
+        finite = np.flatnonzero(np.all(np.isfinite(starts), axis=1))
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            mask_starts = mask_starts[finite]
+            results[finite], _, _ = fitting.levenberg_marquardt_batch(model_jacobian, starts[finite],
+                                                                      np.tile(y, (3, 1))[finite],
+                                                                      HSM_LORENTZIAN_MAX_ITS)
+            results[:, 3] = np.abs(results[:, 3])
+            results = results.reshape(3, fit.size, 4)
+            r_squared_starts = np.stack([find_r_squared(results[start], wavelength_ev, y, mask)
+                                         for start in range(3)])
+        r_squared_starts[np.isnan(r_squared_starts)] = -np.inf
+
+        # first start, if bad fit, try standard values of Matej, if bad fit still, try standard values of Sjoerd
+        result_fit = results[0]
+        r_squared_fit = r_squared_starts[0]
+        for start in (1, 2):
+            better = (r_squared_fit < 0.9) & (r_squared_starts[start] > r_squared_fit)
+            result_fit = np.where(better[:, None], results[start], result_fit)
+            r_squared_fit = np.where(better, r_squared_starts[start], r_squared_fit)
+        result[fit] = result_fit
+        r_squared[fit] = np.where(np.isinf(r_squared_fit), 0, r_squared_fit)
 
         # if verbose, show comparison
         if verbose:
-            compare_plot(wavelength_ev, scattering, result)
+            for roi_index in fit:
+                valid = ~np.isnan(scattering[roi_index])
+                compare_plot(wavelength_ev[valid], scattering[roi_index, valid], result[roi_index])
 
         return result, r_squared
+
+# %% HSM series
+
+
+class HSMSeriesDataset(HSMDataset):
+    """
+    Series of HSM stacks of the same field of view, acquired one after another to follow spectral shifts. The drift
+    between the frames of a stack is found once, on the first (reference) stack, and shared by all stacks. Each other
+    stack only gets one offset relative to the reference. All ROIs of all stacks are fitted in one batch.
+    """
+    def __init__(self, experiment, nd2s, name, label=None):
+        """
+        Initialise HSM series. Finds drift of reference stack, creates merged frame, and finds offset of other stacks
+        ------------------------
+        :param experiment: parent experiment
+        :param nd2s: nd2 of each HSM stack, first one is reference
+        :param name: name of reference HSM
+        :param label: a label that you can add. If added, update percentages will be placed there
+        """
+        super().__init__(experiment, nd2s[0], name, label=label)
+        self.type = "HSM series"
+        self.stacks = nd2s
+        self.stack_offsets = self.series_drift()
+        self.metadata['stack_offsets'] = self.stack_offsets
+        self.lambda_table = None
+        self.linewidth_table = None
+
+    def read_stack_frame(self, stack_index, frame_index):
+        """
+        Reads a single frame of a stack. One read at a time, as read_frame
+        ----------------------------------------
+        :param stack_index: index of stack
+        :param frame_index: index of frame in stack
+        :return: frame
+        """
+        with self.read_lock:
+            return np.asarray(self.stacks[stack_index][frame_index])
+
+    def series_drift(self):
+        """
+        Finds offset of each stack relative to reference stack, by normxcorr2 of the background corrected
+        center frames. Center frame has no drift within its stack, see hsm_drift
+        ----------------------------------------
+        :return: stack_offsets: offset of each stack, stack by [y, x]
+        """
+        def center_frame(stack_index):
+            frame = self.read_stack_frame(stack_index, int(round(len(self.frames) / 2, 0)))
+            background = median_filter(frame, size=9, mode='constant')
+            # crop 5 pixels for background correction
+            return (frame.astype(self.data_type_signed) - background)[5:-5, 5:-5]
+
+        stack_offsets = np.zeros((len(self.stacks), 2), dtype=int)
+        reference = center_frame(0)
+        for stack_index in range(1, len(self.stacks)):
+            # stack is reference shifted by offset, drift between stacks can be anything
+            stack_offsets[stack_index, :] = self.correlate_frames_same_size(reference, center_frame(stack_index))
+        return stack_offsets
+
+    def prepare_run(self, settings):
+        """
+        Prepare the HSM series for run. As a single HSM, but each stack needs a frame for each wavelength
+        --------------------------
+        :param settings: settings given by user
+        :return: status: boolean whether or not success. Mostly edits class though.
+        """
+        status = super().prepare_run(settings)
+        if status is False:
+            return status
+        if any(len(stack) != len(self.wavelengths) for stack in self.stacks):
+            self.experiment.error_func("Input error", "Not all HSM stacks have a frame for each wavelength")
+            return False
+
+    def get_frame_stacks(self, roi_size_1d):
+        """
+        Gets the drift corrected frame stack of all active ROIs in all stacks, in one pass over the frames
+        ----------------------------------------
+        :param roi_size_1d: ROI size
+        :return: frame stacks, ROI by stack by frame by ROI size by ROI size
+        """
+        roi_size = roi_size_1d * 2 + 1
+        frame_stacks = np.zeros((len(self.active_rois), len(self.stacks), len(self.frames), roi_size, roi_size),
+                                dtype=self.data_type)
+        frame_buffer = np.empty(self.frame_for_rois.shape, dtype=self.data_type)
+        for stack_index in range(len(self.stacks)):
+            for frame_index in range(len(self.frames)):
+                frame = self.read_stack_frame(stack_index, frame_index)
+                # drift within stack of reference, then offset of stack
+                target, source = shifted_slices(self.frame_offsets[frame_index, :] + self.stack_offsets[stack_index, :],
+                                                frame.shape)
+                frame_buffer[:, :] = np.mean(frame)
+                frame_buffer[target] = frame[source]
+                for roi_index, roi in enumerate(self.active_rois):
+                    frame_stacks[roi_index, stack_index, frame_index, :, :] = roi.get_roi(frame_buffer, roi_size_1d,
+                                                                                          self.roi_offset)
+        return frame_stacks
+
+    # %% Run
+    def run(self, verbose=False):
+        """
+        Main of HSM series. Fits all stacks of all ROIs as one batch of spectra. Result of each ROI has one entry per
+        stack, the series tables are ROI by stack
+        ---------------------------------------
+        :param verbose: True if you want figures
+        :return: None. Edits ROIs and sets lambda_table and linewidth_table
+        """
+        shape = correction_shape(self.correction_file, self.wavelengths)
+        energy_width = self.find_energy_width()
+
+        roi_size_1d = 4
+        n_frames = len(self.wavelengths)
+        n_rois, n_stacks = len(self.active_rois), len(self.stacks)
+
+        # every stack of every ROI is one spectrum to fit
+        frame_stacks = self.get_frame_stacks(roi_size_1d)
+        spectra_stacks = frame_stacks.reshape(n_rois * n_stacks, *frame_stacks.shape[2:])
+
+        n_cores = min(self.n_cores, n_rois * n_stacks)
+        if n_cores > 1 and not verbose and not self.preview:
+            rows = self.run_mp(spectra_stacks, shape, energy_width, n_cores)
+        else:
+            rows = (preview_rois if self.preview else fit_rois)(spectra_stacks, shape, energy_width, self.wavelengths,
+                                                                verbose=verbose)
+            for _ in range(n_rois * n_stacks):
+                self.experiment.progress_updater.update_progress()
+        rows = rows.reshape(n_rois, n_stacks, -1)
+
+        results, r_squareds = rows[:, :, 8 * n_frames:8 * n_frames + 4], rows[:, :, -1]
+        self.lambda_table = 1240 / results[:, :, 2]
+        self.linewidth_table = 1000 * results[:, :, 3]
+
+        for roi_index, roi in enumerate(self.active_rois):
+            result_dict = {"type": self.type, 'wavelengths': self.wavelengths,
+                           "lambda": self.lambda_table[roi_index], "linewidth": self.linewidth_table[roi_index],
+                           'R2': r_squareds[roi_index], "fit_parameters": results[roi_index],
+                           "raw_intensity": rows[roi_index, :, :n_frames],
+                           "raw_fits": rows[roi_index, :, 2 * n_frames:8 * n_frames].reshape(n_stacks, n_frames, 6),
+                           "intensity": rows[roi_index, :, n_frames:2 * n_frames], "raw": frame_stacks[roi_index]}
+            roi.results[self.name_result] = result_dict
+
+        # reference stack is closed by experiment
+        for stack in self.stacks[1:]:
+            try:
+                stack.close()
+            except Exception:
+                pass
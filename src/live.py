@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon 19-10-2020
+
+@author: Dion Engels
+PLASMON Data Analysis
+
+live
+
+Live Phasor tracking of a TT while it is still being acquired. Follows a growing ND2, or a directory of frames,
+and fits new frames in small batches.
+
+----------------------------
+
+v0.1: live Phasor of growing ND2 or directory of .npy frames
+v0.2: ND2 only reopened once it has grown
+v0.3: stops at last frame set
+
+"""
+import os
+import glob
+import time
+import threading
+
+import numpy as np
+
+from src.nd2_reading import ND2ReaderSelf
+
+__self_made__ = True
+
+LIVE_BATCH = 16  # maximum number of frames fitted at once, small to keep latency low
+LIVE_POLL_INTERVAL = 0.1  # seconds between checks for new frames
+LIVE_IDLE_TIMEOUT = 10  # seconds without new frames after which acquisition is assumed done
+
+# %% Frame sources
+
+
+class ND2FrameSource:
+    """
+    Frames of an ND2 that is still being written. Reopens the ND2 to see new frames, only once the file has grown.
+    """
+    def __init__(self, filename):
+        """
+        Initialisation of ND2 source. Does not open the ND2 yet
+        ----------------------------
+        :param filename: ND2 being written
+        """
+        self.filename = filename
+        self.nd2 = None
+        self.file_size = None
+
+    def n_frames(self):
+        """
+        Number of frames that are currently available
+        ----------------------------
+        :return: number of frames
+        """
+        # an open reader does not see frames written after it was opened, but reopening parses all metadata again
+        try:
+            file_size = os.path.getsize(self.filename)
+        except OSError:
+            file_size = None
+        if self.nd2 is not None and file_size == self.file_size:
+            return len(self.nd2)
+        try:
+            nd2 = ND2ReaderSelf(self.filename)
+        except Exception:
+            # file in the middle of a write, try again next time
+            return 0 if self.nd2 is None else len(self.nd2)
+        if self.nd2 is not None:
+            self.nd2.close()
+        self.nd2 = nd2
+        self.file_size = file_size
+        return len(self.nd2)
+
+    def get_frames(self, start, stop):
+        """
+        Reads frames
+        ----------------------------
+        :param start: first frame
+        :param stop: frame after last frame
+        :return: frames
+        """
+        return np.asarray(self.nd2[start:stop])
+
+    def close(self):
+        """
+        Closes the ND2
+        ----------------------------
+        :return: None
+        """
+        if self.nd2 is not None:
+            self.nd2.close()
+            self.nd2 = None
+
+
+class DirectoryFrameSource:
+    """
+    Frames as separate .npy files in a directory, sorted by name. Stand-in for a camera writing frames.
+    """
+    def __init__(self, directory):
+        """
+        Initialisation of directory source
+        ----------------------------
+        :param directory: directory that frames are written to
+        """
+        self.directory = directory
+        self.files = []
+
+    def n_frames(self):
+        """
+        Number of frames that are currently available
+        ----------------------------
+        :return: number of frames
+        """
+        self.files = sorted(glob.glob(os.path.join(self.directory, "*.npy")))
+        return len(self.files)
+
+    def get_frames(self, start, stop):
+        """
+        Reads frames. Stops at a frame that is still being written
+        ----------------------------
+        :param start: first frame
+        :param stop: frame after last frame
+        :return: frames
+        """
+        frames = []
+        for file in self.files[start:stop]:
+            try:
+                frames.append(np.load(file))
+            except (OSError, ValueError, EOFError):
+                break
+        return np.asarray(frames)
+
+    def close(self):
+        """
+        Nothing to close
+        ----------------------------
+        :return: None
+        """
+        pass
+
+# %% Live tracker
+
+
+class LiveTracker:
+    """
+    Fits frames as they come in with a Phasor fitter, against ROIs and offset chosen beforehand
+    """
+    def __init__(self, fitter, rois, tt_part, publish=None):
+        """
+        Initialisation of live tracker
+        ----------------------------
+        :param fitter: Phasor fitter
+        :param rois: ROIs to fit
+        :param tt_part: part with first frame and offset to use
+        :param publish: function called with the frame numbers and a dictionary of new results per ROI index
+        """
+        self.fitter = fitter
+        self.rois = rois
+        self.tt_part = tt_part
+        self.publish = publish
+
+        self.frames_done = 0
+        self.active_rois = None
+        self.patch_index = None
+        self.raw_blocks = []
+        self.result_blocks = []
+        self.stop_event = threading.Event()
+
+    def process(self, frame_block):
+        """
+        Fits a block of new frames and publishes the results
+        ----------------------------
+        :param frame_block: new frames
+        :return: None. Edits class
+        """
+        if self.active_rois is None:
+            self.active_rois, self.patch_index = self.fitter.frame_major_rois(self.rois, frame_block.shape[1:],
+                                                                              self.tt_part)
+        patches, block_result = self.fitter.fit_frame_block(frame_block, self.frames_done, self.patch_index,
+                                                            self.tt_part)
+        self.raw_blocks.append(patches)
+        self.result_blocks.append(block_result)
+        self.frames_done += frame_block.shape[0]
+
+        if self.publish is not None:
+            self.publish(block_result[0, :, 0] if len(self.active_rois) > 0 else None,
+                         {roi.index: block_result[roi_number] for roi_number, roi in enumerate(self.active_rois)})
+
+    def run(self, source, poll_interval=LIVE_POLL_INTERVAL, idle_timeout=LIVE_IDLE_TIMEOUT, batch=LIVE_BATCH,
+            frame_stop=None):
+        """
+        Follows source until frame_stop, until no new frames came in for idle_timeout seconds, or until stop is called
+        ----------------------------
+        :param source: frame source, ND2FrameSource or DirectoryFrameSource
+        :param poll_interval: seconds between checks for new frames
+        :param idle_timeout: seconds without new frames after which acquisition is assumed done
+        :param batch: maximum number of frames fitted at once
+        :param frame_stop: frame after last frame to fit. None to follow source until it stops growing
+        :return: None. Edits class
+        """
+        last_new_frame = time.time()
+        try:
+            while not self.stop_event.is_set():
+                next_frame = self.tt_part.frame_start + self.frames_done
+                if frame_stop is not None and next_frame >= frame_stop:
+                    break
+                n_available = source.n_frames() if frame_stop is None else min(source.n_frames(), frame_stop)
+                n_new = min(n_available - next_frame, batch)
+                if n_new > 0:
+                    frame_block = source.get_frames(next_frame, next_frame + n_new)
+                    if frame_block.shape[0] > 0:
+                        self.process(frame_block)
+                        last_new_frame = time.time()
+                        continue
+                if time.time() - last_new_frame > idle_timeout:
+                    break
+                time.sleep(poll_interval)
+        finally:
+            source.close()
+
+    def stop(self):
+        """
+        Stops run after the current batch. Can be called from another thread
+        ----------------------------
+        :return: None
+        """
+        self.stop_event.set()
+
+    def results(self):
+        """
+        All results so far
+        ----------------------------
+        :return: list of ROI, result, and raw patches for each ROI in frame
+        """
+        if self.active_rois is None:
+            return []
+        results = np.concatenate(self.result_blocks, axis=1)
+        raw = np.concatenate(self.raw_blocks, axis=1)
+        return [(roi, results[roi_number], raw[roi_number]) for roi_number, roi in enumerate(self.active_rois)]
@@ -32,8 +32,24 @@ TRANSLATOR_DICT = {'int_max': 'Maximum Intensity', 'int_min': 'Minimum Intensity
                    'pixels_or_nm': "Pixels or nanometer output", "method": "Fitting method used",
                    'frame_begin': "First frame fitted", 'frame_end': 'Last frame fitted', 'Type': "Type of dataset",
                    'Offset': "Offset compared to ROI finding frame", 'correction_file': "HSM spectral correction",
-                   'wavelengths': "HSM wavelengths", 'filename': "Filename",
-                   'correlation_interval': "Interval for correlating sample drift"}
+                   'wavelengths': "HSM wavelengths", 'preview': "HSM preview (sums instead of Gaussian fits)",
+                   'filename': "Filename",
+                   'correlation_interval': "Interval for correlating sample drift",
+                   'warm_start': "Warm start from previous frame",
+                   'warm_start_tolerance': "Warm start tolerance (pixels)",
+                   'reuse_tolerance': "Reuse previous frame tolerance (fraction)",
+                   'prescreen_threshold': "Prescreen peak-to-noise threshold",
+                   'fit_counters': "Number of fits per fitting path",
+                   'max_its_calibration': "Calibration of maximum number of iterations",
+                   'single_precision': "Single precision (float32) results",
+                   'phasor_fft': "Phasor with full FFT (pyFFTW)",
+                   'frame_major': "Frame-major Phasor (all ROIs of a frame at once)",
+                   'live': "Live tracking during acquisition", 'live_source': "Live frame source (None is ND2)",
+                   'live_poll_interval': "Live poll interval (s)", 'live_idle_timeout': "Live idle timeout (s)",
+                   'fixed_sigma_fit_bg': "Fixed sigma Gaussian fits background",
+                   'sigma_calibration': "Calibration of fixed sigma",
+                   'pixel_integrated': "Pixel-integrated Gaussian model",
+                   'precision_convergence': "Precision convergence [position (px), intensity (%)]"}
 
 
 def save_to_mat(directory, name, to_save):
@@ -93,10 +109,19 @@ def save_settings(directory, settings, time_taken):
                     elif value == "Phasor + Sum":
                         text_file.write(
                             "Frame index | x position | y position | Sum of ROI pixel values \n")
+                    elif value == "Radial symmetry":
+                        text_file.write(
+                            "Frame index | x position | y position | Pixel intensity peak | Background \n")
                     elif value == "Gaussian - Fit bg":
                         text_file.write("Frame index | x position | y position | Integrated intensity | "
-                                        "Sigma x | Sigma y | Background (fitted) | Iterations needed to converge \n")
+                                        "Sigma x | Sigma y | Background (fitted) | Iterations needed to converge "
+                                        "(of both attempts if a warm start or precision convergence fell back) \n")
+                    elif value == "Gaussian - Fixed sigma":
+                        text_file.write("Frame index | x position | y position | Integrated intensity | "
+                                        "Sigma x (fixed) | Sigma y (fixed) | Background (fitted or estimate) | "
+                                        "Iterations needed to converge \n")
                     else:
                         text_file.write("Frame index | x position | y position | Integrated intensity | "
-                                        "Sigma x | Sigma y | Background (estimate) | Iterations needed to converge \n")
+                                        "Sigma x | Sigma y | Background (estimate) | Iterations needed to converge "
+                                        "(of both attempts if a warm start or precision convergence fell back) \n")
                 text_file.write(str(TRANSLATOR_DICT[key]) + ": " + str(value) + "\n")
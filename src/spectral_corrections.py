@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon 19-10-2020
+
+@author: Dion Engels
+PLASMON Data Analysis
+
+spectral_corrections
+
+Library of HSM spectral correction files. Each .mat is loaded once per session and interpolated to any wavelengths.
+
+----------------------------
+
+v0.1: cached correction library, independent of working directory
+
+"""
+import os
+import sys
+
+import numpy as np
+from scipy.io import loadmat
+import mat73
+
+__self_made__ = True
+
+CORRECTION_CACHE = {}  # name: (modification time, wavelengths, shape)
+
+
+def correction_directory():
+    """
+    Directory of the correction files. Next to the executable when frozen, otherwise in the root of the program
+    ----------------------------
+    :return: path of directory
+    """
+    if getattr(sys, 'frozen', False):
+        root = os.path.dirname(sys.executable)
+    else:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(root, "spectral_corrections")
+
+
+def correction_options():
+    """
+    Names of all available correction files
+    ----------------------------
+    :return: sorted list of names, without .mat
+    """
+    return sorted(file[:-4] for file in os.listdir(correction_directory()) if file.endswith(".mat"))
+
+
+def load_correction(name):
+    """
+    Loads a correction file, or takes it from the cache if the file did not change since
+    ----------------------------
+    :param name: name of correction file, without .mat
+    :return: wavelengths: wavelengths of correction, ascending
+    :return: shape: spectral shape at those wavelengths
+    """
+    path = os.path.join(correction_directory(), name + ".mat")
+    modification_time = os.path.getmtime(path)
+    if name in CORRECTION_CACHE and CORRECTION_CACHE[name][0] == modification_time:
+        return CORRECTION_CACHE[name][1:]
+
+    try:  # for new MATLAB versions
+        correction = loadmat(path)
+        wavelengths = correction['SpectralCorrection'][0][0][0][0]
+        shape = correction['SpectralCorrection'][0][0][1][0]
+    except NotImplementedError:  # for old MATLAB versions
+        correction = mat73.loadmat(path)
+        wavelengths = correction['SpectralCorrection']['Lambda']
+        shape = correction['SpectralCorrection']['SpecShape']
+
+    # sorted for interpolation
+    wavelengths = np.ravel(np.asarray(wavelengths, dtype=np.float64))
+    shape = np.ravel(np.asarray(shape, dtype=np.float64))
+    order = np.argsort(wavelengths)
+    CORRECTION_CACHE[name] = (modification_time, wavelengths[order], shape[order])
+    return CORRECTION_CACHE[name][1:]
+
+
+def correction_shape(name, wavelengths):
+    """
+    Spectral shape of a correction at any wavelengths. Linear interpolation between the wavelengths of the correction,
+    constant outside them
+    ----------------------------
+    :param name: name of correction file, without .mat
+    :param wavelengths: wavelengths to get shape at
+    :return: shape at each wavelength
+    """
+    correction_wavelengths, shape = load_correction(name)
+    return np.interp(np.asarray(wavelengths, dtype=np.float64), correction_wavelengths, shape)
@@ -73,6 +73,10 @@ def convert_to_matlab(experiment):
             elif dataset.type == "HSM":
                 # change HSM to matlab
                 roi.results[dataset.name_result]['raw'] = raw_to_matlab(roi.results[ dataset.name_result]['raw'])
+            elif dataset.type == "HSM series":
+                # stack becomes last axis, after frame
+                roi.results[dataset.name_result]['raw'] = \
+                    raw_to_matlab(moveaxis(roi.results[dataset.name_result]['raw'], 1, -1))
             else:
                 pass
 
@@ -143,7 +147,7 @@ def switch_axis(array):
     :param: array : array to switch
     :return: new : switched array
     """
-    new = zeros(array.shape)
+    new = zeros(array.shape, dtype=array.dtype)
     new[:, 1] = array[:, 0]
     new[:, 0] = array[:, 1]
     return new
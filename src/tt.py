@@ -8,7 +8,7 @@ PLASMON Data Analysis
 Fitters
 
 This package holds all the fitting algorithms of PLASMON.
-This includes 2 Gaussian fitters and 3 Phasor fitters.
+This includes 3 Gaussian fitters, 3 Phasor fitters and a radial symmetry fitter.
 
 ----------------------------
 
@@ -27,6 +27,22 @@ v0.9.2: removed minimum pixel requirement
 v1.0: Integrated intensity output for Gaussians: 27/08/2020
 v2.0 pre-1: part of v2.0 pre-1: 03/10/2020
 v2.0: with TTParts: 30/10/2020
+v2.1: warm start and reuse of near-identical frames for Gaussian fitters
+v2.2: signal prescreen to skip Gaussian fits of empty frames
+v2.3: sampled calibration of maximum iterations
+v2.4: optional single precision results and Phasor
+v2.5: cached FFTW plans and wisdom on disk for Phasor
+v2.6: first harmonic Phasor engine, pyFFTW optional
+v2.7: Phasor results without loop over frames
+v2.8: frame-major Phasor, all ROIs of a batch of frames at once
+v2.9: live Phasor tracking during acquisition
+v2.10: stack-level background, minimum, maximum and sum, FORTRAN kernels once the binaries are rebuilt
+v2.11: Gaussian with fixed sigma per ROI, batched Levenberg-Marquardt
+v2.12: radial symmetry fitter
+v2.13: optional pixel-integrated Gaussian model, erf tables in batched fitter, analytic jacobian for MINPACK
+v2.14: optional precision convergence criteria for Gaussian fitters, default criteria as fallback
+v2.15: bounds and damping floor in batched Levenberg-Marquardt
+v2.16: TTParts correlated in a window of roi_size, smaller transforms
 """
 # %% Imports
 from __future__ import division, print_function, absolute_import
@@ -35,7 +51,7 @@ import numpy as np  # general mathematics + arrays
 
 from scipy.optimize import _minpack, OptimizeResult  # for Gaussian fitter
 from scipy.ndimage import median_filter  # for correlation with experiment
-from scipy.stats import norm
+from scipy.special import erf  # for pixel-integrated Gaussian
 
 import src.mbx_fortran as fortran_linalg  # for fast self-made operations for Gaussian fitter
 import src.mbx_fortran_tools as fortran_tools  # for fast self-made general operations
@@ -43,10 +59,15 @@ from src.class_dataset_and_class_roi import Dataset  # base dataset
 from src.tools import change_to_nm
 from src.drift_correction import DriftCorrector
 from src.nd2_reading import ND2ReaderSelf
-
-from pyfftw import empty_aligned, FFTW    # for FFT for Phasor
+from src.live import LiveTracker, ND2FrameSource, DirectoryFrameSource, LIVE_POLL_INTERVAL, LIVE_IDLE_TIMEOUT
+
+try:
+    from pyfftw import empty_aligned, FFTW, export_wisdom, import_wisdom    # for full FFT for Phasor, optional
+except ImportError:
+    FFTW = None
+import os  # for location of FFTW wisdom
+import pickle  # for saving FFTW wisdom
 from math import pi, atan2  # general mathematics
-from cmath import phase  # general mathematics
 import multiprocessing as mp
 import _thread
 
@@ -54,6 +75,145 @@ __self_made__ = True
 
 MAX_BYTES = 4294967296 // 1  # 4 GB, // 1 for easy tuning
 
+# calibration of maximum iterations of Gaussian fitters
+MAX_ITS_N_ROIS = 100  # number of ROIs sampled
+MAX_ITS_N_FRAMES = 10  # number of frames sampled
+MAX_ITS_PERCENTILE = 95  # percentile of converged fits that has to be covered
+MAX_ITS_LIMIT = 400  # iteration limit during calibration, also the highest possible outcome
+MAX_ITS_SEED = 0  # seed of sampling, for reproducible calibration
+
+# Gaussian with fixed sigma
+SIGMA_N_FRAMES = 20  # frames per ROI fitted to calibrate sigma
+INIT_SIGMA = 1.2  # sigma if calibration fails, same as initial guess of Gaussian fitters
+BATCHED_MAX_ITS = 100  # iteration limit of batched Levenberg-Marquardt
+
+# batched Levenberg-Marquardt
+LM_XTOL = 1e-8  # relative step tolerance
+LM_FTOL = 1e-8  # relative cost tolerance
+LM_DAMPING_START = 1e-3
+LM_DAMPING_MAX = 1e10  # above this no step lowers the cost, the fit is at a minimum
+LM_DAMPING_MIN = 1e-10  # keeps the damped normal equations solvable when parameters are nearly degenerate
+LM_BATCH = 4096  # fits per batch, bounds memory of the jacobian
+# fixed sigma Gaussian has no sigma to run off on noise, so fits of noise are rejected on signal-to-noise ratio
+FIXED_SIGMA_MIN_SNR = 4  # integrated intensity over its standard deviation from the residual of the fit
+# radial symmetry finds a centre in any frame, so empty frames are rejected on their peak above the background
+RADIAL_SYMMETRY_MIN_PEAK = 3  # peak above background over noise, both from the edge pixels as in prescreen
+
+# table of erf for the pixel-integrated Gaussian, cubic Hermite interpolation between the points with an error below
+# 1e-9. Linear interpolation is too rough, the fit notices it and takes more iterations
+ERF_TABLE_RANGE = 6  # erf is -1 or 1 to double precision beyond this
+ERF_TABLE_STEP = 1e-2
+ERF_TABLE_Z = np.arange(-ERF_TABLE_RANGE, ERF_TABLE_RANGE + ERF_TABLE_STEP / 2, ERF_TABLE_STEP)
+ERF_TABLE = erf(ERF_TABLE_Z)
+# polynomial coefficients per interval, from values and derivatives at both ends
+ERF_TABLE_SLOPES = 2 / np.sqrt(pi) * np.exp(-ERF_TABLE_Z ** 2) * ERF_TABLE_STEP
+ERF_TABLE_C1 = ERF_TABLE_SLOPES[:-1]
+ERF_TABLE_C2 = 3 * np.diff(ERF_TABLE) - 2 * ERF_TABLE_SLOPES[:-1] - ERF_TABLE_SLOPES[1:]
+ERF_TABLE_C3 = ERF_TABLE_SLOPES[:-1] + ERF_TABLE_SLOPES[1:] - 2 * np.diff(ERF_TABLE)
+
+# warm start of Gaussian fitters. Saves little on shot-noise limited data: cold fits already start from the sigma of
+# the last frame, and MINPACK needs about as many iterations to meet xtol from either start. A smaller budget or a
+# cost check before the warm start only adds fallbacks
+WARM_START_ITERATIONS = 7  # iterations a warm start gets before it falls back to the phasor guess
+# precision convergence of Gaussian fitters
+PRECISION_ITERATIONS = 10  # iterations to meet the precision criteria before the default criteria take over
+
+FRAME_MAJOR_BATCH = 64  # frames read and fitted together by frame-major Phasor
+
+# the shipped mbx_fortran_tools binary predates the stack kernels in MBx_FORTRAN_TOOLS.f90. NumPy is used until it is
+# rebuilt with f2py
+STACK_KERNELS = hasattr(fortran_tools, 'calc_bg_stack')
+
+# FFTW plans per (stack shape, dtype), kept per process so the fitters stay picklable
+FFTW_PLANS = {}
+FFTW_WISDOM_PATH = os.path.join(os.path.expanduser("~"), ".plasmon_fftw_wisdom")
+
+
+def load_fftw_wisdom():
+    """
+    Imports FFTW wisdom from disk, if any. Makes planning with FFTW_MEASURE nearly free for known shapes
+    ----------------------
+    :return: None. Changes FFTW state of this process
+    """
+    if FFTW is None:
+        return
+    try:
+        with open(FFTW_WISDOM_PATH, 'rb') as f:
+            import_wisdom(pickle.load(f))
+    except (OSError, pickle.UnpicklingError, EOFError, TypeError, ValueError):
+        # wisdom is only a speed up, start without
+        pass
+
+
+def save_fftw_wisdom():
+    """
+    Exports FFTW wisdom of this process to disk. Writes to a temporary file first so processes do not clash
+    ----------------------
+    :return: None. Writes file
+    """
+    if FFTW is None:
+        return
+    temp_path = "{}.{}".format(FFTW_WISDOM_PATH, os.getpid())
+    try:
+        with open(temp_path, 'wb') as f:
+            pickle.dump(export_wisdom(), f)
+        os.replace(temp_path, FFTW_WISDOM_PATH)
+    except OSError:
+        pass
+
+
+def get_fftw_plan(shape, dtype):
+    """
+    Returns FFTW plan for a real stack of frames of this shape and dtype. Plans once per shape, then reused
+    ----------------------
+    :param shape: shape of frame stack, (frames, roi_size, roi_size)
+    :param dtype: floating point type of frame stack
+    :return: FFTW object
+    """
+    key = (shape, np.dtype(dtype).str)
+    if key not in FFTW_PLANS:
+        roi_bb = empty_aligned(shape, dtype=dtype)
+        roi_bf = empty_aligned((shape[0], shape[1], shape[2] // 2 + 1), dtype=np.result_type(dtype, np.complex64))
+        FFTW_PLANS[key] = FFTW(roi_bb, roi_bf, axes=(1, 2), flags=('FFTW_MEASURE',), direction='FFTW_FORWARD')
+    return FFTW_PLANS[key]
+
+
+def erf_lookup(z):
+    """
+    erf and its derivative by interpolation in the precomputed table. NaN input gives NaN.
+    ----------------------
+    :param z: points to evaluate
+    :return: value: erf of z
+    :return: derivative: derivative of erf at z, 2 / sqrt(pi) * exp(-z ** 2)
+    """
+    position = np.clip((z + ERF_TABLE_RANGE) / ERF_TABLE_STEP, 0, ERF_TABLE_C1.size)
+    # NaN would become an invalid index, take index zero instead, the fraction stays NaN
+    index = np.minimum(np.nan_to_num(position).astype(np.intp), ERF_TABLE_C1.size - 1)
+    fraction = position - index
+    c1 = ERF_TABLE_C1.take(index)
+    c2 = ERF_TABLE_C2.take(index)
+    c3 = ERF_TABLE_C3.take(index)
+    value = ERF_TABLE.take(index) + fraction * (c1 + fraction * (c2 + fraction * c3))
+    derivative = (c1 + fraction * (2 * c2 + 3 * fraction * c3)) / ERF_TABLE_STEP
+    return value, derivative
+
+
+def get_phasor_weights(roi_size, dtype):
+    """
+    Real weights of the DC term, first harmonic in x (cos, -sin), and first harmonic in y (cos, -sin) per pixel.
+    The product of flattened patches with these weights gives the Fourier coefficients used by Phasor.
+    ----------------------
+    :param roi_size: ROI size
+    :param dtype: floating point type of weights
+    :return: weights, (roi_size ** 2, 5)
+    """
+    angle = 2 * pi * np.arange(roi_size) / roi_size
+    ones = np.ones(roi_size)
+    return np.stack([np.outer(ones, ones),
+                     np.outer(ones, np.cos(angle)), np.outer(ones, -np.sin(angle)),
+                     np.outer(np.cos(angle), ones), np.outer(-np.sin(angle), ones)],
+                    axis=-1).reshape(roi_size ** 2, 5).astype(dtype)
+
 # %% Time trace class
 
 
@@ -82,6 +242,8 @@ class TimeTrace(Dataset):
             self.time_axis = range(0, len(self.frames))
             self.time_axis_dim = 'frames'
         self.drift_corrector = None
+        # tracker of live run, can be stopped from another thread
+        self.live_tracker = None
         # parts that the TT dataset is split into
         self.tt_parts = None
         self.tt_parts_done = 0
@@ -101,6 +263,18 @@ class TimeTrace(Dataset):
                                                              "Are you sure everything is set up correctly?") is False:
             return False
 
+        # live tracking is only done with Phasor
+        if settings.get('live', False) and "Phasor" not in settings['method']:
+            self.experiment.error_func("Live needs Phasor", "Live tracking during acquisition is only possible with "
+                                                            "one of the Phasor methods.")
+            return False
+
+        # pixel-integrated model is only used by the Gaussian methods
+        if settings.get('pixel_integrated', False) and "Gaussian" not in settings['method']:
+            self.experiment.error_func("Pixel-integrated needs Gaussian", "The pixel-integrated model is only used "
+                                                                          "by the Gaussian methods.")
+            return False
+
         # check cores for Phasor
         if settings['#cores'] > 1 and "Phasor" in settings['method']:
             if self.experiment.proceed_question("Just a heads up", """Phasor will be used with one core since the
@@ -132,9 +306,11 @@ class TimeTrace(Dataset):
             return False
         # create TTParts
         self.tt_parts = self.slices_create_setup(slices_user)
-
-        # set max its
-        max_its = self.find_max_its()
+        # live tracking follows a single part as it grows
+        if settings.get('live', False) and len(self.tt_parts) > 1:
+            self.experiment.error_func("Live needs one part", "Live tracking fits the TT as a single part. Set the "
+                                                              "correlation interval to 'Never' or fit fewer frames.")
+            return False
 
         # initializer fitter
         if settings['method'] == "Phasor + Intensity":
@@ -142,11 +318,19 @@ class TimeTrace(Dataset):
         elif settings['method'] == "Phasor":
             self.fitter = PhasorDumb(settings, self.roi_offset)
         elif settings['method'] == "Gaussian - Fit bg":
+            max_its = self.find_max_its()
             self.fitter = GaussianBackground(settings, max_its, 6, self.roi_offset)
             self.settings['max_its'] = max_its
         elif settings['method'] == "Gaussian - Estimate bg":
+            max_its = self.find_max_its()
             self.fitter = Gaussian(settings, max_its, 5, self.roi_offset)
             self.settings['max_its'] = max_its
+        elif settings['method'] == "Radial symmetry":
+            self.fitter = RadialSymmetry(settings, self.roi_offset)
+        elif settings['method'] == "Gaussian - Fixed sigma":
+            sigmas = self.calibrate_sigma()
+            self.fitter = GaussianFixedSigma(settings, BATCHED_MAX_ITS, sigmas, self.roi_offset)
+            self.settings['max_its'] = BATCHED_MAX_ITS
         else:
             self.fitter = PhasorSum(settings, self.roi_offset)
 
@@ -293,44 +477,80 @@ class TimeTrace(Dataset):
 
     def find_max_its(self):
         """
-        Finds maximum iterations needed based on intensity of particles found
+        Finds maximum iterations needed by fitting a random sample of ROIs over several frames of the first TTPart.
+        Takes the smallest number of iterations that covers the target percentile of the converged fits.
+        Adds a calibration report to the settings.
         ----------------
         :return: max_its: integer of maximum iterations needed
         """
-        # take first frame
-        first_frame_index = self.tt_parts[0].slice.start
-        first_frame = np.asarray(self.frames[first_frame_index])
-
-        # create temp fitter
-        fitter_tmp = GaussianBackground({'roi_size': 7, 'rejection': True, 'method': "Gaussian - Fit bg"},
-                                        400, 6, self.roi_offset)
-        int_list = []
+        rng = np.random.default_rng(MAX_ITS_SEED)
+
+        # sample ROIs and frames
+        n_rois = min(MAX_ITS_N_ROIS, len(self.active_rois))
+        rois = [self.active_rois[index] for index in np.sort(rng.choice(len(self.active_rois), n_rois,
+                                                                        replace=False))]
+        frame_indices, frames = self.sample_frames(MAX_ITS_N_FRAMES)
+
+        # create temp fitter of the chosen method, without warm start to calibrate on full fits
+        fitter_settings = {'roi_size': self.settings['roi_size'], 'rejection': self.settings['rejection'],
+                           'method': self.settings['method'],
+                           'prescreen_threshold': self.settings.get('prescreen_threshold', None),
+                           'precision_convergence': self.settings.get('precision_convergence', None),
+                           'pixel_integrated': self.settings.get('pixel_integrated', False)}
+        if self.settings['method'] == "Gaussian - Fit bg":
+            fitter_tmp = GaussianBackground(fitter_settings, MAX_ITS_LIMIT, 6, self.roi_offset)
+        else:
+            fitter_tmp = Gaussian(fitter_settings, MAX_ITS_LIMIT, 5, self.roi_offset)
 
-        # for every ROI, find intensity
-        for roi in self.active_rois:
-            my_roi = roi.get_roi(first_frame, 3, self.roi_offset)
-            result, its, success = fitter_tmp.fit_gaussian(my_roi)
-            if result[0] > 0:
-                int_list.append(result[0])
-
-        # fit intensity
-        mu, std = norm.fit(int_list)
-        intensity_list2 = np.asarray(int_list)[int_list < mu]
-        if len(intensity_list2) > 0:
-            mu, std = norm.fit(intensity_list2)
-
-        # set max its depending on mean intensity
-        int_under_which_more_its_are_needed = 3000
-        if mu >= int_under_which_more_its_are_needed:
-            max_its = 100
+        # fit all sampled frames of each sampled ROI, keep iterations of converged fits. Serial on purpose, the sample
+        # takes a fraction of a second and MINPACK calls back into Python each evaluation, so threads wait on the GIL
+        nfev = []
+        n_fits = 0
+        for roi in rois:
+            if roi.in_frame(frames[0].shape, self.roi_offset, fitter_tmp.roi_size_1D):
+                frame_stack = roi.get_frame_stack(frames, fitter_tmp.roi_size_1D, self.roi_offset)
+                roi_result = fitter_tmp.fitter(frame_stack, roi.index, roi.y, roi.x, self.tt_parts[0])
+                nfev.extend(roi_result[~np.isnan(roi_result[:, 7]), 7])
+                n_fits += frame_stack.shape[0]
+
+        # take percentile of converged fits
+        if len(nfev) > 0:
+            max_its = int(min(np.ceil(np.percentile(nfev, MAX_ITS_PERCENTILE)), MAX_ITS_LIMIT))
+            self.settings['max_its_calibration'] = \
+                "{} of {} fits converged ({} ROIs x {} frames). Iterations: median {:.0f}, {}th percentile {}, " \
+                "max {:.0f}".format(len(nfev), n_fits, n_rois, len(frame_indices), np.median(nfev),
+                                    MAX_ITS_PERCENTILE, max_its, np.max(nfev))
         else:
-            max_its = np.ceil((int_under_which_more_its_are_needed - mu) / 1000) * 100 + 100
+            max_its = MAX_ITS_LIMIT
+            self.settings['max_its_calibration'] = "0 of {} fits converged ({} ROIs x {} frames). " \
+                                                   "Limit used".format(n_fits, n_rois, len(frame_indices))
 
-        # final check
-        if max_its > 400:
-            max_its = 400
+        return max_its
 
-        return int(max_its)
+    def sample_frames(self, n_frames):
+        """
+        Reads frames spread evenly over the first TTPart, used for calibration
+        ----------------
+        :param n_frames: number of frames to sample, fewer if the TTPart is shorter
+        :return: frame_indices: indices of sampled frames
+        :return: frames: sampled frames
+        """
+        first_slice = self.tt_parts[0].slice
+        frame_indices = np.unique(np.linspace(first_slice.start, first_slice.stop - 1, n_frames).astype(int))
+        frames = np.asarray([np.asarray(self.frames[frame_index]) for frame_index in frame_indices])
+        return frame_indices, frames
+
+    def calibrate_sigma(self):
+        """
+        Finds the sigma of each ROI for the fixed sigma Gaussian, by fitting a full Gaussian to frames spread over the
+        first TTPart. Adds a calibration report to the settings.
+        ----------------
+        :return: sigmas: dictionary with per ROI index the sigma y and sigma x
+        """
+        frame_indices, frames = self.sample_frames(SIGMA_N_FRAMES)
+        sigmas, report = calibrate_sigmas(frames, self.active_rois, self.roi_offset, self.tt_parts[0], self.settings)
+        self.settings['sigma_calibration'] = report
+        return sigmas
 
     def correlate_tt_parts(self):
         """
@@ -352,6 +572,7 @@ class TimeTrace(Dataset):
                     background = median_filter(new_frame, size=9, mode='constant')
                     new_frame = new_frame.astype(self.data_type_signed) - background
                     # input roi_size as maximum possible drift
+                    # input roi_size as maximum possible drift
                     last_non_nan_offset += np.asarray(self.correlate_frames_same_size(old_frame, new_frame,
                                                                                       range=self.settings['roi_size']))
                     old_frame = new_frame
@@ -372,8 +593,12 @@ class TimeTrace(Dataset):
 
             # find correlation between tt_parts
             self.correlate_tt_parts()
+            if "Phasor" in self.settings['method']:
+                load_fftw_wisdom()
             # run
-            if len(self.tt_parts) > 1:
+            if self.settings.get('live', False):
+                self.run_live()
+            elif len(self.tt_parts) > 1:
                 if self.n_cores > 1:
                     self.tt_parts_done = 0
                     tt_parts_created = 0
@@ -415,9 +640,13 @@ class TimeTrace(Dataset):
                 # merge data
                 self.experiment.progress_updater.message("Finalizing data")
                 self.merge_data(dicts_list)
+                self.collect_counters(dicts_list)
             else:
                 self.tt_parts[0].run(self.fitter, self.active_rois, dataset=self)
                 self.experiment.progress_updater.message("Finalizing data")
+                self.collect_counters()
+            if "Phasor" in self.settings['method']:
+                save_fftw_wisdom()
 
             # set to nm if desired
             if self.settings['pixels_or_nm'] == "nm":
@@ -433,9 +662,53 @@ class TimeTrace(Dataset):
 
             # correct for drift
             self.experiment.progress_updater.message("Starting drift correction")
-            self.drift_corrector = DriftCorrector(self.settings['method'])
+            self.drift_corrector = DriftCorrector(self.settings['method'], dtype=self.fitter.dtype)
             self.drift_corrector.main(self.active_rois, self.name_result, len(self.time_axis))
 
+    def run_live(self, publish=None):
+        """
+        Live run of TT. Fits frames while they are being acquired, until the last frame set, until no new frames come
+        in, or until stop_live is called. Starts at the first frame set and uses the ROIs and offset that are already
+        set.
+        ----------------------
+        :param publish: function called with the frame numbers and a dictionary of new results per ROI index
+        :return: None. Edits results in experiment
+        """
+        if self.settings.get('live_source', None) is None:
+            source = ND2FrameSource(self.filename)
+        else:
+            source = DirectoryFrameSource(self.settings['live_source'])
+
+        def publish_and_report(frame_numbers, new_results):
+            self.experiment.progress_updater.message("Live: {} frames done".format(self.live_tracker.frames_done))
+            if publish is not None:
+                publish(frame_numbers, new_results)
+
+        # last frame set by user, if any. The part itself stops at the frames that were there at the start
+        frame_stop = self.parse_start_end(self.settings['frame_begin'], self.settings['frame_end'])[0].stop
+
+        self.live_tracker = LiveTracker(self.fitter, self.active_rois, self.tt_parts[0], publish=publish_and_report)
+        self.live_tracker.run(source, poll_interval=self.settings.get('live_poll_interval', LIVE_POLL_INTERVAL),
+                              idle_timeout=self.settings.get('live_idle_timeout', LIVE_IDLE_TIMEOUT),
+                              frame_stop=frame_stop)
+
+        self.experiment.progress_updater.message("Finalizing data")
+        for roi, roi_result, roi_raw in self.live_tracker.results():
+            roi.results[self.name_result] = {"type": 'TT', "result": roi_result, "raw": roi_raw}
+        # number of frames is only known now
+        self.time_axis = np.arange(self.tt_parts[0].frame_start,
+                                   self.tt_parts[0].frame_start + self.live_tracker.frames_done)
+        self.time_axis_dim = 'frames'
+
+    def stop_live(self):
+        """
+        Stops a live run after the current batch, results so far are kept. Can be called from another thread
+        ----------------------
+        :return: None. Edits class
+        """
+        if self.live_tracker is not None:
+            self.live_tracker.stop()
+
     def merge_data(self, dicts_list):
         """
         Merges the data in the case that a TT Dataset was split in TTParts
@@ -447,7 +720,7 @@ class TimeTrace(Dataset):
 
         for roi in self.active_rois:
             roi_result = np.zeros((self.tt_parts[-1].slice.stop - self.tt_parts[0].frame_start,
-                                   dicts_list[0]["{}".format(roi.index)]['result'].shape[1]))
+                                   dicts_list[0]["{}".format(roi.index)]['result'].shape[1]), dtype=self.fitter.dtype)
             roi_raw = np.zeros((self.tt_parts[-1].slice.stop - self.tt_parts[0].frame_start,
                                 self.fitter.roi_size, self.fitter.roi_size), dtype=self.data_type)
             counter = 0
@@ -465,6 +738,24 @@ class TimeTrace(Dataset):
 
             roi.results[self.name_result] = {"type": 'TT', "result": roi_result, "raw": roi_raw}
 
+    def collect_counters(self, dicts_list=None):
+        """
+        Collects how often each fitting path was taken and adds it to the settings
+        ----------------------
+        :param dicts_list: dictionaries that hold the results of the split TTParts. If None, takes counters of fitter
+        :return: None. Edits settings
+        """
+        if dicts_list is None:
+            counters = dict(self.fitter.counters)
+        else:
+            counters = {}
+            for tt_part_dict in dicts_list:
+                for key, value in tt_part_dict.get("counters", {}).items():
+                    counters[key] = counters.get(key, 0) + value
+
+        if len(counters) > 0:
+            self.settings['fit_counters'] = counters
+
     def mp_create_process(self, tt_part, shared_dict, q):
         """
         Called by threads to start a process, monitors it, and joins it at the end
@@ -491,6 +782,12 @@ class TimeTrace(Dataset):
         :param q: The queue to place updates in
         :return: None, changes the shared_dict
         """
+        if "Phasor" in fitter.__name__:
+            load_fftw_wisdom()
+        if fitter.frame_major:
+            fitter.run_frame_major(ND2ReaderSelf(tt_part.name)[tt_part.slice], rois, tt_part, q=q,
+                                   res_dict=shared_dict)
+            return
         # load in slice of video
         full_frame_stack = np.asarray(ND2ReaderSelf(tt_part.name)[tt_part.slice])
         # create frame stacks of each ROIs
@@ -506,6 +803,8 @@ class TimeTrace(Dataset):
         del full_frame_stack
         # run
         fitter.run(frame_stacks, rois, tt_part, q=q, res_dict=shared_dict)
+        if "Phasor" in fitter.__name__:
+            save_fftw_wisdom()
 
 # %% TT Part
 
@@ -541,6 +840,10 @@ class TTPart:
         :param dataset: Information of the dataset. Used when single process used.
         :return: None. Changes the res_dict or the ROIs
         """
+        if fitter.frame_major:
+            fitter.run_frame_major(ND2ReaderSelf(self.name)[self.slice], rois, self, res_dict=res_dict,
+                                   dataset=dataset)
+            return
         # load in slice of video
         full_frame_stack = np.asarray(ND2ReaderSelf(self.name)[self.slice])
         # create frame stacks of each ROIs
@@ -569,8 +872,72 @@ class BaseFitter:
         self.roi_size_1D = int((self.roi_size - 1) / 2)
         self.__name__ = settings['method']
         self.rejection = settings['rejection']
+        # single precision halves memory of results, off by default
+        self.dtype = np.float32 if settings.get('single_precision', False) else np.float64
+        # frame-major fitting streams frames and fits all ROIs of a frame together, only Phasor supports it
+        self.frame_major = False
 
         self.roi_offset = roi_offset
+        # counts how often each fitting path is taken, reported in settings
+        self.counters = {}
+
+    def reset_counters(self):
+        """
+        Sets all counters of fitting paths back to zero
+        -------------------------------
+        :return: None. Edits class
+        """
+        self.counters = dict.fromkeys(self.counters, 0)
+
+    def stack_bg(self, frame_stack):
+        """
+        Background of each frame of a stack, same pixels as fun_calc_bg. One FORTRAN call for the entire stack if the
+        kernels are compiled, NumPy otherwise.
+        -------------------------------
+        :param frame_stack: stack of frames of a single ROI, or patches of many ROIs
+        :return: background per frame
+        """
+        if STACK_KERNELS:
+            return fortran_tools.calc_bg_stack(frame_stack.T)
+        # like CALC_BG7/9 the inner pixels of the first and last column count twice, first and last row are not used
+        return (frame_stack[:, :, [0, -1]].sum(axis=(1, 2), dtype=np.float64) +
+                frame_stack[:, 1:-1, [0, -1]].sum(axis=(1, 2), dtype=np.float64)) / (4 * self.roi_size - 4)
+
+    def stack_max(self, frame_stack):
+        """
+        Maximum of each frame of a stack. One FORTRAN call for the entire stack if the kernels are compiled, NumPy
+        otherwise.
+        -------------------------------
+        :param frame_stack: stack of frames of a single ROI, or patches of many ROIs
+        :return: maximum per frame
+        """
+        if STACK_KERNELS:
+            return fortran_tools.max_stack(frame_stack.T)
+        return frame_stack.max(axis=(1, 2)).astype(np.float64)
+
+    def stack_min(self, frame_stack):
+        """
+        Minimum of each frame of a stack. One FORTRAN call for the entire stack if the kernels are compiled, NumPy
+        otherwise.
+        -------------------------------
+        :param frame_stack: stack of frames of a single ROI, or patches of many ROIs
+        :return: minimum per frame
+        """
+        if STACK_KERNELS:
+            return fortran_tools.min_stack(frame_stack.T)
+        return frame_stack.min(axis=(1, 2)).astype(np.float64)
+
+    def stack_sum(self, frame_stack):
+        """
+        Sum of each frame of a stack. One FORTRAN call for the entire stack if the kernels are compiled, NumPy
+        otherwise.
+        -------------------------------
+        :param frame_stack: stack of frames of a single ROI, or patches of many ROIs
+        :return: sum per frame
+        """
+        if STACK_KERNELS:
+            return fortran_tools.sum_stack(frame_stack.T)
+        return frame_stack.sum(axis=(1, 2), dtype=np.float64)
 
     def fitter(self, frame_stack, roi_index, y, x, tt_part):
         """
@@ -599,6 +966,7 @@ class BaseFitter:
         """
         if res_dict is not None:
             res_dict["start_frame"] = tt_part.frame_start
+        self.reset_counters()
 
         for frame_stack, roi in zip(frame_stacks, rois):
             if frame_stack is not None:
@@ -617,6 +985,9 @@ class BaseFitter:
             else:
                 q.put(1)
 
+        if res_dict is not None:
+            res_dict["counters"] = dict(self.counters)
+
 # %% Gaussian fitter with estimated background
 
 
@@ -675,6 +1046,21 @@ class Gaussian(BaseFitter):
 
         self.max_its = max_its
 
+        # warm start from last successful fit and reuse of near-identical frames, both off by default
+        self.warm_start = settings.get('warm_start', False)
+        self.warm_start_tolerance = settings.get('warm_start_tolerance', 0.5)
+        self.reuse_tolerance = settings.get('reuse_tolerance', None)
+        self.last_params = None
+        self.last_roi = None
+        # frames with a peak-to-noise ratio below this threshold are not fitted, off by default
+        self.prescreen_threshold = settings.get('prescreen_threshold', None)
+        # stop once position and intensity steps are below [position (px), intensity (%)], off by default
+        self.precision_convergence = settings.get('precision_convergence', None)
+        # Gaussian integrated over each pixel instead of sampled at pixel centers, off by default
+        self.pixel_integrated = settings.get('pixel_integrated', False)
+        self.pixel_edges = np.arange(self.roi_size + 1, dtype=np.float64) - 0.5
+        self.counters = {'cold_start': 0, 'warm_start': 0, 'warm_start_fallback': 0, 'reused': 0, 'prescreened': 0}
+
     def fun_find_max(self, roi):
         """
         Input ROI, returns max using FORTRAN
@@ -729,6 +1115,27 @@ class Gaussian(BaseFitter):
         elif self.roi_size == 7:
             return fortran_tools.calc_bg7(roi)
 
+    def prescreen(self, frame_stack):
+        """
+        Cheap vectorised check which frames of a stack contain signal. Divides the peak above the background (mean of
+        edge pixels) by the noise (standard deviation of edge pixels). Frames below the prescreen threshold are not
+        fitted.
+        -------------------------------
+        :param frame_stack: frame stack of a single ROI
+        :return: candidates: boolean per frame whether or not it should be fitted
+        """
+        if self.prescreen_threshold is None:
+            return np.ones(frame_stack.shape[0], dtype=bool)
+
+        frame_stack = frame_stack.astype(float)
+        edges = np.concatenate((frame_stack[:, 0, :], frame_stack[:, -1, :],
+                                frame_stack[:, 1:-1, 0], frame_stack[:, 1:-1, -1]), axis=1)
+        background = np.mean(edges, axis=1)
+        noise = np.maximum(np.std(edges, axis=1), 1)  # at least one count to prevent dividing by zero
+        peak = np.max(frame_stack, axis=(1, 2)) - background
+
+        return peak / noise >= self.prescreen_threshold
+
     def fun_norm(self, g):
         """
         Input 5 or 6 long array, returns norm using FORTRAN
@@ -761,6 +1168,8 @@ class Gaussian(BaseFitter):
         Difference between created 2D Gaussian and data
 
         """
+        if self.pixel_integrated:
+            return self.fun_gaussian_integrated(x, data)
         if self.num_fit_params == 5 and self.roi_size == 9:
             return fortran_linalg.gaussian(*x, self.roi_size, data)
         elif self.num_fit_params == 5 and self.roi_size == 7:
@@ -770,9 +1179,67 @@ class Gaussian(BaseFitter):
         elif self.num_fit_params == 6 and self.roi_size == 7:
             return fortran_linalg.gs_bg7(*x, self.roi_size, data)
 
+    def fun_gaussian_integrated(self, x, data):
+        """
+        Creates a Gaussian integrated over each pixel with parameters x, returns difference between that and data.
+        The height is that of the Gaussian before integration, so the integrated intensity and the sigmas are the same
+        as those of the model sampled at pixel centers.
+
+        Parameters
+        ----------
+        x : Parameters of Gaussian
+        data : ROI pixel values to be subtracted from created Gaussian
+
+        Returns
+        -------
+        Difference between created 2D Gaussian and data
+
+        """
+        scale = np.sqrt(2) * np.maximum(np.abs(x[3:5]), EPS)
+        # erf itself, on this few points the table lookup of the batched fitter costs more than it saves
+        profiles = np.diff(erf((self.pixel_edges[None, :] - x[1:3, None]) / scale[:, None]), axis=1)
+        # fraction of the Gaussian in each pixel times its total, 2 pi sigma_x sigma_y height
+        gaussian = x[0] * pi / 4 * scale[0] * scale[1] * profiles[0][:, None] * profiles[1][None, :]
+        if self.num_fit_params == 6:
+            gaussian += x[5]
+        return (gaussian - data).ravel()
+
+    def fun_jacobian_integrated(self, x):
+        """
+        Analytic jacobian of the pixel-integrated Gaussian. Each profile is a difference of erf at the pixel edges, so
+        its derivatives are differences of Gaussians at the pixel edges. One row per parameter, as MINPACK takes it
+        with col_deriv.
+
+        Parameters
+        ----------
+        x : Parameters of Gaussian
+
+        Returns
+        -------
+        Jacobian, transposed
+
+        """
+        scale = np.sqrt(2) * np.maximum(np.abs(x[3:5]), EPS)
+        edges = (self.pixel_edges[None, :] - x[1:3, None]) / scale[:, None]
+        values = erf(edges)
+        gaussians = 2 / np.sqrt(pi) * np.exp(-edges ** 2)
+        profiles = values[:, 1:] - values[:, :-1]
+        # profile times its scale, and its derivatives to center and sigma. Sign of sigma as the model uses abs
+        scaled = scale[:, None] * profiles
+        d_center = gaussians[:, :-1] - gaussians[:, 1:]
+        d_sigma = np.where(x[3:5] < 0, -np.sqrt(2), np.sqrt(2))[:, None] * \
+            (profiles - (gaussians * edges)[:, 1:] + (gaussians * edges)[:, :-1])
+        # each row of the jacobian is an outer product of a factor along x and along y
+        along_x = np.stack((scaled[0], d_center[0], scaled[0], d_sigma[0], scaled[0]))
+        along_y = np.stack((scaled[1], scaled[1], d_center[1], scaled[1], d_sigma[1]))
+        jacobian = np.ones((self.num_fit_params, self.roi_size ** 2))
+        jacobian[:5] = (along_x[:, :, None] * along_y[:, None, :]).reshape(5, -1) * (pi / 4)
+        jacobian[1:5] *= x[0]
+        return jacobian
+
     def fun_jacobian(self, x0, data):
         """
-        Generated jacobian using FORTRAN
+        Generated jacobian using FORTRAN, or analytic jacobian of the pixel-integrated model
 
         Parameters
         ----------
@@ -784,6 +1251,8 @@ class Gaussian(BaseFitter):
         Jacobian
 
         """
+        if self.pixel_integrated:
+            return self.fun_jacobian_integrated(x0).T
         if self.num_fit_params == 5 and self.roi_size == 9:
             return fortran_linalg.dense_dif(x0, self.rel_step, self.comp,
                                             self.num_fit_params, self.roi_size, data)
@@ -826,9 +1295,17 @@ class Gaussian(BaseFitter):
         if max_nfev is None:
             # n squared to account for Jacobian evaluations.
             max_nfev = 100 * n * (n + 1)
-        x, info, status = _minpack._lmdif(
-            fun, x0, (), full_output, ftol, xtol, gtol,
-            max_nfev, epsfcn, factor, diag)
+        if self.pixel_integrated:
+            # analytic jacobian. Budget and count in evaluations as for finite differences, a jacobian counts as n
+            col_deriv = True
+            x, info, status = _minpack._lmder(
+                fun, self.fun_jacobian_integrated, x0, (), full_output, col_deriv, ftol, xtol, gtol,
+                max(max_nfev // (n + 1), 1), factor, diag)
+            info['nfev'] += n * info['njev']
+        else:
+            x, info, status = _minpack._lmdif(
+                fun, x0, (), full_output, ftol, xtol, gtol,
+                max_nfev, epsfcn, factor, diag)
 
         f = info['fvec']
 
@@ -890,14 +1367,55 @@ class Gaussian(BaseFitter):
         if f0.ndim != 1:
             raise ValueError("`fun` must return at most 1-d array_like.")
 
-        result = self.call_minpack(fun_wrapped, x0, data, ftol, xtol, gtol,
-                                   max_nfev, self.x_scale)
+        if max_nfev is None:
+            max_nfev = 100 * x0.size * (x0.size + 1)
+
+        if self.precision_convergence is not None:
+            # particles meet the precision criteria in a few iterations. Other fits restart from the initial guess
+            # with the default criteria, so noise that would not converge is still rejected
+            diag, precision_xtol = self.precision_scale(x0)
+            result = self.call_minpack(fun_wrapped, x0.copy(), data, ftol, precision_xtol, gtol,
+                                       min(PRECISION_ITERATIONS * (x0.size + 1), max_nfev), diag)
+            if result.status <= 0 and result.nfev < max_nfev:
+                nfev_precision = result.nfev
+                result = self.call_minpack(fun_wrapped, x0, data, ftol, xtol, gtol,
+                                           max_nfev, self.x_scale)
+                result.nfev += nfev_precision
+        else:
+            result = self.call_minpack(fun_wrapped, x0, data, ftol, xtol, gtol,
+                                       max_nfev, self.x_scale)
 
         result.message = TERMINATION_MESSAGES[result.status]
         result.success = result.status > 0
 
         return result
 
+    def precision_scale(self, x0):
+        """
+        Scaling and xtol for MINPACK that turn its step test into the precision convergence criteria. Each parameter
+        is scaled by its tolerance: position and sigma by the position tolerance, height and background by the
+        intensity tolerance relative to the initial guess. MINPACK stops when its scaled step bound drops below
+        xtol times the Euclidean norm of the scaled parameters, so xtol is set to make that bound one tolerance.
+
+        Parameters
+        ----------
+        x0 : initial parameters
+
+        Returns
+        -------
+        diag : scaling of each parameter
+        xtol : parameter tolerance
+
+        """
+        position_tolerance, intensity_tolerance = self.precision_convergence
+        diag = np.full(self.num_fit_params, 1 / position_tolerance)
+        diag[0] = 1 / max(abs(x0[0]) * intensity_tolerance / 100, EPS)
+        if self.num_fit_params == 6:
+            diag[5] = 1 / max(abs(x0[5]) * intensity_tolerance / 100, EPS)
+        xtol = 1 / max(np.linalg.norm(diag * x0), 1)
+
+        return diag, xtol
+
     def phasor_fit(self, data):
         """
         Does Phasor fit to estimate parameters using FORTRAN
@@ -933,13 +1451,15 @@ class Gaussian(BaseFitter):
 
         return pos_x, pos_y
 
-    def phasor_guess(self, data):
+    def phasor_guess(self, data, background=None, minimum=None):
         """
         Returns an initial guess based on phasor fitting
 
         Parameters
         ----------
         data : ROI pixel values
+        background : not used, background is already subtracted
+        minimum : optional minimum of data, if already known
 
         Returns
         -------
@@ -947,33 +1467,85 @@ class Gaussian(BaseFitter):
 
         """
         pos_x, pos_y = self.phasor_fit(data)
-        height = data[int(pos_y), int(pos_x)] - self.fun_find_min(data)
+        if minimum is None:
+            minimum = self.fun_find_min(data)
+        height = data[int(pos_y), int(pos_x)] - minimum
 
         return np.array([height, pos_y, pos_x, self.init_sig, self.init_sig])
 
-    def fit_gaussian(self, data):
+    def fit_gaussian(self, data, background=None, minimum=None):
         """
-        Gathers parameter estimate and calls fit.
+        Gathers parameter estimate and calls fit. If warm start is enabled, first fits starting from the last
+        successful result, for at most WARM_START_ITERATIONS iterations. If that fails or ends further than the warm
+        start tolerance from the phasor guess of this frame, falls back to the phasor guess.
 
         Parameters
         ----------
         data : ROI pixel values
+        background : optional background of data, if already known
+        minimum : optional minimum of data, if already known
 
         Returns
         -------
         p.x: solution of parameters
-        p.nfev: number of iterations
+        p.nfev: number of iterations, of both attempts after a warm start fallback
         p.success: success or failure
 
         """
-        if self.params[0] == 0:
-            params = self.phasor_guess(data)
-        else:
-            params = self.phasor_guess(data)
+        params = self.phasor_guess(data, background=background, minimum=minimum)
+        its_warm = 0
+        # only try a warm start if the phasor guess agrees with the last result, otherwise the frame changed
+        if self.warm_start and self.last_params is not None and \
+                np.all(np.abs(self.last_params[1:3] - params[1:3]) <= self.warm_start_tolerance):
+            # a good warm start converges in a few iterations, so a fallback costs little. MINPACK counts the
+            # function evaluations of its finite difference jacobian as well
+            p = self.least_squares(np.array(self.last_params, dtype=float), data,
+                                   max_nfev=min(WARM_START_ITERATIONS * (self.num_fit_params + 1), self.max_its))
+            # compare to phasor guess of this frame, so a bad fit cannot be carried on from frame to frame
+            _, _, _, _, sig_max, sig_min = self.define_fitter_bounds()
+            if p.success and p.x[0] > 0 and \
+                    np.all(np.abs(p.x[1:3] - params[1:3]) <= self.warm_start_tolerance) and \
+                    np.all(p.x[3:5] > sig_min) and np.all(p.x[3:5] <= sig_max):
+                self.counters['warm_start'] += 1
+                return [p.x, p.nfev, p.success]
+            # warm start did not work out, count iterations and start over
+            self.counters['warm_start_fallback'] += 1
+            its_warm = p.nfev
+
+        if self.params[0] != 0:
             params[3:5] = self.params[:]
         p = self.least_squares(params, data, max_nfev=self.max_its)  # , ftol=1e-10, xtol=1e-10, gtol=1e-10)
+        self.counters['cold_start'] += 1
 
-        return [p.x, p.nfev, p.success]
+        return [p.x, p.nfev + its_warm, p.success]
+
+    def reset_history(self):
+        """
+        Forgets the previous frame. Called at the start of each ROI
+        -------------------------------
+        :return: None. Edits class
+        """
+        self.params = np.zeros(2)
+        self.last_params = None
+        self.last_roi = None
+
+    def reuse_previous(self, data):
+        """
+        Checks if a ROI is near-identical to the ROI of the last fitted frame, in which case that result can be reused.
+        Near-identical means that no pixel differs more than the reuse tolerance times the peak-to-peak value.
+        -------------------------------
+        :param data: ROI pixel values
+        :return: reuse: whether or not the previous result can be reused
+        """
+        if self.reuse_tolerance is None:
+            return False
+        data = data.astype(float)
+        if self.last_roi is not None and \
+                np.max(np.abs(data - self.last_roi)) <= self.reuse_tolerance * np.ptp(self.last_roi):
+            self.counters['reused'] += 1
+            return True
+        self.last_roi = data
+        return False
 
     def define_fitter_bounds(self):
         """
@@ -1011,17 +1583,36 @@ class Gaussian(BaseFitter):
         """
         pos_max, pos_min, int_max, int_min, sig_max, sig_min = self.define_fitter_bounds()
 
-        self.params = np.zeros(2)
-        roi_result = np.zeros([frame_stack.shape[0], 8])
-
-        for frame_index, my_roi in enumerate(frame_stack):
-            my_roi_bg = self.fun_calc_bg(my_roi)
+        self.reset_history()
+        # all frames start as NaN, only the candidates of the prescreen are fitted
+        roi_result = np.full([frame_stack.shape[0], 8], np.nan, dtype=self.dtype)
+        roi_result[:, 0] = np.arange(frame_stack.shape[0]) + tt_part.frame_start
+        candidates = np.flatnonzero(self.prescreen(frame_stack))
+        self.counters['prescreened'] += frame_stack.shape[0] - len(candidates)
+        previous_index = None
+        # background and minimum of all frames in one go
+        backgrounds = self.stack_bg(frame_stack)
+        minima = self.stack_min(frame_stack) - backgrounds
+
+        for frame_index in candidates:
+            my_roi = frame_stack[frame_index]
+            # if nearly the same as last fitted frame, take that result
+            if self.reuse_previous(my_roi):
+                roi_result[frame_index, 1:] = roi_result[previous_index, 1:]
+                previous_index = frame_index
+                continue
+            # warm start only from the frame right before, a frame left out by the prescreen had no particle
+            if previous_index is not None and frame_index != previous_index + 1:
+                self.last_params = None
+            previous_index = frame_index
+            my_roi_bg = backgrounds[frame_index]
             my_roi = my_roi - my_roi_bg
-            result, its, success = self.fit_gaussian(my_roi)
+            result, its, success = self.fit_gaussian(my_roi, minimum=minima[frame_index])
 
             if self.rejection is False:
                 if success == 0 or result[0] == 0:
                     self.params = [self.init_sig, self.init_sig]
+                    self.last_params = None
                     success = 0
             else:
                 if success == 0 or \
@@ -1029,11 +1620,12 @@ class Gaussian(BaseFitter):
                         result[0] <= int_min or result[0] > int_max or \
                         result[3] < sig_min or result[3] > sig_max or result[4] < sig_min or result[4] > sig_max:
                     self.params = [self.init_sig, self.init_sig]
+                    self.last_params = None
                     success = 0
 
             if success == 1:
                 self.params = result[3:5]
-                roi_result[frame_index, 0] = frame_index + tt_part.frame_start
+                self.last_params = result
                 # start position plus from center in ROI + half for indexing of pixels
                 roi_result[frame_index, 1] = result[1] + y - self.roi_size_1D + 0.5 + tt_part.offset_from_base[0]  # y
                 roi_result[frame_index, 2] = result[2] + x - self.roi_size_1D + 0.5 + tt_part.offset_from_base[1]  # x
@@ -1042,9 +1634,6 @@ class Gaussian(BaseFitter):
                 roi_result[frame_index, 5] = result[4]  # sigma x
                 roi_result[frame_index, 6] = my_roi_bg
                 roi_result[frame_index, 7] = its
-            else:
-                roi_result[frame_index, :] = np.nan
-                roi_result[frame_index, 0] = frame_index + tt_part.frame_start
 
         return roi_result
 
@@ -1056,13 +1645,15 @@ class GaussianBackground(Gaussian):
     """
     Gaussian fitter with fitted background, build upon Scipy Optimize Least-Squares
     """
-    def phasor_guess(self, data):
+    def phasor_guess(self, data, background=None, minimum=None):
         """
         Returns an initial guess based on phasor fitting
 
         Parameters
         ----------
         data : ROI pixel values
+        background : optional background of data, if already known
+        minimum : not used, background is used instead
 
         Returns
         -------
@@ -1070,7 +1661,8 @@ class GaussianBackground(Gaussian):
 
         """
         pos_x, pos_y = self.phasor_fit(data)
-        background = self.fun_calc_bg(data)
+        if background is None:
+            background = self.fun_calc_bg(data)
         height = data[int(pos_y), int(pos_x)] - background
 
         return np.array([height, pos_y, pos_x, self.init_sig, self.init_sig, background])
@@ -1087,15 +1679,33 @@ class GaussianBackground(Gaussian):
         :return: roi results
         """
         pos_max, pos_min, int_max, int_min, sig_max, sig_min = self.define_fitter_bounds()
-        self.params = np.zeros(2)
-        roi_result = np.zeros([frame_stack.shape[0], 8])
-
-        for frame_index, my_roi in enumerate(frame_stack):
-            result, its, success = self.fit_gaussian(my_roi)
+        self.reset_history()
+        # all frames start as NaN, only the candidates of the prescreen are fitted
+        roi_result = np.full([frame_stack.shape[0], 8], np.nan, dtype=self.dtype)
+        roi_result[:, 0] = np.arange(frame_stack.shape[0]) + tt_part.frame_start
+        candidates = np.flatnonzero(self.prescreen(frame_stack))
+        self.counters['prescreened'] += frame_stack.shape[0] - len(candidates)
+        previous_index = None
+        # background guess of all frames in one go
+        backgrounds = self.stack_bg(frame_stack)
+
+        for frame_index in candidates:
+            my_roi = frame_stack[frame_index]
+            # if nearly the same as last fitted frame, take that result
+            if self.reuse_previous(my_roi):
+                roi_result[frame_index, 1:] = roi_result[previous_index, 1:]
+                previous_index = frame_index
+                continue
+            # warm start only from the frame right before, a frame left out by the prescreen had no particle
+            if previous_index is not None and frame_index != previous_index + 1:
+                self.last_params = None
+            previous_index = frame_index
+            result, its, success = self.fit_gaussian(my_roi, background=backgrounds[frame_index])
 
             if self.rejection is False:
                 if success == 0 or result[0] == 0:
                     self.params = [self.init_sig, self.init_sig]
+                    self.last_params = None
                     success = 0
             else:
                 if success == 0 or \
@@ -1103,12 +1713,13 @@ class GaussianBackground(Gaussian):
                         result[0] <= int_min or result[0] > int_max or \
                         result[3] < sig_min or result[3] > sig_max or result[4] < sig_min or result[4] > sig_max:
                     self.params = [self.init_sig, self.init_sig]
+                    self.last_params = None
                     success = 0
 
             if success == 1:
                 self.params = result[3:5]
+                self.last_params = result
 
-                roi_result[frame_index, 0] = frame_index + tt_part.frame_start
                 # start position plus from center in ROI + half for indexing of pixels
                 roi_result[frame_index, 1] = result[1] + y - self.roi_size_1D + 0.5 + tt_part.offset_from_base[0]  # y
                 roi_result[frame_index, 2] = result[2] + x - self.roi_size_1D + 0.5 + tt_part.offset_from_base[1]  # x
@@ -1117,207 +1728,697 @@ class GaussianBackground(Gaussian):
                 roi_result[frame_index, 5] = result[4]  # sigma x
                 roi_result[frame_index, 6] = result[5]  # background
                 roi_result[frame_index, 7] = its
-            else:
-                roi_result[frame_index, :] = np.nan
-                roi_result[frame_index, 0] = frame_index
 
         return roi_result
 
-# %% Phasor for ROI loops
+# %% Batched Levenberg-Marquardt
 
 
-class Phasor(BaseFitter):
+def levenberg_marquardt_batch(model_jacobian, params, data, max_its, step_converged=None, bounds=None):
     """
-    Phasor fitting using Fourier Transform. Also returns intensity of pixel in which Phasor position is found.
+    Levenberg-Marquardt for many small, independent least-squares fits at once, one fit per row. Every iteration is a
+    handful of array operations for all fits that are still running, instead of one MINPACK call per fit.
+    ----------------
+    :param model_jacobian: function of parameters (fits, params) and the row of each fit, returns model (fits, pixels)
+    and analytic jacobian (fits, pixels, params)
+    :param params: initial parameters, (fits, params)
+    :param data: data to fit to, (fits, pixels)
+    :param max_its: maximum number of function evaluations per fit
+    :param step_converged: optional function of step and new parameters that returns per fit whether it converged.
+    Default is a relative step smaller than LM_XTOL
+    :param bounds: optional lower and upper bound of each parameter, two arrays of length params. Steps are
+    projected onto the bounds
+    :return: params: solution of parameters
+    :return: nfev: number of function evaluations per fit
+    :return: success: boolean per fit if converged
     """
-    def fun_find_max(self, roi):
+    params = np.array(params, dtype=np.float64)
+    data = np.asarray(data, dtype=np.float64)
+    n_fits, n_params = params.shape
+    nfev = np.ones(n_fits, dtype=int)
+    success = np.zeros(n_fits, dtype=bool)
+    damping = np.full(n_fits, LM_DAMPING_START)
+    identity = np.eye(n_params)
+
+    # residual and jacobian are only kept for fits that are still running
+    active = np.arange(n_fits)
+    model, jac = model_jacobian(params, active)
+    residual = data - model
+    cost = np.einsum('ij,ij->i', residual, residual)
+    while active.size > 0:
+        # normal equations, damping scaled by the diagonal (Marquardt)
+        jac_t = jac.transpose(0, 2, 1)
+        jtj = jac_t @ jac
+        jtr = (jac_t @ residual[:, :, None])[:, :, 0]
+        scale = np.maximum(np.einsum('nkk->nk', jtj), EPS)
+        step = np.linalg.solve(jtj + damping[active, None, None] * scale[:, :, None] * identity,
+                               jtr[:, :, None])[:, :, 0]
+        trial = params[active] + step
+        if bounds is not None:
+            trial = np.clip(trial, *bounds)
+            step = trial - params[active]
+
+        model_trial, jac_trial = model_jacobian(trial, active)
+        nfev[active] += 1
+        residual_trial = data[active] - model_trial
+        cost_trial = np.einsum('ij,ij->i', residual_trial, residual_trial)
+
+        better = cost_trial < cost[active]
+        if step_converged is None:
+            small_step = np.linalg.norm(step, axis=1) <= LM_XTOL * (np.linalg.norm(trial, axis=1) + LM_XTOL)
+        else:
+            small_step = step_converged(step, trial)
+        converged = small_step | (better & (cost[active] - cost_trial <= LM_FTOL * cost[active]))
+
+        # take better steps and trust the quadratic model more, otherwise damp more
+        params[active[better]] = trial[better]
+        cost[active[better]] = cost_trial[better]
+        residual[better] = residual_trial[better]
+        jac[better] = jac_trial[better]
+        damping[active[better]] = np.maximum(damping[active[better]] / 10, LM_DAMPING_MIN)
+        damping[active[~better]] *= 10
+
+        # no step lowers the cost anymore, at a minimum
+        converged |= damping[active] > LM_DAMPING_MAX
+        success[active[converged]] = True
+        running = ~converged & (nfev[active] < max_its)
+        active = active[running]
+        residual = residual[running]
+        jac = jac[running]
+
+    return params, nfev, success
+
+
+def calibrate_sigmas(frames, rois, roi_offset, tt_part, settings):
+    """
+    Finds the sigma of each ROI as the median of full Gaussian fits (background fitted) to a few frames. ROIs without
+    any successful fit get the median of the other ROIs.
+    ----------------
+    :param frames: frames to fit
+    :param rois: ROIs to calibrate
+    :param roi_offset: offset of ROIs in dataset
+    :param tt_part: information about which part of the TT the frames are from
+    :param settings: settings of dataset, for roi_size and prescreen_threshold
+    :return: sigmas: dictionary with per ROI index the sigma y and sigma x
+    :return: report: calibration report for the settings
+    """
+    fitter_settings = {'roi_size': settings['roi_size'], 'rejection': True, 'method': "Gaussian - Fit bg",
+                       'prescreen_threshold': settings.get('prescreen_threshold', None)}
+    fitter_tmp = GaussianBackground(fitter_settings, MAX_ITS_LIMIT, 6, roi_offset)
+
+    sigmas = {}
+    for roi in rois:
+        if roi.in_frame(frames[0].shape, roi_offset, fitter_tmp.roi_size_1D):
+            frame_stack = roi.get_frame_stack(frames, fitter_tmp.roi_size_1D, roi_offset)
+            roi_result = fitter_tmp.fitter(frame_stack, roi.index, roi.y, roi.x, tt_part)
+            fitted = roi_result[~np.isnan(roi_result[:, 4]), 4:6]
+            if fitted.shape[0] > 0:
+                sigmas[roi.index] = np.median(fitted, axis=0)
+
+    n_calibrated = len(sigmas)
+    if n_calibrated > 0:
+        fallback = np.median(np.asarray(list(sigmas.values())), axis=0)
+    else:
+        fallback = np.array([INIT_SIGMA, INIT_SIGMA])
+    for roi in rois:
+        sigmas.setdefault(roi.index, fallback)
+
+    report = "{} of {} ROIs calibrated on {} frames, others take the median. Median sigma y {:.3f}, " \
+             "sigma x {:.3f}".format(n_calibrated, len(rois), frames.shape[0], fallback[0], fallback[1])
+    return sigmas, report
+
+# %% Gaussian fitter with fixed sigma
+
+
+class GaussianFixedSigma(BaseFitter):
+    """
+    Gaussian fitter with a fixed sigma per ROI. Fits height, position and optionally background of all frames of a
+    ROI at once with a batched Levenberg-Marquardt and analytic derivatives.
+    """
+    def __init__(self, settings, max_its, sigmas, roi_offset):
         """
-        Input ROI, returns max using FORTRAN
+        Initializer of fixed sigma Gaussian fitter
+        ----------
+        :param settings: Fitting settings
+        :param max_its: number of iterations limit
+        :param sigmas: dictionary with per ROI index the sigma y and sigma x, from calibrate_sigmas
+        :param roi_offset: offset of ROIs in dataset
+        """
+        super().__init__(settings, roi_offset)
+        self.max_its = max_its
+        self.sigmas = sigmas
+        if len(sigmas) > 0:
+            self.default_sigma = np.median(np.asarray(list(sigmas.values())), axis=0)
+        else:
+            self.default_sigma = np.array([INIT_SIGMA, INIT_SIGMA])
+        # fit background or subtract estimate, fit by default
+        self.fit_bg = settings.get('fixed_sigma_fit_bg', True)
+        # Gaussian integrated over each pixel instead of sampled at pixel centers, off by default
+        self.pixel_integrated = settings.get('pixel_integrated', False)
+        # stop once position and intensity steps are below [position (px), intensity (%)], off by default
+        self.precision_convergence = settings.get('precision_convergence', None)
+        if self.pixel_integrated:
+            # calibration samples at pixel centers, which widens by the variance of a pixel, 1/12
+            self.sigmas = {roi_index: np.sqrt(np.maximum(np.square(sigma) - 1 / 12, EPS))
+                           for roi_index, sigma in sigmas.items()}
+            self.default_sigma = np.sqrt(np.maximum(np.square(self.default_sigma) - 1 / 12, EPS))
+
+        self.pixels = np.arange(self.roi_size, dtype=np.float64)
+        self.pixel_edges = np.arange(self.roi_size + 1, dtype=np.float64) - 0.5
+        self.phasor_weights = get_phasor_weights(self.roi_size, np.float64)
+
+    def define_fitter_bounds(self):
+        """
+        Defines fitter bounds, same as the other Gaussian fitters
+
+        Returns
+        -------
+        pos_max : Max position of fit
+        pos_min : Min position of fit
+        int_max : Max intensity of fit
+        int_min : Min intensity of fit
+
+        """
+        pos_max = self.roi_size
+        pos_min = 0
+        int_min = 0
+        int_max = ((2 ** 16) - 1) * 1.5  # 50% margin over maximum pixel value possible
+
+        return pos_max, pos_min, int_max, int_min
+
+    def phasor_guess(self, frame_stack, backgrounds, sigmas):
+        """
+        Returns initial guesses of all frames based on phasor fitting
 
         Parameters
         ----------
-        roi : region of interest
+        frame_stack : stack of frames of a single ROI
+        backgrounds : background of each frame
+        sigmas : sigma y and sigma x of each frame
 
         Returns
         -------
-        maximum
+        Parameters for fitting, per frame. In order: height (integrated intensity if pixel integrated), position y,
+        position x, (background).
 
         """
-        if self.roi_size == 9:
-            return fortran_tools.max9(roi)
-        elif self.roi_size == 7:
-            return fortran_tools.max7(roi)
+        values = frame_stack.reshape(frame_stack.shape[0], self.roi_size ** 2).astype(np.float64) @ self.phasor_weights
+        # phase in (-2 pi, 0], y from the harmonic along the rows
+        ang = np.arctan2(values[:, [4, 2]], values[:, [3, 1]])
+        ang[ang > 0] -= 2 * pi
+        pos = np.abs(ang) / (2 * pi / self.roi_size)
+        height = self.stack_max(frame_stack) - backgrounds
+        if self.pixel_integrated:
+            height *= 2 * pi * sigmas[:, 0] * sigmas[:, 1]
 
-    def fun_calc_bg(self, roi):
+        if self.fit_bg:
+            return np.column_stack([height, pos, backgrounds])
+        return np.column_stack([height, pos])
+
+    def step_converged(self, step, params):
         """
-        Input ROI, returns background using FORTRAN
+        Precision convergence criteria for levenberg_marquardt_batch
 
         Parameters
         ----------
-        roi : region of interest
+        step : last step of each fit
+        params : parameters after the step
 
         Returns
         -------
-        background
+        Boolean per fit, true if both position steps are below the position tolerance and the relative intensity
+        step is below the intensity tolerance
 
         """
-        if self.roi_size == 9:
-            return fortran_tools.calc_bg9(roi)
-        elif self.roi_size == 7:
-            return fortran_tools.calc_bg7(roi)
+        position_tolerance, intensity_tolerance = self.precision_convergence
+        return np.all(np.abs(step[:, 1:3]) <= position_tolerance, axis=1) & \
+            (np.abs(step[:, 0]) <= np.abs(params[:, 0]) * intensity_tolerance / 100)
 
-    def fft_to_pos(self, fft_values):
+    def profiles(self, position, sigma):
         """
-        Convert the found Fourier transform to a Phasor position
+        1D profile of the Gaussian along one direction and its derivative to the position
 
         Parameters
         ----------
-        fft_values : Fourier transform of ROI
+        position : position of each fit
+        sigma : sigma of each fit, (fits, 1)
 
         Returns
         -------
-        pos_x : x-position of Phasor
-        pos_y : y-position of Phasor
+        profile : value per pixel, (fits, roi_size). Fraction of the Gaussian in the pixel if pixel integrated,
+        otherwise value at pixel center relative to the height
+        derivative : derivative of profile to the position
 
         """
-        ang_x = phase(fft_values[0, 1])
-        if ang_x > 0:
-            ang_x = ang_x - 2 * pi
+        if self.pixel_integrated:
+            scale = np.sqrt(2) * sigma
+            value, derivative = erf_lookup((self.pixel_edges[None, :] - position[:, None]) / scale)
+            return np.diff(value, axis=1) / 2, -np.diff(derivative, axis=1) / (2 * scale)
 
-        pos_x = abs(ang_x) / (2 * pi / self.roi_size) + 0.5
+        dist = (self.pixels[None, :] - position[:, None]) / sigma
+        profile = np.exp(-0.5 * dist ** 2)
+        return profile, profile * dist / sigma
 
-        ang_y = phase(fft_values[1, 0])
+    def model_function(self, sigmas):
+        """
+        Model and analytic jacobian of a Gaussian with fixed sigma, for levenberg_marquardt_batch
 
-        if ang_y > 0:
-            ang_y = ang_y - 2 * pi
+        Parameters
+        ----------
+        sigmas : sigma y and sigma x of each fit
 
-        pos_y = abs(ang_y) / (2 * pi / self.roi_size) + 0.5
+        Returns
+        -------
+        Function of parameters (fits, params) and rows that returns model (fits, pixels) and jacobian
+        (fits, pixels, params)
 
-        return pos_x, pos_y
+        """
+        n_params = 4 if self.fit_bg else 3
 
-    def get_fft_values(self, frame_stack):
+        def model_jacobian(params, rows):
+            # separable, so only one profile per direction
+            profile_y, derivative_y = self.profiles(params[:, 1], sigmas[rows, 0, None])
+            profile_x, derivative_x = self.profiles(params[:, 2], sigmas[rows, 1, None])
+            shape = profile_y[:, :, None] * profile_x[:, None, :]
+            amplitude = params[:, 0, None, None]
+
+            jac = np.empty(shape.shape + (n_params,))
+            jac[..., 0] = shape
+            jac[..., 1] = amplitude * derivative_y[:, :, None] * profile_x[:, None, :]
+            jac[..., 2] = amplitude * profile_y[:, :, None] * derivative_x[:, None, :]
+            gaussian = amplitude * shape
+            if self.fit_bg:
+                jac[..., 3] = 1
+                gaussian += params[:, 3, None, None]
+
+            n_fits = params.shape[0]
+            return gaussian.reshape(n_fits, self.roi_size ** 2), jac.reshape(n_fits, self.roi_size ** 2, n_params)
+
+        return model_jacobian
+
+    def signal_to_noise(self, result, data, sigmas, intensity):
         """
-        Converts frame stack to fft values
-        -----------------------
-        :param frame_stack: frame stack to convert
-        :return: fft_values: fft of frame_stack
+        Signal-to-noise ratio of the integrated intensity of each fit. The noise per pixel is taken from the residual,
+        so it holds for any camera offset and gain. A least-squares intensity of a Gaussian on that noise has a standard
+        deviation of noise * sqrt(4 pi sigma_y sigma_x)
+
+        Parameters
+        ----------
+        result : fitted parameters
+        data : data that was fitted to
+        sigmas : sigma y and sigma x of each fit
+        intensity : integrated intensity of each fit
+
+        Returns
+        -------
+        Signal-to-noise ratio per fit
+
         """
-        roi_bb = empty_aligned(frame_stack.shape, dtype='float64')
-        roi_bf = empty_aligned((frame_stack.shape[0], self.roi_size, self.roi_size_1D + 1), dtype='complex128')
-        fft_values_list = FFTW(roi_bb, roi_bf, axes=(1, 2),
-                               flags=('FFTW_MEASURE',),
-                               direction='FFTW_FORWARD')
-        roi_bb = frame_stack
-        return fft_values_list(roi_bb)
+        model, _ = self.model_function(sigmas)(result, np.arange(result.shape[0]))
+        noise = np.sqrt(np.sum((data - model) ** 2, axis=1) / (data.shape[1] - result.shape[1]))
+        return intensity / np.maximum(noise * np.sqrt(4 * pi * sigmas[:, 0] * sigmas[:, 1]), EPS)
 
-    def fit_and_reject(self, fft_values):
+    def fit_stacks(self, frame_stacks, roi_indices, ys, xs, tt_part):
         """
-        Takes fft values, fits and rejects if need be
+        Does fixed sigma Gaussian fitting for all frames of several ROIs in one batch
+        --------------------------------------------------------
+        :param frame_stacks: frame stacks to be fitted, one per ROI
+        :param roi_indices: the index of each ROI
+        :param ys: y-position of each ROI center
+        :param xs: x-position of each ROI center
+        :param tt_part: information about which part of the TT is being fitted
+        :return: list of roi results
+        """
+        pos_max, pos_min, int_max, int_min = self.define_fitter_bounds()
+        n_frames = [frame_stack.shape[0] for frame_stack in frame_stacks]
+        frame_stack = np.concatenate(frame_stacks)
+        sigmas = np.repeat(np.asarray([self.sigmas.get(roi_index, self.default_sigma) for roi_index in roi_indices],
+                                      dtype=np.float64).reshape(-1, 2), n_frames, axis=0)
+        if frame_stack.shape[0] == 0:
+            return [np.empty((0, 8), dtype=self.dtype) for _ in frame_stacks]
+
+        backgrounds = self.stack_bg(frame_stack)
+        data = frame_stack.reshape(frame_stack.shape[0], self.roi_size ** 2).astype(np.float64)
+        if not self.fit_bg:
+            data -= backgrounds[:, None]
+        step_converged = None if self.precision_convergence is None else self.step_converged
+        result, nfev, success = levenberg_marquardt_batch(self.model_function(sigmas),
+                                                          self.phasor_guess(frame_stack, backgrounds, sigmas), data,
+                                                          self.max_its, step_converged=step_converged)
+
+        # integrated intensity and height of Gaussian
+        if self.pixel_integrated:
+            intensity = result[:, 0]
+            height = intensity / (2 * pi * sigmas[:, 0] * sigmas[:, 1])
+        else:
+            height = result[:, 0]
+            intensity = height * sigmas[:, 0] * sigmas[:, 1] * 2 * pi
+
+        if self.rejection is False:
+            success &= height != 0
+        else:
+            success &= (result[:, 1] >= pos_min) & (result[:, 1] <= pos_max) & \
+                       (result[:, 2] >= pos_min) & (result[:, 2] <= pos_max) & \
+                       (height > int_min) & (height <= int_max) & \
+                       (self.signal_to_noise(result, data, sigmas, intensity) >= FIXED_SIGMA_MIN_SNR)
+
+        roi_result = np.empty([frame_stack.shape[0], 8], dtype=self.dtype)
+        roi_result[:, 0] = np.concatenate([np.arange(n) for n in n_frames]) + tt_part.frame_start
+        # start position plus from center in ROI + half for indexing of pixels
+        roi_result[:, 1] = result[:, 1] + np.repeat(ys, n_frames) - self.roi_size_1D + 0.5 + \
+            tt_part.offset_from_base[0]  # y
+        roi_result[:, 2] = result[:, 2] + np.repeat(xs, n_frames) - self.roi_size_1D + 0.5 + \
+            tt_part.offset_from_base[1]  # x
+        roi_result[:, 3] = intensity
+        roi_result[:, 4:6] = sigmas
+        roi_result[:, 6] = result[:, 3] if self.fit_bg else backgrounds
+        roi_result[:, 7] = nfev
+        roi_result[~success, 1:] = np.nan
+
+        return np.split(roi_result, np.cumsum(n_frames)[:-1])
+
+    def fitter(self, frame_stack, roi_index, y, x, tt_part):
+        """
+        Does fixed sigma Gaussian fitting for all frames for a single ROI at once
+        --------------------------------------------------------
+        :param frame_stack: frame stack to be fitted of single ROI
+        :param roi_index: the ROIs index
+        :param y: y-position of ROI center
+        :param x: x-position of ROI center
+        :param tt_part: information about which part of the TT is being fitted
+        :return: roi results
+        """
+        return self.fit_stacks([frame_stack], [roi_index], [y], [x], tt_part)[0]
+
+    def run(self, frame_stacks, rois, tt_part, dataset=None, q=None, res_dict=None):
+        """
+        Run of fitter. Fits the frames of several ROIs in one batch, up to LM_BATCH fits, so the overhead of each
+        iteration is shared. In case of MP, q and res_dict are given, and the results wil be placed in there.
+        -------------------------------
+        :param frame_stacks: Frame stacks to fit
+        :param rois: ROIs to fit
+        :param tt_part: information about which part of the TT is being fitted
+        :param dataset: The dataset to fit. Only used when single core is used
+        :param q: Queue to place updates in when MP is used. Each time a ROI is finished, 1 is placed in it
+        :param res_dict: The shared dictionary to save results to. Only used for MP
+        :return: None. Edits dataset
+        """
+        if res_dict is not None:
+            res_dict["start_frame"] = tt_part.frame_start
+        self.reset_counters()
+
+        batch = []
+        n_batch = 0
+        n_updates = 0
+        for roi_number, (frame_stack, roi) in enumerate(zip(frame_stacks, rois)):
+            if frame_stack is not None:
+                batch.append((frame_stack, roi))
+                n_batch += frame_stack.shape[0]
+            n_updates += 1
+            if n_batch < LM_BATCH and roi_number < len(rois) - 1:
+                continue
+
+            if len(batch) > 0:
+                batch_results = self.fit_stacks([stack for stack, _ in batch], [roi.index for _, roi in batch],
+                                                [roi.y for _, roi in batch], [roi.x for _, roi in batch], tt_part)
+                for (batch_stack, batch_roi), roi_result in zip(batch, batch_results):
+                    result_dict = {"type": 'TT', "result": roi_result, "raw": batch_stack}
+                    # else triggered when split dataset in parts
+                    if res_dict is None:
+                        batch_roi.results[dataset.name_result] = result_dict
+                    else:
+                        res_dict["{}".format(batch_roi.index)] = result_dict
+
+            # regardless of frame_stack None or not, send update
+            for _ in range(n_updates):
+                if dataset is not None:
+                    dataset.experiment.progress_updater.update_progress()
+                else:
+                    q.put(1)
+            batch = []
+            n_batch = 0
+            n_updates = 0
+
+        if res_dict is not None:
+            res_dict["counters"] = dict(self.counters)
+
+# %% Radial symmetry
+
+
+class RadialSymmetry(BaseFitter):
+    """
+    Radial symmetry centre (Parthasarathy, Nature Methods 2012). Not iterative: takes the point closest to all lines
+    along the intensity gradient. Also returns intensity of pixel peak and background, same as Phasor + Intensity.
+    """
+    def __init__(self, settings, roi_offset):
+        """
+        Initializer of radial symmetry fitter. Sets positions of the gradients
+        ----------
+        :param settings: Fitting settings
+        :param roi_offset: offset of ROIs in dataset
+        """
+        super().__init__(settings, roi_offset)
+        # gradients are taken halfway between pixels
+        midpoints = np.arange(self.roi_size - 1, dtype=self.dtype) + 0.5
+        self.grid_y, self.grid_x = np.meshgrid(midpoints, midpoints, indexing='ij')
+
+    def gradients(self, frame_stack):
+        """
+        Intensity gradients of all frames halfway between pixels, smoothed with a 3x3 box to lower noise
         ------------------------
-        :param fft_values: values to fit
-        :return: pos_x: x pos found
-        :return: pos_y: y pos found
-        :return: success: if fit was success
+        :param frame_stack: frame stack of a single ROI
+        :return: grad_y: gradient in y, (frames, roi_size - 1, roi_size - 1)
+        :return: grad_x: gradient in x
+        """
+        frame_stack = frame_stack.astype(self.dtype, copy=False)
+        n_grid = self.roi_size - 1
+        # differences along the two diagonals
+        diff_u = frame_stack[:, :-1, 1:] - frame_stack[:, 1:, :-1]
+        diff_v = frame_stack[:, :-1, :-1] - frame_stack[:, 1:, 1:]
+
+        smoothed = []
+        for diff in (diff_u, diff_v):
+            padded = np.pad(diff, ((0, 0), (1, 1), (1, 1)))
+            box = np.zeros_like(diff)
+            for shift_y in range(3):
+                for shift_x in range(3):
+                    box += padded[:, shift_y:shift_y + n_grid, shift_x:shift_x + n_grid]
+            smoothed.append(box / 9)
+        diff_u, diff_v = smoothed
+
+        # rotate back to y and x, only direction and relative magnitude matter
+        return -(diff_u + diff_v) / 2, (diff_u - diff_v) / 2
+
+    def centres(self, frame_stack):
+        """
+        Radial symmetry centre of all frames. Solves the weighted least squares of the distances to the gradient lines.
+        Lines are weighted by squared gradient magnitude over the distance to the gradient-weighted centroid.
+        ------------------------
+        :param frame_stack: frame stack of a single ROI
+        :return: pos_y: y-positions of center in ROI, pixel centers at integers
+        :return: pos_x: x-positions of center in ROI
         """
-        success = 1
-        pos_x, pos_y = self.fft_to_pos(fft_values)
+        grad_y, grad_x = self.gradients(frame_stack)
+        grad_sq = grad_y ** 2 + grad_x ** 2
 
-        if self.rejection is True and (pos_x > self.roi_size or pos_x < 0):
-            success = 0
-        if self.rejection is True and (pos_y > self.roi_size or pos_y < 0):
-            success = 0
+        total = grad_sq.sum(axis=(1, 2))
+        centroid_y = (grad_sq * self.grid_y).sum(axis=(1, 2)) / total
+        centroid_x = (grad_sq * self.grid_x).sum(axis=(1, 2)) / total
+        distance = np.hypot(self.grid_y - centroid_y[:, None, None], self.grid_x - centroid_x[:, None, None])
+        weight = 1 / np.maximum(distance, EPS)
 
-        return pos_x, pos_y, success
+        # weighted projection perpendicular to each gradient line: |g|^2 I - g g^T
+        proj_yy = weight * grad_x ** 2
+        proj_xx = weight * grad_y ** 2
+        proj_yx = -weight * grad_y * grad_x
+        a_yy = proj_yy.sum(axis=(1, 2))
+        a_xx = proj_xx.sum(axis=(1, 2))
+        a_yx = proj_yx.sum(axis=(1, 2))
+        b_y = (proj_yy * self.grid_y + proj_yx * self.grid_x).sum(axis=(1, 2))
+        b_x = (proj_yx * self.grid_y + proj_xx * self.grid_x).sum(axis=(1, 2))
 
-    def fitter(self, frame_stack, roi_index, y, x, tt_part):
+        det = a_yy * a_xx - a_yx ** 2
+        pos_y = (a_xx * b_y - a_yx * b_x) / det
+        pos_x = (a_yy * b_x - a_yx * b_y) / det
+
+        return pos_y, pos_x
+
+    def define_fitter_bounds(self, frame_stack):
         """
-        Applies phasor fitting to an entire stack of frames of one ROI
+        Defines fitter bounds. Minimum intensity is RADIAL_SYMMETRY_MIN_PEAK times the noise of each frame, the
+        standard deviation of its edge pixels
 
         Parameters
         ----------
-        frame_stack : stack of frames of a single ROI
-        roi_index : Index of ROI that is currently being fitted
-        y : y-location with respect to total microscope frame of currently fitted ROI
-        x : x-location with respect to total microscope frame of currently fitted ROI
-        tt_part: information about which part of the TT is being fitted
+        frame_stack : frame stack of a single ROI
 
         Returns
         -------
-        roi_result : Result of all the frames of the current ROI
+        pos_max : Max position of fit
+        pos_min : Min position of fit
+        int_max : Max intensity of fit
+        int_min : Min intensity of fit, per frame
 
         """
-        roi_result = np.zeros([frame_stack.shape[0], 5])
-        fft_values_list = self.get_fft_values(frame_stack)
-
-        for frame_index, (fft_values, frame) in enumerate(zip(fft_values_list, frame_stack)):
-            my_frame_bg = self.fun_calc_bg(frame)
-            frame_max = self.fun_find_max(frame)
+        pos_max = self.roi_size - 0.5
+        pos_min = -0.5
+        edges = np.concatenate((frame_stack[:, 0, :], frame_stack[:, -1, :],
+                                frame_stack[:, 1:-1, 0], frame_stack[:, 1:-1, -1]), axis=1).astype(float)
+        int_min = RADIAL_SYMMETRY_MIN_PEAK * np.maximum(np.std(edges, axis=1), 1)  # at least one count
+        int_max = ((2 ** 16) - 1) * 1.5  # 50% margin over maximum pixel value possible
 
-            pos_x, pos_y, success = self.fit_and_reject(fft_values)
-            if frame_max == 0:
-                success = 0
+        return pos_max, pos_min, int_max, int_min
 
-            if success == 1:
-                roi_result[frame_index, 0] = frame_index + tt_part.frame_start
-                # start position plus from center in ROI + half for indexing of pixels
-                roi_result[frame_index, 1] = y + pos_y - self.roi_size_1D + tt_part.offset_from_base[0]  # y
-                roi_result[frame_index, 2] = x + pos_x - self.roi_size_1D + tt_part.offset_from_base[1]  # x
-                roi_result[frame_index, 3] = frame_max - my_frame_bg  # returns max peak
-                roi_result[frame_index, 4] = my_frame_bg  # background
-            else:
-                roi_result[frame_index, :] = np.nan
-                roi_result[frame_index, 0] = frame_index + tt_part.frame_start
+    def fitter(self, frame_stack, roi_index, y, x, tt_part):
+        """
+        Finds the radial symmetry centre of an entire stack of frames of one ROI
+        --------------------------------------------------------
+        :param frame_stack: frame stack to be fitted of single ROI
+        :param roi_index: the ROIs index
+        :param y: y-position of ROI center
+        :param x: x-position of ROI center
+        :param tt_part: information about which part of the TT is being fitted
+        :return: roi results
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pos_y, pos_x = self.centres(frame_stack)
+        # empty or flat frames have no gradient and no centre
+        success = np.isfinite(pos_y) & np.isfinite(pos_x)
+
+        frame_bg = self.stack_bg(frame_stack)
+        frame_max = self.stack_max(frame_stack)
+        success &= frame_max != 0
+        if self.rejection is True:
+            pos_max, pos_min, int_max, int_min = self.define_fitter_bounds(frame_stack)
+            success &= (pos_y >= pos_min) & (pos_y <= pos_max) & (pos_x >= pos_min) & (pos_x <= pos_max) & \
+                       (frame_max - frame_bg >= int_min) & (frame_max - frame_bg <= int_max)
+
+        roi_result = np.empty([frame_stack.shape[0], 5], dtype=self.dtype)
+        roi_result[:, 0] = np.arange(frame_stack.shape[0]) + tt_part.frame_start
+        # start position plus from center in ROI + half for indexing of pixels
+        roi_result[:, 1] = pos_y + y - self.roi_size_1D + 0.5 + tt_part.offset_from_base[0]  # y
+        roi_result[:, 2] = pos_x + x - self.roi_size_1D + 0.5 + tt_part.offset_from_base[1]  # x
+        roi_result[:, 3] = frame_max - frame_bg
+        roi_result[:, 4] = frame_bg
+        roi_result[~success, 1:] = np.nan
 
         return roi_result
 
-# %% Dumb phasor ROI loop
+# %% Phasor for ROI loops
 
 
-class PhasorDumb(Phasor):
+class Phasor(BaseFitter):
     """
-    Dumb Phasor. Does not return intensity of found location.
+    Phasor fitting using Fourier Transform. Also returns intensity of pixel in which Phasor position is found.
     """
-    def fitter(self, frame_stack, roi_index, y, x, tt_part):
+    def __init__(self, settings, roi_offset):
         """
-        Applies phasor fitting to an entire stack of frames of one ROI
+        Initializer of Phasor fitter. Precomputes the weights of the Fourier coefficients that are used
+        ----------
+        :param settings: Fitting settings
+        :param roi_offset: offset of ROIs in dataset
+        """
+        super().__init__(settings, roi_offset)
+        # full FFT only on request and if pyFFTW is installed, otherwise only the used coefficients are computed
+        self.use_fftw = settings.get('phasor_fft', False) and FFTW is not None
+        self.frame_major = settings.get('frame_major', False)
+
+        self.phasor_weights = get_phasor_weights(self.roi_size, self.dtype)
+
+    def fft_to_pos(self, fft_values):
+        """
+        Convert the found Fourier coefficients of all frames to Phasor positions
 
         Parameters
         ----------
-        frame_stack : stack of frames of a single ROI
-        roi_index : Index of ROI that is currently being fitted
-        y : y-location with respect to total microscope frame of currently fitted ROI
-        x : x-location with respect to total microscope frame of currently fitted ROI
-        tt_part: information about which part of the TT is being fitted
+        fft_values : DC and first harmonics in x and y of each frame
 
         Returns
         -------
-        roi_result : Result of all the frames of the current ROI
+        pos_x : x-positions of Phasor
+        pos_y : y-positions of Phasor
 
         """
-        roi_result = np.zeros([frame_stack.shape[0], 3])
-        fft_values_list = self.get_fft_values(frame_stack)
+        # phase in (-2 pi, 0]
+        ang = np.angle(fft_values[:, 1:])
+        ang[ang > 0] -= 2 * pi
+        pos = np.abs(ang) / (2 * pi / self.roi_size) + 0.5
 
-        for frame_index, (fft_values, frame) in enumerate(zip(fft_values_list, frame_stack)):
-            pos_x, pos_y, success = self.fit_and_reject(fft_values)
+        return pos[:, 0], pos[:, 1]
 
-            if success == 1:
-                roi_result[frame_index, 0] = frame_index + tt_part.frame_start
-                # start position plus from center in ROI + half for indexing of pixels
-                roi_result[frame_index, 1] = y + pos_y - self.roi_size_1D + tt_part.offset_from_base[0]  # y
-                roi_result[frame_index, 2] = x + pos_x - self.roi_size_1D + tt_part.offset_from_base[1]  # x
-            else:
-                roi_result[frame_index, :] = np.nan
-                roi_result[frame_index, 0] = frame_index + tt_part.frame_start
+    def get_fft_values(self, frame_stack):
+        """
+        Converts frame stack to the Fourier coefficients used by Phasor
+        -----------------------
+        :param frame_stack: frame stack to convert
+        :return: fft_values: per frame the DC, first harmonic in x, and first harmonic in y
+        """
+        if self.use_fftw:
+            # copy out of the buffer of the cached plan, that buffer is only valid until the next call
+            fft_full = get_fftw_plan(frame_stack.shape, self.dtype)(frame_stack)
+            return np.stack([fft_full[:, 0, 0], fft_full[:, 0, 1], fft_full[:, 1, 0]], axis=1)
 
-        return roi_result
+        values = frame_stack.reshape(frame_stack.shape[0], -1).astype(self.dtype, copy=False) @ self.phasor_weights
+        return np.stack([values[:, 0], values[:, 1] + 1j * values[:, 2], values[:, 3] + 1j * values[:, 4]], axis=1)
 
-# %% Phasor with sum
+    def fit_and_reject(self, fft_values):
+        """
+        Takes fft values of all frames, fits and rejects if need be
+        ------------------------
+        :param fft_values: values to fit
+        :return: pos_x: x pos found
+        :return: pos_y: y pos found
+        :return: success: boolean per frame if fit was success
+        """
+        pos_x, pos_y = self.fft_to_pos(fft_values)
 
+        if self.rejection is True:
+            success = (pos_x <= self.roi_size) & (pos_x >= 0) & (pos_y <= self.roi_size) & (pos_y >= 0)
+        else:
+            success = np.ones(pos_x.shape, dtype=bool)
+
+        return pos_x, pos_y, success
+
+    def extra_columns(self, frame_stack, fft_values, success):
+        """
+        Columns after the position, peak and background for Phasor + Intensity
+        ------------------------
+        :param frame_stack: patches that are fitted
+        :param fft_values: values of fit
+        :param success: boolean per patch if fit was success
+        :return: extra: extra columns of result
+        :return: success: success, also false if frame is empty
+        """
+        frame_bg = self.stack_bg(frame_stack)
+        frame_max = self.stack_max(frame_stack)
+        # returns max peak and background
+        return np.stack([frame_max - frame_bg, frame_bg], axis=1), success & (frame_max != 0)
+
+    def fit_patches(self, frame_stack, frame_numbers, y, x, tt_part):
+        """
+        Fits a stack of patches. Patches can be from one ROI over time or from many ROIs at once
+        ------------------------
+        :param frame_stack: patches to fit, (patches, roi_size, roi_size)
+        :param frame_numbers: frame number of each patch
+        :param y: y-position of ROI center of each patch, or a single y-position
+        :param x: x-position of ROI center of each patch, or a single x-position
+        :param tt_part: information about which part of the TT is being fitted
+        :return: roi_result: result of each patch
+        """
+        fft_values = self.get_fft_values(frame_stack)
+        pos_x, pos_y, success = self.fit_and_reject(fft_values)
+        extra, success = self.extra_columns(frame_stack, fft_values, success)
+
+        roi_result = np.empty([frame_stack.shape[0], 3 + extra.shape[1]], dtype=self.dtype)
+        roi_result[:, 0] = frame_numbers
+        # start position plus from center in ROI + half for indexing of pixels
+        roi_result[:, 1] = y + pos_y - self.roi_size_1D + tt_part.offset_from_base[0]  # y
+        roi_result[:, 2] = x + pos_x - self.roi_size_1D + tt_part.offset_from_base[1]  # x
+        roi_result[:, 3:] = extra
+        roi_result[~success, 1:] = np.nan
+
+        return roi_result
 
-class PhasorSum(Phasor):
-    """
-    Phasor Sum. Also returns summation of entire ROI
-    """
     def fitter(self, frame_stack, roi_index, y, x, tt_part):
         """
         Applies phasor fitting to an entire stack of frames of one ROI
@@ -1335,23 +2436,138 @@ class PhasorSum(Phasor):
         roi_result : Result of all the frames of the current ROI
 
         """
-        roi_result = np.zeros([frame_stack.shape[0], 4])
-        fft_values_list = self.get_fft_values(frame_stack)
+        frame_numbers = np.arange(frame_stack.shape[0]) + tt_part.frame_start
+        return self.fit_patches(frame_stack, frame_numbers, y, x, tt_part)
 
-        for frame_index, (fft_values, frame) in enumerate(zip(fft_values_list, frame_stack)):
-            frame_sum = np.sum(frame)
-            pos_x, pos_y, success = self.fit_and_reject(fft_values)
-            if frame_sum == 0:
-                success = 0
+    def frame_major_rois(self, rois, frame_shape, tt_part):
+        """
+        Finds the ROIs that are in frame and the indices of their patches, for frame-major fitting
+        ------------------------
+        :param rois: ROIs to fit
+        :param frame_shape: shape of a full frame
+        :param tt_part: information about which part of the TT is being fitted
+        :return: active_rois: ROIs in frame, these are the only ROIs that get a result
+        :return: patch_index: rows, columns, and ROI centers y and x of the patches
+        """
+        total_offset = self.roi_offset + tt_part.offset_from_base
+        pixels = np.arange(-self.roi_size_1D, self.roi_size_1D + 1)
+        active_rois = [roi for roi in rois if roi.in_frame(frame_shape, total_offset, self.roi_size_1D)]
+        roi_y = np.asarray([roi.y for roi in active_rois], dtype=int)
+        roi_x = np.asarray([roi.x for roi in active_rois], dtype=int)
+        rows = (roi_y + total_offset[0])[:, None, None] + pixels[None, :, None]
+        columns = (roi_x + total_offset[1])[:, None, None] + pixels[None, None, :]
+        return active_rois, (rows, columns, roi_y, roi_x)
 
-            if success == 1:
-                roi_result[frame_index, 0] = frame_index + tt_part.frame_start
-                # start position plus from center in ROI + half for indexing of pixels
-                roi_result[frame_index, 1] = y + pos_y - self.roi_size_1D + tt_part.offset_from_base[0]  # y
-                roi_result[frame_index, 2] = x + pos_x - self.roi_size_1D + tt_part.offset_from_base[1]  # x
-                roi_result[frame_index, 3] = frame_sum  # returns summation
+    def fit_frame_block(self, frame_block, first_frame, patch_index, tt_part):
+        """
+        Fits the patches of all ROIs in a block of frames at once
+        ------------------------
+        :param frame_block: full frames, (frames, height, width)
+        :param first_frame: number of first frame of block within TT part
+        :param patch_index: patch indices from frame_major_rois
+        :param tt_part: information about which part of the TT is being fitted
+        :return: patches: raw patches, (ROIs, frames, roi_size, roi_size)
+        :return: block_result: results, (ROIs, frames, columns)
+        """
+        rows, columns, roi_y, roi_x = patch_index
+        n_batch = frame_block.shape[0]
+        n_rois = roi_y.shape[0]
+        # (frames, ROIs, roi_size, roi_size)
+        patches = frame_block[:, rows, columns]
+        frame_numbers = np.repeat(np.arange(first_frame, first_frame + n_batch) + tt_part.frame_start, n_rois)
+        block_result = self.fit_patches(patches.reshape(-1, self.roi_size, self.roi_size), frame_numbers,
+                                        np.tile(roi_y, n_batch), np.tile(roi_x, n_batch), tt_part)
+        block_result = block_result.reshape(n_batch, n_rois, block_result.shape[1])
+        return patches.swapaxes(0, 1), block_result.swapaxes(0, 1)
+
+    def run_frame_major(self, frames, rois, tt_part, dataset=None, q=None, res_dict=None):
+        """
+        Frame-major run of fitter. Reads frames in batches and fits the patches of all ROIs of a batch at once.
+        Only one batch of frames is in memory, results and raw patches are written into per-ROI buffers.
+        -------------------------------
+        :param frames: lazy frames of the TT part, such as a sliced ND2
+        :param rois: ROIs to fit
+        :param tt_part: information about which part of the TT is being fitted
+        :param dataset: The dataset to fit. Only used when single core is used
+        :param q: Queue to place updates in when MP is used
+        :param res_dict: The shared dictionary to save results to. Only used for MP or multiple TT parts
+        :return: None. Edits dataset or res_dict
+        """
+        if res_dict is not None:
+            res_dict["start_frame"] = tt_part.frame_start
+        self.reset_counters()
+
+        n_frames = len(frames)
+        active_rois = patch_index = results = raw = None
+        updates_sent = 0
+
+        for batch_start in range(0, n_frames, FRAME_MAJOR_BATCH):
+            frame_block = np.asarray(frames[batch_start:batch_start + FRAME_MAJOR_BATCH])
+            n_batch = frame_block.shape[0]
+            if active_rois is None:
+                active_rois, patch_index = self.frame_major_rois(rois, frame_block.shape[1:], tt_part)
+
+            patches, block_result = self.fit_frame_block(frame_block, batch_start, patch_index, tt_part)
+            if results is None:
+                raw = np.empty((len(active_rois), n_frames, self.roi_size, self.roi_size), dtype=patches.dtype)
+                results = np.empty((len(active_rois), n_frames, block_result.shape[2]), dtype=self.dtype)
+            raw[:, batch_start:batch_start + n_batch] = patches
+            results[:, batch_start:batch_start + n_batch] = block_result
+
+            # progress is per ROI, so send the share of ROIs that corresponds to the frames done
+            updates_due = len(rois) * (batch_start + n_batch) // n_frames
+            for _ in range(updates_due - updates_sent):
+                if dataset is not None:
+                    dataset.experiment.progress_updater.update_progress()
+                else:
+                    q.put(1)
+            updates_sent = updates_due
+
+        for roi_number, roi in enumerate(active_rois or []):
+            result_dict = {"type": 'TT', "result": results[roi_number], "raw": raw[roi_number]}
+            if res_dict is None:
+                roi.results[dataset.name_result] = result_dict
             else:
-                roi_result[frame_index, :] = np.nan
-                roi_result[frame_index, 0] = frame_index + tt_part.frame_start
+                res_dict["{}".format(roi.index)] = result_dict
 
-        return roi_result
+        if res_dict is not None:
+            res_dict["counters"] = dict(self.counters)
+
+# %% Dumb phasor ROI loop
+
+
+class PhasorDumb(Phasor):
+    """
+    Dumb Phasor. Does not return intensity of found location.
+    """
+    def extra_columns(self, frame_stack, fft_values, success):
+        """
+        No columns after the position for Phasor
+        ------------------------
+        :param frame_stack: patches that are fitted
+        :param fft_values: values of fit
+        :param success: boolean per patch if fit was success
+        :return: extra: empty extra columns
+        :return: success: unchanged success
+        """
+        return np.empty((frame_stack.shape[0], 0), dtype=self.dtype), success
+
+# %% Phasor with sum
+
+
+class PhasorSum(Phasor):
+    """
+    Phasor Sum. Also returns summation of entire ROI
+    """
+    def extra_columns(self, frame_stack, fft_values, success):
+        """
+        Summation of entire ROI as column after the position for Phasor + Sum
+        ------------------------
+        :param frame_stack: patches that are fitted
+        :param fft_values: values of fit
+        :param success: boolean per patch if fit was success
+        :return: extra: summation column
+        :return: success: success, also false if frame is empty
+        """
+        frame_sum = fft_values[:, 0].real  # DC term is the sum
+        return frame_sum[:, None], success & (frame_sum != 0)